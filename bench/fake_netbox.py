@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+
+import json
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local stand-in for the netbox REST API (2.x flavour used by gen_intf_cfg.py):
+# sites, devices, interfaces, interface connections, vlans, circuits and
+# circuit terminations, seeded with synthetic data of configurable size.
+# Deletions are logged to the changelog (extras/object-changes).
+
+STATS = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'endpoints': dict()}
+STATS_LOCK = threading.Lock()
+DB = dict()
+DB_LOCK = threading.Lock()
+BASE_URL = 'http://127.0.0.1:8000'
+# netbox < 2.10 has no bulk PATCH/DELETE on list endpoints
+BULK_WRITES = True
+
+
+def now_iso():
+	return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def nested(obj, *keys):
+	return {k: obj[k] for k in keys if k in obj}
+
+
+def seed_db(sites=1, devices=10, interfaces=24, vlans=20, circuits=10, seed=1):
+	rnd = random.Random(seed)
+	ts = now_iso()
+	db = {
+		'dcim/sites': dict(),
+		'dcim/devices': dict(),
+		'dcim/interfaces': dict(),
+		'dcim/interface-connections': dict(),
+		'ipam/vlans': dict(),
+		'circuits/circuits': dict(),
+		'circuits/circuit-terminations': dict(),
+		'extras/object-changes': dict(),
+	}
+	ids = {'site': 0, 'device': 0, 'intf': 0, 'conn': 0, 'vlan': 0, 'circuit': 0, 'term': 0}
+
+	def next_id(kind):
+		ids[kind] += 1
+		return ids[kind]
+
+	providers = [{'id': i + 1, 'name': 'ISP{0}'.format(i + 1), 'slug': 'isp{0}'.format(i + 1)} for i in range(4)]
+	ctypes = [{'id': 1, 'name': 'Internet', 'slug': 'internet'}, {'id': 2, 'name': 'MPLS', 'slug': 'mpls'}]
+	roles = [{'id': 1, 'name': 'Router', 'slug': 'router'}, {'id': 2, 'name': 'Access switch', 'slug': 'access-switch'}]
+	dtypes = [{'id': 1, 'model': 'ISR4331', 'slug': 'isr4331'}, {'id': 2, 'model': '1841', 'slug': '1841'},
+		{'id': 3, 'model': 'C2960X', 'slug': 'c2960x'}]
+
+	for s in range(sites):
+		site_id = next_id('site')
+		site = {'id': site_id, 'name': 'SITE{0}'.format(site_id), 'slug': 'site{0}'.format(site_id),
+			'url': '{0}/api/dcim/sites/{1}/'.format(BASE_URL, site_id), 'last_updated': ts}
+		db['dcim/sites'][site_id] = site
+		site_nested = nested(site, 'id', 'name', 'slug', 'url')
+
+		site_vlans = list()
+		for v in range(vlans):
+			vlan_id = next_id('vlan')
+			tag = rnd.choice(['vlan_ok', 'vlan_ok', 'vlan_add', 'vlan_del'])
+			vlan = {'id': vlan_id, 'vid': 100 + v, 'name': 'VLAN{0}'.format(100 + v), 'site': site_nested,
+				'tags': [tag], 'url': '{0}/api/ipam/vlans/{1}/'.format(BASE_URL, vlan_id), 'last_updated': ts}
+			db['ipam/vlans'][vlan_id] = vlan
+			site_vlans.append(vlan)
+
+		site_circuits = list()
+		for c in range(circuits):
+			circuit_id = next_id('circuit')
+			circuit = {'id': circuit_id, 'cid': 'CID-{0:05d}'.format(circuit_id),
+				'provider': rnd.choice(providers), 'type': rnd.choice(ctypes),
+				'commit_rate': rnd.choice([10000, 100000, 1000000]),
+				'url': '{0}/api/circuits/circuits/{1}/'.format(BASE_URL, circuit_id), 'last_updated': ts}
+			db['circuits/circuits'][circuit_id] = circuit
+			site_circuits.append(circuit)
+
+		site_intfs = list()
+		for d in range(devices):
+			device_id = next_id('device')
+			is_switch = d % 2 == 1
+			device = {'id': device_id, 'name': '{0}-{1}{2}'.format(site['slug'], 'sw' if is_switch else 'rtr', device_id),
+				'display_name': None, 'device_role': roles[1] if is_switch else roles[0],
+				'device_type': dtypes[2] if is_switch else rnd.choice(dtypes[:2]), 'site': site_nested,
+				'primary_ip4': {'id': device_id, 'address': '10.0.{0}.{1}/32'.format(site_id % 256, device_id % 256)},
+				'url': '{0}/api/dcim/devices/{1}/'.format(BASE_URL, device_id), 'last_updated': ts}
+			device['display_name'] = device['name']
+			db['dcim/devices'][device_id] = device
+			dev_nested = nested(device, 'id', 'name', 'display_name', 'url')
+
+			for i in range(interfaces):
+				intf_id = next_id('intf')
+				mode = rnd.choice([None, None, {'value': 100, 'label': 'Access'}, {'value': 200, 'label': 'Tagged'}])
+				tags = list()
+				roll = rnd.random()
+				if roll < 0.05:
+					tags = ['isp_l3', 'cid_{0}'.format(rnd.choice(site_circuits)['id'])] if site_circuits else ['isp_l3']
+				elif roll < 0.10:
+					tags = ['isp_l2']
+				elif roll < 0.15:
+					tags = ['gw']
+				elif roll < 0.20:
+					tags = ['upd_trunk']
+				untagged = nested(rnd.choice(site_vlans), 'id', 'vid', 'name', 'url') if site_vlans and mode else None
+				tagged = [nested(v, 'id', 'vid', 'name', 'url') for v in rnd.sample(site_vlans, min(3, len(site_vlans)))] \
+					if mode and mode['value'] == 200 else list()
+				intf = {'id': intf_id, 'device': dev_nested, 'name': 'GigabitEthernet0/{0}'.format(i),
+					'form_factor': {'value': 1000, 'label': '1000BASE-T (1GE)'} if i else {'value': 200, 'label': 'Link Aggregation Group (LAG)'},
+					'enabled': True, 'lag': None, 'mtu': rnd.choice([None, 1500, 9000]), 'mac_address': None,
+					'mgmt_only': False, 'description': '', 'is_connected': False, 'interface_connection': None,
+					'circuit_termination': None, 'mode': mode, 'untagged_vlan': untagged, 'tagged_vlans': tagged,
+					'tags': tags, 'url': '{0}/api/dcim/interfaces/{1}/'.format(BASE_URL, intf_id), 'last_updated': ts}
+				db['dcim/interfaces'][intf_id] = intf
+				site_intfs.append(intf)
+
+		# Connect some interfaces pairwise inside the site
+		free = [i for i in site_intfs if not i['tags']]
+		rnd.shuffle(free)
+		for a, b in zip(free[0:len(free) // 4:2], free[1:len(free) // 4:2]):
+			if a['device']['id'] == b['device']['id']:
+				continue
+			conn_id = next_id('conn')
+			db['dcim/interface-connections'][conn_id] = {'id': conn_id,
+				'interface_a': nested(a, 'id', 'device', 'name', 'url'),
+				'interface_b': nested(b, 'id', 'device', 'name', 'url'), 'connection_status': {'value': True, 'label': 'Connected'}}
+			for x, y in ((a, b), (b, a)):
+				x['is_connected'] = True
+				x['interface_connection'] = {'interface': nested(y, 'id', 'device', 'name', 'url'),
+					'connection_status': {'value': True, 'label': 'Connected'}}
+
+		# Terminate some circuits on router interfaces
+		rtr_free = [i for i in site_intfs if not i['tags'] and not i['is_connected']
+			and 'rtr' in i['device']['name']]
+		for circuit, intf in zip(site_circuits[:len(site_circuits) // 2], rtr_free):
+			term_id = next_id('term')
+			db['circuits/circuit-terminations'][term_id] = {'id': term_id,
+				'circuit': nested(circuit, 'id', 'cid', 'url'), 'term_side': 'A', 'site': site_nested,
+				'interface': nested(intf, 'id', 'device', 'name', 'url')}
+			intf['circuit_termination'] = {'id': term_id, 'circuit': nested(circuit, 'id', 'cid', 'url'), 'term_side': 'A'}
+			intf['is_connected'] = True
+
+	return db
+
+
+def lookup(obj, path):
+	for key in path.split('.'):
+		if not isinstance(obj, dict):
+			return None
+		obj = obj.get(key)
+	return obj
+
+
+def match(endpoint, obj, key, values):
+	if key == 'id':
+		return str(obj['id']) in values
+	if key == 'id__in':
+		return str(obj['id']) in ','.join(values).split(',')
+	if key == 'name':
+		return str(obj.get('name')) in values
+	if key == 'site':
+		if endpoint == 'dcim/interface-connections':
+			# Either end on the site
+			return any(str(lookup(DB['dcim/devices'].get(lookup(obj, side + '.device.id')), 'site.slug'))
+				in [v.lower() for v in values] for side in ('interface_a', 'interface_b'))
+		return str(lookup(obj, 'site.slug')) in [v.lower() for v in values]
+	if key == 'site_id':
+		site_id = lookup(obj, 'site.id')
+		if site_id is None and endpoint.startswith('dcim/inter'):
+			device = DB['dcim/devices'].get(lookup(obj, 'device.id') or lookup(obj, 'interface_a.device.id'))
+			site_id = lookup(device, 'site.id')
+		return str(site_id) in values
+	if key == 'device_id':
+		return str(lookup(obj, 'device.id')) in values or str(lookup(obj, 'interface_a.device.id')) in values \
+			or str(lookup(obj, 'interface_b.device.id')) in values
+	if key == 'device':
+		return str(lookup(obj, 'device.name')) in values
+	if key == 'circuit_id':
+		return str(lookup(obj, 'circuit.id')) in values
+	if key == 'type':
+		return str(lookup(obj, 'type.slug')) in values
+	if key == 'provider':
+		return str(lookup(obj, 'provider.slug')) in values
+	if key == 'tag':
+		# Repeated tags narrow the result down, as in netbox
+		return all(v in (obj.get('tags') or []) for v in values)
+	if key == 'last_updated__gte':
+		parse = lambda value: datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+		return bool(obj.get('last_updated')) and parse(obj['last_updated']) >= min(parse(v) for v in values)
+	if key == 'vid':
+		return str(obj.get('vid')) in values
+	if key == 'action':
+		return str(lookup(obj, 'action.value')) in values
+	if key == 'changed_object_type':
+		return str(obj.get('changed_object_type')) in values
+	if key == 'time_after':
+		parse = lambda value: datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+		return parse(obj['time']) >= max(parse(v) for v in values)
+	return True
+
+
+def log_deletion(endpoint, obj):
+	# Changelog entry as netbox 2.x writes it, foreign keys in 'object_data' are plain ids
+	changes = DB['extras/object-changes']
+	change_id = max(changes, default=0) + 1
+	app, model = endpoint.split('/')
+	changes[change_id] = {'id': change_id, 'time': now_iso(), 'user_name': 'fake',
+		'action': {'value': 'delete', 'label': 'Deleted'},
+		'changed_object_type': '{0}.{1}'.format(app, model.replace('-', '').rstrip('s')),
+		'changed_object_id': obj['id'], 'changed_object': None,
+		'object_data': {k: v.get('id') if isinstance(v, dict) and 'id' in v else v for k, v in obj.items()},
+		'url': '{0}/api/extras/object-changes/{1}/'.format(BASE_URL, change_id)}
+
+
+class FakeNetboxHandler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def send_json(self, status, data):
+		body = json.dumps(data).encode() if data is not None else b''
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		with STATS_LOCK:
+			STATS['bytes_out'] += len(body)
+
+	def read_body(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		data = self.rfile.read(length) if length else b''
+		with STATS_LOCK:
+			STATS['bytes_in'] += len(data)
+		return json.loads(data) if data else None
+
+	def route(self):
+		url = urlparse(self.path)
+		parts = [p for p in url.path.split('/') if p]
+		# /api/<app>/<model>/[<id>/]
+		if len(parts) < 3 or parts[0] != 'api':
+			return None, None, parse_qs(url.query)
+		endpoint = '{0}/{1}'.format(parts[1], parts[2])
+		obj_id = int(parts[3]) if len(parts) > 3 and parts[3].isdigit() else None
+		with STATS_LOCK:
+			STATS['requests'] += 1
+			key = '{0} {1}'.format(self.command, endpoint)
+			STATS['endpoints'][key] = STATS['endpoints'].get(key, 0) + 1
+		return endpoint, obj_id, parse_qs(url.query)
+
+	def do_GET(self):
+		if self.path.startswith('/_stats'):
+			return self.send_json(200, get_stats())
+		endpoint, obj_id, query = self.route()
+		if endpoint is None:
+			return self.send_json(200, {'netbox-version': '2.5'})
+		if endpoint not in DB:
+			return self.send_json(404, {'detail': 'Not found.'})
+		if obj_id is not None:
+			obj = DB[endpoint].get(obj_id)
+			return self.send_json(200 if obj else 404, obj or {'detail': 'Not found.'})
+		limit = int((query.pop('limit', ['50']) or ['50'])[0]) or 1000
+		offset = int((query.pop('offset', ['0']) or ['0'])[0])
+		query.pop('brief', None)
+		with DB_LOCK:
+			objs = [o for o in DB[endpoint].values() if all(match(endpoint, o, k, v) for k, v in query.items())]
+		page = objs[offset:offset + limit]
+		next_url = None
+		if offset + limit < len(objs):
+			params = '&'.join('{0}={1}'.format(k, v) for k, vs in query.items() for v in vs)
+			next_url = '{0}{1}?{2}limit={3}&offset={4}'.format(BASE_URL, urlparse(self.path).path,
+				params + '&' if params else '', limit, offset + limit)
+		self.send_json(200, {'count': len(objs), 'next': next_url, 'previous': None, 'results': page})
+
+	def do_PATCH(self):
+		endpoint, obj_id, query = self.route()
+		data = self.read_body()
+		if endpoint not in DB:
+			return self.send_json(404, {'detail': 'Not found.'})
+		if obj_id is None and not BULK_WRITES:
+			return self.send_json(405, {'detail': 'Method "PATCH" not allowed.'})
+		with DB_LOCK:
+			items = [dict(data, id=obj_id)] if obj_id is not None else data
+			results = list()
+			for item in items:
+				obj = DB[endpoint].get(int(item['id']))
+				if obj is None:
+					return self.send_json(404, {'detail': 'Not found.'})
+				obj.update({k: v for k, v in item.items() if k != 'id'})
+				obj['last_updated'] = now_iso()
+				results.append(obj)
+		self.send_json(200, results[0] if obj_id is not None else results)
+
+	def do_DELETE(self):
+		endpoint, obj_id, query = self.route()
+		data = self.read_body()
+		if endpoint not in DB:
+			return self.send_json(404, {'detail': 'Not found.'})
+		if obj_id is None and not BULK_WRITES:
+			return self.send_json(405, {'detail': 'Method "DELETE" not allowed.'})
+		with DB_LOCK:
+			for item in ([{'id': obj_id}] if obj_id is not None else data):
+				obj = DB[endpoint].pop(int(item['id']), None)
+				if obj is not None:
+					log_deletion(endpoint, obj)
+		self.send_json(204, None)
+
+
+def reset_db(**seed_args):
+	# Fresh data and zeroed counters, e.g. between benchmark runs
+	db = seed_db(**seed_args)
+	with DB_LOCK:
+		DB.clear()
+		DB.update(db)
+	with STATS_LOCK:
+		STATS.update({'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'endpoints': dict()})
+
+
+def get_stats():
+	with STATS_LOCK:
+		return json.loads(json.dumps(STATS))
+
+
+def start_server(host='127.0.0.1', port=0, **seed_args):
+	global BASE_URL
+	server = ThreadingHTTPServer((host, port), FakeNetboxHandler)
+	server.daemon_threads = True
+	BASE_URL = 'http://{0}:{1}'.format(host, server.server_address[1])
+	reset_db(**seed_args)
+	thread = threading.Thread(target=server.serve_forever, daemon=True)
+	thread.start()
+	return server, BASE_URL
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--port', dest='port', type=int, default=8000, help='listen port')
+	parser.add_argument('--sites', dest='sites', type=int, default=1, help='number of sites')
+	parser.add_argument('--devices', dest='devices', type=int, default=10, help='devices per site')
+	parser.add_argument('--interfaces', dest='interfaces', type=int, default=24, help='interfaces per device')
+	parser.add_argument('--vlans', dest='vlans', type=int, default=20, help='vlans per site')
+	parser.add_argument('--no-bulk', dest='no_bulk', action='store_true', help='reject bulk PATCH/DELETE (netbox < 2.10)')
+	parser.add_argument('--circuits', dest='circuits', type=int, default=10, help='circuits per site')
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	ARGS = get_cmdline()
+	BULK_WRITES = not ARGS.no_bulk
+	server, url = start_server(port=ARGS.port, sites=ARGS.sites, devices=ARGS.devices,
+		interfaces=ARGS.interfaces, vlans=ARGS.vlans, circuits=ARGS.circuits)
+	print('Fake netbox listening on {0}'.format(url))
+	try:
+		threading.Event().wait()
+	except KeyboardInterrupt:
+		server.shutdown()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+from napalm.base import NetworkDriver
+from napalm.base.exceptions import ConnectionException
+
+
+# NAPALM driver stand-in: keeps a per-device "running config" on disk, answers
+# compare_config() with the candidate lines not present in it and appends them
+# on commit. Latencies are configurable through the environment.
+
+FAKE_STATE_DIR = os.environ.get('FAKE_NAPALM_DIR', './fake_devices')
+FAKE_LATENCY = float(os.environ.get('FAKE_NAPALM_LATENCY', '0.05'))
+# Comma separated hosts that refuse connections
+FAKE_UNREACHABLE = os.environ.get('FAKE_NAPALM_UNREACHABLE', '').split(',')
+OPEN_SESSIONS = {'count': 0, 'max': 0, 'opened': 0}
+OPEN_SESSIONS_LOCK = threading.Lock()
+
+
+class FakeDriver(NetworkDriver):
+
+	def __init__(self, hostname, username, password, timeout=60, optional_args=None):
+		self.hostname = hostname
+		self.candidate = ''
+		self.opened = False
+
+	def _running_file(self):
+		return os.path.join(FAKE_STATE_DIR, '{0}.running'.format(self.hostname))
+
+	def _running(self):
+		if os.path.exists(self._running_file()):
+			with open(self._running_file()) as f:
+				return f.read()
+		return 'hostname {0}\n!\n'.format(self.hostname)
+
+	def open(self):
+		time.sleep(FAKE_LATENCY * 4)
+		if self.hostname in FAKE_UNREACHABLE:
+			raise ConnectionException('Cannot connect to {0}'.format(self.hostname))
+		self.opened = True
+		with OPEN_SESSIONS_LOCK:
+			OPEN_SESSIONS['count'] += 1
+			OPEN_SESSIONS['opened'] += 1
+			OPEN_SESSIONS['max'] = max(OPEN_SESSIONS['max'], OPEN_SESSIONS['count'])
+
+	def close(self):
+		if self.opened:
+			self.opened = False
+			with OPEN_SESSIONS_LOCK:
+				OPEN_SESSIONS['count'] -= 1
+
+	def is_alive(self):
+		return {'is_alive': self.opened}
+
+	def load_merge_candidate(self, filename=None, config=None):
+		if filename:
+			with open(filename) as f:
+				config = f.read()
+		self.candidate = config or ''
+
+	def compare_config(self):
+		time.sleep(FAKE_LATENCY)
+		running = set(self._running().splitlines())
+		return '\n'.join('+' + line for line in self.candidate.splitlines()
+			if line.strip() and line.strip() != '!' and line not in running)
+
+	def commit_config(self, message='', revert_in=None):
+		time.sleep(FAKE_LATENCY * 2)
+		os.makedirs(FAKE_STATE_DIR, exist_ok=True)
+		with open(self._running_file(), 'a') as f:
+			f.write(self.candidate)
+		self.candidate = ''
+
+	def discard_config(self):
+		self.candidate = ''
+
+	def get_config(self, retrieve='all', full=False, sanitized=False, format='text'):
+		time.sleep(FAKE_LATENCY)
+		return {'running': self._running(), 'startup': '', 'candidate': ''}
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import glob
+import json
+import time
+import yaml
+import shutil
+import signal
+import argparse
+import tempfile
+import threading
+import subprocess
+
+# Local fake_netbox.py
+import fake_netbox
+
+
+# End-to-end runs of gen_intf_cfg.py against the fake netbox, the fake NAPALM driver and
+# fake_clogin. Every run gets freshly seeded data and an empty work dir, so runs are comparable.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SCENARIOS = {
+	'i1': ['-i1', '{device}', '-y'],
+	'i2': ['-i2', '{site}', '-y'],
+	'i3': ['-i3', '{device}', '-y'],
+	'v3': ['-v3', '{site}', '-y'],
+	'c': ['-c'],
+	# Render-only, every site, no device touched
+	'r': ['-i2', 'all', '--render', './out/render'],
+	# Cold start only: imports, config, argument parsing
+	'h': ['-h'],
+}
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-s', dest='scenarios', type=str, default=','.join(SCENARIOS),
+							help='comma separated SCENARIOS to run (default: {0}).'.format(','.join(SCENARIOS)),
+							required=False)
+	parser.add_argument('--sites', dest='sites', type=int, default=2, help='number of sites (default: 2).')
+	parser.add_argument('--devices', dest='devices', type=int, default=10, help='devices per site (default: 10).')
+	parser.add_argument('--interfaces', dest='interfaces', type=int, default=24, help='interfaces per device (default: 24).')
+	parser.add_argument('--vlans', dest='vlans', type=int, default=20, help='vlans per site (default: 20).')
+	parser.add_argument('--circuits', dest='circuits', type=int, default=10, help='circuits per site (default: 10).')
+	parser.add_argument('--latency', dest='latency', type=float, default=0.05,
+							help='fake device latency per operation, s (default: 0.05).')
+	parser.add_argument('--no-bulk', dest='no_bulk', action='store_true', help='fake netbox rejects bulk PATCH/DELETE.')
+	parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+							help='runs per scenario, the fastest one is reported (default: 1).')
+	parser.add_argument('--timeout', dest='timeout', type=int, default=600, help='max time per run, s (default: 600).')
+	parser.add_argument('--args', dest='extra_args', type=str, default='',
+							help='extra gen_intf_cfg.py arguments for every scenario, e.g. \'--workers 8\'.')
+	parser.add_argument('--json', dest='json_file', type=str, help='also write the results to a JSON FILE.')
+	parser.add_argument('--keep', dest='keep', action='store_true', help='keep work dirs (logs, fake device state).')
+	return parser.parse_args()
+
+
+def get_seed_args(args=None):
+	return {
+		'sites': args.sites,
+		'devices': args.devices,
+		'interfaces': args.interfaces,
+		'vlans': args.vlans,
+		'circuits': args.circuits,
+	}
+
+
+def get_targets():
+	# First site, its first device, and the last router of every site (pushed through clogin)
+	devices = sorted(fake_netbox.DB['dcim/devices'].values(), key=lambda d: d['id'])
+	site = devices[0]['site']['slug']
+	telnet = dict()
+	for device in devices:
+		if '-rtr' in device['name']:
+			telnet[device['site']['slug']] = device['name']
+	return {'site': site, 'device': devices[0]['name']}, sorted(telnet.values())
+
+
+def make_work_dir(url=None, telnet=None):
+	work_dir = tempfile.mkdtemp(prefix='netbox-bench-')
+	for py_file in glob.glob(os.path.join(REPO_DIR, '*.py')):
+		os.symlink(py_file, os.path.join(work_dir, os.path.basename(py_file)))
+	os.makedirs(os.path.join(work_dir, 'out'))
+	for tpl_file in glob.glob(os.path.join(REPO_DIR, 'out', '*.j2')):
+		shutil.copy(tpl_file, os.path.join(work_dir, 'out'))
+	os.symlink(os.path.join(BENCH_DIR, 'fake_clogin'), os.path.join(work_dir, 'clogin'))
+	open(os.path.join(work_dir, '.cloginrc'), 'w').close()
+
+	with open(os.path.join(REPO_DIR, 'config.yml.default')) as f:
+		params = yaml.safe_load(f)
+	params['netbox']['url'] = url
+	params['netbox']['token'] = 'bench'
+	params['napalm'] = {'default': {'driver': 'fake', 'username': 'bench', 'password': 'bench', 'timeout': 60}}
+	params['telnet'] = telnet
+	with open(os.path.join(work_dir, 'config.yml'), 'w') as f:
+		yaml.safe_dump(params, f, default_flow_style=False)
+	return work_dir
+
+
+def run_scenario(name=None, cmd_args=None, args=None, url=None):
+	fake_netbox.reset_db(**get_seed_args(args))
+	targets, telnet = get_targets()
+	work_dir = make_work_dir(url, telnet)
+	cmd = [sys.executable, 'gen_intf_cfg.py'] + [a.format(**targets) for a in cmd_args] + args.extra_args.split()
+	env = dict(os.environ,
+		PYTHONPATH=os.pathsep.join(filter(None, [BENCH_DIR, os.environ.get('PYTHONPATH')])),
+		FAKE_NAPALM_DIR=os.path.join(work_dir, 'fake_devices'),
+		FAKE_NAPALM_LATENCY=str(args.latency))
+
+	log_file = os.path.join(work_dir, 'run.log')
+	with open(log_file, 'w') as log:
+		start = time.time()
+		proc = subprocess.Popen(cmd, cwd=work_dir, env=env, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+		timer = threading.Timer(args.timeout, os.kill, (proc.pid, signal.SIGKILL))
+		timer.start()
+		# wait4() gives the peak RSS of this child only
+		pid, status, rusage = os.wait4(proc.pid, 0)
+		wall_time = time.time() - start
+		timer.cancel()
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	stats = fake_netbox.get_stats()
+
+	result = {
+		'scenario': name,
+		'cmd': ' '.join(cmd[1:]),
+		'exit': proc.returncode,
+		'wall': wall_time,
+		'requests': stats['requests'],
+		'bytes': stats['bytes_in'] + stats['bytes_out'],
+		'peak_rss_mb': rusage.ru_maxrss / 1024.0,
+		'endpoints': stats['endpoints'],
+		'work_dir': work_dir if args.keep else None,
+	}
+	if proc.returncode != 0:
+		with open(log_file) as f:
+			result['log_tail'] = f.read()[-2000:]
+	if not args.keep:
+		shutil.rmtree(work_dir, ignore_errors=True)
+	return result
+
+
+def format_bytes(size=None):
+	for unit in ('B', 'KB', 'MB'):
+		if size < 1024:
+			return '{0:.0f} {1}'.format(size, unit)
+		size /= 1024.0
+	return '{0:.1f} GB'.format(size)
+
+
+def print_results(results=None):
+	row = '{0:<8}  {1:>4}  {2:>8}  {3:>8}  {4:>10}  {5:>9}  {6}'
+	print('\nResults:')
+	print('*****')
+	print(row.format('scenario', 'exit', 'wall, s', 'requests', 'bytes', 'peak, MB', 'command'))
+	for r in results:
+		print(row.format(r['scenario'], r['exit'], '{0:.2f}'.format(r['wall']), r['requests'],
+			format_bytes(r['bytes']), '{0:.1f}'.format(r['peak_rss_mb']), r['cmd']))
+	print('*****')
+	for r in results:
+		if r.get('log_tail'):
+			print('\n{0} failed, end of its output:\n{1}'.format(r['scenario'], r['log_tail']))
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+		fake_netbox.BULK_WRITES = not ARGS.no_bulk
+		server, url = fake_netbox.start_server(**get_seed_args(ARGS))
+		print('Fake netbox listening on {0}, {1}'.format(url, json.dumps(get_seed_args(ARGS))))
+
+		results = list()
+		for name in ARGS.scenarios.split(','):
+			if name not in SCENARIOS:
+				raise Exception('Unknown scenario \'{0}\'!'.format(name))
+			runs = [run_scenario(name, SCENARIOS[name], ARGS, url) for n in range(max(ARGS.repeat, 1))]
+			best = min(runs, key=lambda r: r['wall'])
+			print('{0}: {1:.2f}s, {2} request(s)'.format(name, best['wall'], best['requests']))
+			results.append(best)
+		server.shutdown()
+
+		print_results(results)
+		if ARGS.json_file:
+			with open(ARGS.json_file, 'w') as f:
+				json.dump({'params': get_seed_args(ARGS), 'latency': ARGS.latency, 'results': results}, f, indent=2)
+		if any(r['exit'] != 0 for r in results):
+			sys.exit(1)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import gzip
+import time
+import argparse
+from datetime import datetime, timezone
+
+
+# Running configs are kept compressed and versioned per device:
+#   <archive dir>/<device>/<YYYYmmddTHHMMSSffffffZ>.cfg.gz
+# A '.stale' marker newer than the latest version means the device was changed since.
+
+ARCHIVE_SUFFIX = '.cfg.gz'
+STALE_MARKER = '.stale'
+TS_FORMAT = '%Y%m%dT%H%M%S%fZ'
+
+
+def get_device_dir(archive_dir=None, device=None):
+	return os.path.join(archive_dir, str(device).lower())
+
+
+def list_versions(archive_dir=None, device=None):
+	# Oldest first, file names sort by timestamp
+	device_dir = get_device_dir(archive_dir, device)
+	if not os.path.isdir(device_dir):
+		return list()
+	return sorted(f for f in os.listdir(device_dir) if f.endswith(ARCHIVE_SUFFIX))
+
+
+def get_version_time(version=None):
+	ts = datetime.strptime(version[:-len(ARCHIVE_SUFFIX)], TS_FORMAT).replace(tzinfo=timezone.utc)
+	return ts.timestamp()
+
+
+def save_config(archive_dir=None, device=None, config_text=None, keep=0):
+	try:
+		if not archive_dir:
+			raise Exception('No archive dir specified!')
+		elif not device:
+			raise Exception('No device specified!')
+		elif config_text is None:
+			raise Exception('No config provided!')
+
+		device_dir = get_device_dir(archive_dir, device)
+		os.makedirs(device_dir, exist_ok=True)
+		version = datetime.now(timezone.utc).strftime(TS_FORMAT) + ARCHIVE_SUFFIX
+		tmp_file = os.path.join(device_dir, '.' + version + '.tmp')
+		with gzip.open(tmp_file, 'wt') as file:
+			file.write(config_text)
+		os.replace(tmp_file, os.path.join(device_dir, version))
+
+		marker = os.path.join(device_dir, STALE_MARKER)
+		if os.path.exists(marker):
+			os.remove(marker)
+
+		if keep:
+			for old_version in list_versions(archive_dir, device)[:-keep]:
+				os.remove(os.path.join(device_dir, old_version))
+		return os.path.join(device_dir, version)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def load_config(archive_dir=None, device=None, version=None):
+	with gzip.open(os.path.join(get_device_dir(archive_dir, device), version), 'rt') as file:
+		return file.read()
+
+
+def get_fresh_config(archive_dir=None, device=None, max_age=0):
+	# Latest archived config if it's younger than max_age seconds and the device
+	# wasn't changed since, otherwise None
+	if not (archive_dir and max_age):
+		return None
+	versions = list_versions(archive_dir, device)
+	if not versions:
+		return None
+	if time.time() - get_version_time(versions[-1]) > max_age:
+		return None
+	if os.path.exists(os.path.join(get_device_dir(archive_dir, device), STALE_MARKER)):
+		return None
+	return load_config(archive_dir, device, versions[-1])
+
+
+def mark_stale(archive_dir=None, device=None):
+	device_dir = get_device_dir(archive_dir, device)
+	if archive_dir and os.path.isdir(device_dir):
+		with open(os.path.join(device_dir, STALE_MARKER), 'w') as file:
+			file.write(datetime.now(timezone.utc).isoformat())
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('-d', dest='archive_dir', type=str, default='./archive',
+							help='archive DIR (default: ./archive).',
+							required=False)
+	parser.add_argument('-l', dest='list_device', type=str,
+							help='list archived versions of a DEVICE.',
+							required=False)
+	parser.add_argument('-s', dest='show_device', type=str,
+							help='print the latest (or -v VERSION) archived config of a DEVICE.',
+							required=False)
+	parser.add_argument('-v', dest='version', type=str,
+							help='VERSION (file name) to print with -s.',
+							required=False)
+	arguments = parser.parse_args()
+	return arguments
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+
+		if ARGS.list_device:
+			for version in list_versions(ARGS.archive_dir, ARGS.list_device):
+				print('{0}  {1}'.format(version, datetime.fromtimestamp(get_version_time(version), timezone.utc).isoformat()))
+
+		elif ARGS.show_device:
+			versions = list_versions(ARGS.archive_dir, ARGS.show_device)
+			if not versions:
+				raise Exception('Nothing archived for {0}!'.format(ARGS.show_device))
+			print(load_config(ARGS.archive_dir, ARGS.show_device, ARGS.version or versions[-1]), end='')
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
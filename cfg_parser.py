@@ -1,18 +1,146 @@
-#!/usr/bin/env python
-
-
-from ciscoconfparse import CiscoConfParse
-
-
-def main():
-	try:
-		confparse = CiscoConfParse("example_config.txt")
-
-	except Exception as e:
-		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
-			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
-		print(msg)
-		sys.exit(1)
-
-if __name__ == "__main__":
-	main()
+#!/usr/bin/env python
+
+import sys
+import os
+import re
+import argparse
+from ciscoconfparse import CiscoConfParse
+
+
+ALLOWED_VLAN_RE = re.compile(r'^switchport trunk allowed vlan (add )?(\S+)$')
+# Only in these VTP modes are vlans part of the running config
+VTP_LOCAL_VLAN_MODES = ('vtp mode transparent', 'vtp mode off')
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('running', type=str, help='running config FILE of a device.')
+	parser.add_argument('rendered', type=str, help='rendered config FILE (tpl_intf.j2/tpl_vlan.j2 output).')
+	arguments = parser.parse_args()
+	return arguments
+
+
+def expand_vlan_list(vlans=None):
+	# '1,5-7' -> [1, 5, 6, 7]
+	vlan_list = set()
+	for item in str(vlans or '').split(','):
+		item = item.strip()
+		if not item or item == 'none':
+			continue
+		if '-' in item:
+			first, last = item.split('-', 1)
+			vlan_list.update(range(int(first), int(last) + 1))
+		else:
+			vlan_list.add(int(item))
+	return sorted(vlan_list)
+
+
+def build_cfg_tree(cfg_objs=None):
+	# Parent line -> tree of its children, '!' comments are dropped
+	tree = dict()
+	allowed_vlans = None
+	for obj in cfg_objs or []:
+		text = obj.text.strip()
+		if not text or text.startswith('!'):
+			continue
+		# Trunk allowed list can be split over several 'add' lines and compressed into
+		# ranges by the device, keep a single normalized line for it
+		match = ALLOWED_VLAN_RE.match(text)
+		if match:
+			allowed_vlans = (allowed_vlans or list()) + expand_vlan_list(match.group(2))
+			continue
+		subtree = build_cfg_tree(obj.children)
+		if text in tree:
+			tree[text].update(subtree)
+		else:
+			tree[text] = subtree
+	if allowed_vlans is not None:
+		tree['switchport trunk allowed vlan {0}'.format(','.join(str(v) for v in sorted(set(allowed_vlans))))] = dict()
+	return tree
+
+
+def parse_cfg(config_text=None):
+	parse = CiscoConfParse((config_text or '').splitlines())
+	return build_cfg_tree(parse.find_objects(r'^\S'))
+
+
+def get_tree_delta(running_tree=None, rendered_tree=None, depth=0):
+	delta = list()
+	for text, children in rendered_tree.items():
+		if text.startswith('no '):
+			positive = text[3:]
+			if depth == 0 and positive.startswith('vlan ') and not any(mode in running_tree
+				for mode in VTP_LOCAL_VLAN_MODES):
+				# VTP server/client (the default) keeps vlans in vlan.dat, a missing 'vlan N' says nothing
+				needed = True
+			elif depth == 0:
+				# Global 'no X' (e.g. 'no vlan 10') only matters if X is configured
+				needed = (positive in running_tree) or any(k.startswith(positive + ' ') for k in running_tree)
+			else:
+				# Interface level negations are shown literally in running config
+				needed = text not in running_tree
+			if needed:
+				delta.append((depth, text))
+				delta.extend(get_tree_lines(children, depth + 1))
+			continue
+		if text not in running_tree:
+			delta.append((depth, text))
+			delta.extend(get_tree_lines(children, depth + 1))
+		else:
+			sub_delta = get_tree_delta(running_tree[text], children, depth + 1)
+			if sub_delta:
+				delta.append((depth, text))
+				delta.extend(sub_delta)
+	return delta
+
+
+def get_tree_lines(tree=None, depth=0):
+	lines = list()
+	for text, children in tree.items():
+		lines.append((depth, text))
+		lines.extend(get_tree_lines(children, depth + 1))
+	return lines
+
+
+def get_cfg_delta(running_config=None, rendered_config=None):
+	try:
+		if running_config is None:
+			raise Exception('No running config provided!')
+
+		delta = get_tree_delta(parse_cfg(running_config), parse_cfg(rendered_config))
+		lines = list()
+		for n, (depth, text) in enumerate(delta):
+			lines.append(' ' * depth + text)
+			# Close every top level block the same way the templates do
+			if depth > 0 and ((n + 1 == len(delta)) or (delta[n + 1][0] == 0)):
+				lines.append('!')
+		return '\n'.join(lines) + '\n' if lines else ''
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+		with open(ARGS.running) as f:
+			running_config = f.read()
+		with open(ARGS.rendered) as f:
+			rendered_config = f.read()
+		delta = get_cfg_delta(running_config, rendered_config)
+		if delta:
+			print(delta, end='')
+		else:
+			print('No effective changes!')
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
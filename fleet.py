@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Local profiler.py
+from profiler import stage, set_profile_device
+
+
+# Per-site semaphores limiting how many devices of the same site are handled at once
+SITE_LOCKS = dict()
+SITE_LOCKS_GUARD = threading.Lock()
+
+
+def get_site_lock(site=None, site_workers=0):
+	with SITE_LOCKS_GUARD:
+		if site not in SITE_LOCKS:
+			SITE_LOCKS[site] = threading.BoundedSemaphore(site_workers)
+		return SITE_LOCKS[site]
+
+
+def run_task(task=None, site_workers=0):
+	result = {
+		'device': task['device'],
+		'site': task.get('site'),
+		'status': 'failed',
+		'elapsed': 0.0,
+		'error': None,
+	}
+	site_lock = get_site_lock(task.get('site'), site_workers) if site_workers else None
+	if site_lock:
+		site_lock.acquire()
+	start = time.time()
+	try:
+		load = run_task_func(task)
+		if load is None:
+			result['status'] = 'skipped'
+		elif load:
+			result['status'] = 'ok'
+		else:
+			result['status'] = 'nok'
+	# Local functions report errors and call sys.exit(1), keep it inside the worker
+	except SystemExit as e:
+		result['error'] = 'exit code {0}'.format(e.code)
+	except Exception as e:
+		result['error'] = str(e)
+	finally:
+		result['elapsed'] = time.time() - start
+		if site_lock:
+			site_lock.release()
+	return result
+
+
+def run_task_func(task=None):
+	# Stages recorded inside the task are attributed to its device
+	set_profile_device(task['device'])
+	try:
+		with stage('total', device=task['device']):
+			return task['func'](**task.get('kwargs', dict()))
+	finally:
+		set_profile_device(None)
+
+
+def interleave_sites(tasks=None):
+	# Round-robin over sites so per-site limits don't park all workers on one site
+	by_site = dict()
+	for task in tasks:
+		by_site.setdefault(task.get('site'), list()).append(task)
+	ordered = list()
+	while by_site:
+		for site in list(by_site):
+			ordered.append(by_site[site].pop(0))
+			if not by_site[site]:
+				del by_site[site]
+	return ordered
+
+
+def run_fleet(tasks=None, workers=1, site_workers=0):
+	try:
+		if not tasks:
+			raise Exception('No tasks provided!')
+
+		results = list()
+
+		# Single worker runs the devices one after another in this thread, a failed device
+		# doesn't stop the others either
+		if workers <= 1:
+			for task in tasks:
+				results.append(run_task(task))
+			return results
+
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			futures = [pool.submit(run_task, task, site_workers) for task in interleave_sites(tasks)]
+			for future in as_completed(futures):
+				results.append(future.result())
+
+		# Keep the original device order in the summary
+		order = {task['device']: n for n, task in enumerate(tasks)}
+		results.sort(key=lambda r: order.get(r['device'], 0))
+		return results
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def print_fleet_summary(results=None, wall_time=None):
+	if not results:
+		return
+	dev_width = max(len('device'), max(len(str(r['device'])) for r in results))
+	site_width = max(len('site'), max(len(str(r['site'] or '-')) for r in results))
+	row = '{0:<{dw}}  {1:<{sw}}  {2:<8}  {3:>9}  {4}'
+	print('\nSummary:')
+	print('*****')
+	print(row.format('device', 'site', 'status', 'time, s', 'error', dw=dev_width, sw=site_width))
+	for r in results:
+		print(row.format(str(r['device']), str(r['site'] or '-'), r['status'], '{0:.1f}'.format(r['elapsed']),
+			r['error'] or '', dw=dev_width, sw=site_width))
+	counts = dict()
+	for r in results:
+		counts[r['status']] = counts.get(r['status'], 0) + 1
+	totals = ', '.join('{0}: {1}'.format(k, v) for k, v in sorted(counts.items()))
+	if wall_time is not None:
+		totals += ', wall time: {0:.1f}s'.format(wall_time)
+	print('*****')
+	print(totals)
@@ -2,19 +2,38 @@
 
 import sys
 import os
+import re
+import time
 import subprocess
+import hashlib
+import threading
+import atexit
+import functools
 import yaml
 import json
-import requests
-import pynetbox
-from pprint import pprint
-from jinja2 import Environment, FileSystemLoader
-from napalm import get_network_driver
+from array import array
+from datetime import datetime, timezone, timedelta
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+# Local cfg_archive.py
+from cfg_archive import save_config, get_fresh_config, mark_stale
+# Local profiler.py
+from profiler import profiled, stage, install_http_hooks
+# Local netbox_client.py
+from netbox_client import get_netbox_api
+# Local registry.py
+from registry import register, register_module, get_registered, LazyObject
+# Local journal.py
+from journal import record_stage
+# Local netbox_snapshot.py
+from netbox_snapshot import SnapshotFile, SnapshotRecord, write_snapshot
 
 
+# config.yml is parsed here only, the other modules take YAML_PARAMS from this one
 if os.path.exists('./config.yml'):
 	with open('./config.yml') as f:
-		YAML_PARAMS = yaml.safe_load(f)
+		YAML_PARAMS = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
 		f.close()
 else:
 	print('config.yml not found!')
@@ -22,16 +41,174 @@ else:
 
 NETBOX_URL = YAML_PARAMS['netbox']['url']
 NETBOX_TOKEN = YAML_PARAMS['netbox']['token']
-NETBOX_API = pynetbox.api(NETBOX_URL, token=NETBOX_TOKEN)
+# Single netbox client for all modules, built on first use, see build_netbox_api()
+NETBOX_API = LazyObject('netbox')
+# Max objects per page and max values per multi-value filter in bulk queries
+NETBOX_PAGE_SIZE = YAML_PARAMS['netbox'].get('page_size', 1000)
+NETBOX_FILTER_CHUNK = YAML_PARAMS['netbox'].get('filter_chunk', 100)
+NETBOX_WRITE_CHUNK = YAML_PARAMS['netbox'].get('write_chunk', 100)
+# Answers of netbox releases without bulk writes on list endpoints: 405, or 404 for the list URL itself
+NETBOX_BULK_UNSUPPORTED = (404, 405)
+# Changelog types of deleted objects incremental runs look for -> field of their device/site id
+NETBOX_DELETE_PARENTS = {'dcim.interface': 'device', 'ipam.vlan': 'site'}
+# Prefetch pages/chunks concurrently, at most max_in_flight requests at a time
+NETBOX_ASYNC_FETCH = YAML_PARAMS['netbox'].get('async_fetch', True)
+NETBOX_MAX_IN_FLIGHT = YAML_PARAMS['netbox'].get('max_in_flight', 8)
+# Netbox data read from a snapshot file instead of the API (--snapshot), see set_netbox_snapshot()
+NETBOX_SNAPSHOT = None
+# Fields of devices/vlans kept in snapshot files, nested objects are cut down to their identifying fields
+SNAPSHOT_DEVICE_FIELDS = ('id', 'name', 'site', 'device_role', 'device_type', 'platform', 'primary_ip4', 'status')
+SNAPSHOT_VLAN_FIELDS = ('id', 'vid', 'name', 'tags', 'site', 'group', 'role', 'status')
+SNAPSHOT_NESTED_FIELDS = ('id', 'name', 'slug', 'model', 'address', 'value', 'label')
+# Pending netbox mutations per endpoint, see flush_netbox_writes()
+NETBOX_WRITE_QUEUE = {'update': dict(), 'delete': dict()}
+NETBOX_WRITE_LOCK = threading.Lock()
+PLAN_VERSION = 1
+# Diff rendered configs against running configs locally and push only the delta
+LOCAL_DIFF = (YAML_PARAMS.get('diff') or dict()).get('local', False)
+# Running configs fetched during the run, see get_running_config()
+RUNNING_CONFIGS = dict()
+RUNNING_CONFIGS_LOCK = threading.Lock()
+# Compressed versioned running configs, lookups within 'ttl' seconds are served from it
+ARCHIVE_DIR = (YAML_PARAMS.get('archive') or dict()).get('dir', './out/archive')
+ARCHIVE_TTL = (YAML_PARAMS.get('archive') or dict()).get('ttl', 0)
+ARCHIVE_KEEP = (YAML_PARAMS.get('archive') or dict()).get('keep', 0)
+# Per-run device stage journals, see journal.py
+JOURNAL_DIR = (YAML_PARAMS.get('journal') or dict()).get('dir', './out/journal')
+# Open NAPALM sessions per (device, napalm profile), see napalm_session()
+NAPALM_SESSIONS = dict()
+NAPALM_SESSIONS_COND = threading.Condition()
+NAPALM_MAX_SESSIONS = (YAML_PARAMS.get('napalm_pool') or dict()).get('max_sessions', 0)
+# Compiled jinja2 environments, see get_j2_template()
+J2_ENVS = dict()
+J2_ENVS_LOCK = threading.Lock()
+J2_CACHE_DIR = (YAML_PARAMS.get('jinja') or dict()).get('cache_dir', './out/.j2cache')
+# Rendered/pushed config hashes per device and template, see load_cfg()
+PUSH_STATE = None
+PUSH_STATE_LOCK = threading.RLock()
+PUSH_STATE_FILE = (YAML_PARAMS.get('state') or dict()).get('push_state_file', './out/.push_state.json')
+# Push even if the rendered config was already pushed successfully
+FORCE_PUSH = False
+# Concurrent netbox users the connection pool is sized for when the client is built, see build_netbox_api()
+NETBOX_WORKERS = (YAML_PARAMS.get('fleet') or dict()).get('workers', 1)
+# circuit id -> provider/type/commit rate/cid, see get_circuit_index()
+CIRCUIT_INDEX = None
+CIRCUIT_INDEX_LOCK = threading.RLock()
+CIRCUIT_INDEX_FILE = (YAML_PARAMS.get('state') or dict()).get('circuit_index_file', './out/.circuits.json')
+CIRCUIT_INDEX_TTL = (YAML_PARAMS.get('state') or dict()).get('circuit_index_ttl', 0)
+# Per-site high-water marks of netbox 'last_updated' for incremental runs, see get_site_changes()
+WATERMARK_FILE = (YAML_PARAMS.get('state') or dict()).get('watermark_file', './out/.watermarks.json')
+# Per-site VLAN plans are kept in the snapshot, see get_site_vlan_plan()
+SITE_VLAN_PLANS_LOCK = threading.RLock()
+# Per-site interface -> peer/circuit maps are kept in the snapshot, see get_site_topology()
+SITE_TOPOLOGY_LOCK = threading.RLock()
+
+
+# clogin (telnet devices) processes: concurrency cap, per-device timeout and logs, see run_clogin()
+CLOGIN_PARAMS = YAML_PARAMS.get('clogin') or dict()
+CLOGIN_SLOTS = threading.BoundedSemaphore(CLOGIN_PARAMS.get('max_parallel', 4))
+CLOGIN_TIMEOUT = CLOGIN_PARAMS.get('timeout', 300)
+CLOGIN_LOG_DIR = CLOGIN_PARAMS.get('log_dir', './out/logs')
+# IOS 'show running-config' header, not part of the config
+CLOGIN_CONFIG_PREAMBLE_RE = re.compile(r'^(?:Building configuration\.\.\.|Current configuration ?: \d+ bytes)\s*$')
+CLOGIN_ERROR_RE = re.compile(r'^(?:Error: .*|% (?:Invalid input|Incomplete command|Ambiguous command|Unknown command|'
+	r'Authorization failed|Bad passwords|Login invalid).*)$', re.M)
+
+
+def build_netbox_api():
+	# Connection pool is sized for the workers of this run, set_netbox_workers() must come before the first use
+	api = get_netbox_api(YAML_PARAMS['netbox'], workers=NETBOX_WORKERS)
+	install_http_hooks(api.http_session)
+	return api
+
+
+# Loaded on first use only: a read-only query never pays for NAPALM drivers, jinja2 or ciscoconfparse
+register('netbox', build_netbox_api)
+register_module('napalm')
+register_module('jinja2')
+# Local cfg_parser.py
+register_module('cfg_parser')
+
+
+# Serializes prompts and multi-line output of concurrent workers
+CONSOLE_LOCK = threading.RLock()
+# Answer 'yes' to every prompt (unattended runs)
+ASSUME_YES = False
+
+
+def set_assume_yes(flag=False):
+	global ASSUME_YES
+	ASSUME_YES = bool(flag)
+
+
+def set_force_push(flag=False):
+	global FORCE_PUSH
+	FORCE_PUSH = bool(flag)
+
+
+def set_netbox_workers(workers=1):
+	global NETBOX_WORKERS
+	NETBOX_WORKERS = workers
+
+
+def get_push_state_key(device=None, j2_tpl=None):
+	return '{0}|{1}'.format(str(device).lower(), os.path.basename(j2_tpl or ''))
+
+
+def load_push_state():
+	global PUSH_STATE
+	with PUSH_STATE_LOCK:
+		if PUSH_STATE is None:
+			PUSH_STATE = dict()
+			if PUSH_STATE_FILE and os.path.exists(PUSH_STATE_FILE):
+				try:
+					with open(PUSH_STATE_FILE) as file:
+						PUSH_STATE = json.load(file)
+				except ValueError:
+					print('{0} is corrupted, starting with an empty push state'.format(PUSH_STATE_FILE))
+		return PUSH_STATE
+
+
+def get_push_state(key=None):
+	return dict(load_push_state().get(key) or dict())
+
+
+def save_push_state():
+	with PUSH_STATE_LOCK:
+		if PUSH_STATE_FILE and (PUSH_STATE is not None):
+			# Write to a temp file first so an interrupted run can't leave a truncated state
+			tmp_file = PUSH_STATE_FILE + '.tmp'
+			with open(tmp_file, 'w') as file:
+				json.dump(PUSH_STATE, file, indent=1, sort_keys=True)
+			os.replace(tmp_file, PUSH_STATE_FILE)
+
+
+# Rendered hashes are only kept in memory while running, flush them on exit
+atexit.register(save_push_state)
+
+
+def set_push_state(key=None, persist=True, **hashes):
+	state = load_push_state()
+	with PUSH_STATE_LOCK:
+		entry = state.setdefault(key, dict())
+		for name, value in hashes.items():
+			entry[name] = value
+			entry[name + '_at'] = datetime.now(timezone.utc).isoformat()
+		if persist:
+			save_push_state()
 
 
 def yes_or_no(question):
-    while "the answer is invalid!":
-        reply = str(input(question+' (y/n): ')).lower().strip()
-        if reply[:1].lower() == 'y':
+    with CONSOLE_LOCK:
+        if ASSUME_YES:
+            print(question+' (y/n): y')
             return True
-        if reply[:1].lower() == 'n':
-            return False
+        while "the answer is invalid!":
+            reply = str(input(question+' (y/n): ')).lower().strip()
+            if reply[:1].lower() == 'y':
+                return True
+            if reply[:1].lower() == 'n':
+                return False
 
 
 def format_rate(rate=None):
@@ -52,12 +229,31 @@ def format_rate(rate=None):
 		sys.exit(1)
 
 
+def get_j2_template(tpl_file, trim_blocks_flag=True, lstrip_blocks_flag=False):
+	# One compiled environment per template dir/options for the whole process:
+	# templates are compiled once, auto_reload recompiles a template when its file
+	# changes and the bytecode cache keeps compiled code between runs.
+	tpl_dir = os.path.abspath(os.path.dirname(tpl_file))
+	key = (tpl_dir, trim_blocks_flag, lstrip_blocks_flag)
+	with J2_ENVS_LOCK:
+		env = J2_ENVS.get(key)
+		if env is None:
+			jinja2 = get_registered('jinja2')
+			if J2_CACHE_DIR:
+				os.makedirs(J2_CACHE_DIR, exist_ok=True)
+				bytecode_cache = jinja2.FileSystemBytecodeCache(J2_CACHE_DIR)
+			else:
+				bytecode_cache = None
+			env = jinja2.Environment(loader=jinja2.FileSystemLoader(tpl_dir), trim_blocks=trim_blocks_flag,
+				lstrip_blocks=lstrip_blocks_flag, auto_reload=True, bytecode_cache=bytecode_cache)
+			J2_ENVS[key] = env
+	return env.get_template(os.path.basename(tpl_file))
+
+
+@profiled('render')
 def generate_cfg_from_template(tpl_file, data_dict, trim_blocks_flag=True, lstrip_blocks_flag=False):
 	try:
-		tpl_dir = os.path.dirname(tpl_file)
-		env = Environment(loader=FileSystemLoader(tpl_dir), trim_blocks=trim_blocks_flag,
-			lstrip_blocks=lstrip_blocks_flag)
-		template = env.get_template(os.path.basename(tpl_file))
+		template = get_j2_template(tpl_file, trim_blocks_flag, lstrip_blocks_flag)
 		return template.render(data_dict)
 
 	except Exception as e:
@@ -67,6 +263,65 @@ def generate_cfg_from_template(tpl_file, data_dict, trim_blocks_flag=True, lstri
 		sys.exit(1)
 
 
+def render_cfg_to_file(tpl_file=None, config_dict=None, out_file=None, trim_blocks_flag=True, lstrip_blocks_flag=False):
+	# Render-only: template output goes to out_file chunk by chunk and is hashed on the way (same hash
+	# as get_text_hash() of the rendered text), the whole config is never built as one string.
+	# Runs in render pool processes as well.
+	try:
+		if not out_file:
+			raise Exception('No output file specified!')
+
+		template = get_j2_template(tpl_file, trim_blocks_flag, lstrip_blocks_flag)
+		digest = hashlib.sha256()
+		size = 0
+		os.makedirs(os.path.dirname(out_file) or '.', exist_ok=True)
+		with open(out_file, 'wb') as file:
+			for chunk in template.generate(config_dict):
+				data = chunk.encode('utf-8')
+				digest.update(data)
+				size += len(data)
+				file.write(data)
+		return digest.hexdigest(), size
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_clogin_errors(output=None):
+	# clogin reports login/connection problems as 'Error: ...', IOS rejects lines with '% ...'
+	return [match.group(0).strip() for match in CLOGIN_ERROR_RE.finditer(output or '')]
+
+
+def run_clogin(clogin_device=None, clogin_device_ip=None, args=None, timeout=None):
+	# One expect process per device, at most clogin.max_parallel at a time. Output goes to a
+	# per-device log as it comes, the process is killed after 'timeout' seconds.
+	timeout = timeout or CLOGIN_TIMEOUT
+	log_file = os.path.join(CLOGIN_LOG_DIR, '{0}.log'.format(clogin_device.lower()))
+	os.makedirs(CLOGIN_LOG_DIR, exist_ok=True)
+	with CLOGIN_SLOTS:
+		with open(log_file, 'w') as log:
+			process = subprocess.Popen(['./clogin', '-f', './.cloginrc'] + list(args) + [clogin_device_ip],
+				stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+			try:
+				returncode = process.wait(timeout=timeout)
+			except subprocess.TimeoutExpired:
+				process.kill()
+				process.wait()
+				returncode = None
+	with open(log_file, errors='replace') as log:
+		output = log.read()
+	errors = get_clogin_errors(output)
+	if returncode is None:
+		errors.insert(0, 'timed out after {0}s'.format(timeout))
+	elif returncode != 0:
+		errors.insert(0, 'clogin exited with code {0}'.format(returncode))
+	return output, errors
+
+
+@profiled('clogin_push', 'clogin_device')
 def load_cfg_with_clogin(clogin_device, clogin_device_ip):
 	try:
 		if not clogin_device:
@@ -81,8 +336,15 @@ def load_cfg_with_clogin(clogin_device, clogin_device_ip):
 			with open(clogin_device_cfg, 'w') as modified:
 				modified.write('conf t\n' + '!\n' + data + 'end\n'+ 'wr\n')
 
-		sp = subprocess.check_output("./clogin -f ./.cloginrc -x {0} {1}".format(
-			clogin_device_cfg, clogin_device_ip), shell=True)
+		output, errors = run_clogin(clogin_device, clogin_device_ip, ['-x', clogin_device_cfg])
+		if errors:
+			with CONSOLE_LOCK:
+				print('clogin ({0}) failed, see {1}:'.format(clogin_device,
+					os.path.join(CLOGIN_LOG_DIR, '{0}.log'.format(clogin_device.lower()))))
+				for error in errors:
+					print(' - {0}'.format(error))
+			return False
+		return True
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -91,45 +353,278 @@ def load_cfg_with_clogin(clogin_device, clogin_device_ip):
 		sys.exit(1)
 
 
-def load_cfg_with_napalm(napalm_device, napalm_device_ip):
+def get_napalm_params(napalm_device=None):
+	check_device = YAML_PARAMS['napalm'].get(napalm_device, None)
+
+	if check_device:
+		key = check_device
+	else:
+		key = 'default'
+
+	return {
+		'profile': key,
+		'driver': YAML_PARAMS['napalm'][key]['driver'],
+		'username': YAML_PARAMS['napalm'][key]['username'],
+		'password': YAML_PARAMS['napalm'][key]['password'],
+		'timeout': YAML_PARAMS['napalm'][key]['timeout'],
+	}
+
+
+def open_napalm_driver(napalm_device_ip=None, napalm_params=None):
+	driver = get_registered('napalm').get_network_driver(napalm_params['driver'])
+	device = driver(napalm_device_ip, napalm_params['username'], napalm_params['password'],
+		timeout=napalm_params['timeout'])
+	device.open()
+	return device
+
+
+def close_napalm_driver(device=None):
+	try:
+		device.close()
+	except Exception:
+		pass
+
+
+def acquire_napalm_session(napalm_device=None, napalm_device_ip=None):
+	napalm_params = get_napalm_params(napalm_device)
+	key = (napalm_device.lower(), napalm_params['profile'])
+
+	with NAPALM_SESSIONS_COND:
+		while True:
+			entry = NAPALM_SESSIONS.get(key)
+			if entry is not None:
+				if not entry['in_use']:
+					entry['in_use'] = True
+					break
+				# Same device is busy in another worker
+				NAPALM_SESSIONS_COND.wait()
+				continue
+			if (not NAPALM_MAX_SESSIONS) or (len(NAPALM_SESSIONS) < NAPALM_MAX_SESSIONS):
+				# Reserve the slot, the device is opened outside of the lock
+				entry = {'device': None, 'in_use': True, 'last_used': time.time()}
+				NAPALM_SESSIONS[key] = entry
+				break
+			idle = [(e['last_used'], k) for k, e in NAPALM_SESSIONS.items() if not e['in_use']]
+			if idle:
+				# Cap reached, close the least recently used idle session
+				idle_key = min(idle)[1]
+				close_napalm_driver(NAPALM_SESSIONS.pop(idle_key)['device'])
+				continue
+			NAPALM_SESSIONS_COND.wait()
+
+	try:
+		if entry['device'] is not None:
+			# Reused session, make sure it's still usable
+			try:
+				alive = entry['device'].is_alive().get('is_alive')
+			except Exception:
+				alive = False
+			if not alive:
+				close_napalm_driver(entry['device'])
+				entry['device'] = None
+		if entry['device'] is None:
+			with stage('napalm_connect', device=napalm_device):
+				entry['device'] = open_napalm_driver(napalm_device_ip, napalm_params)
+		return key, entry['device']
+	except BaseException:
+		with NAPALM_SESSIONS_COND:
+			NAPALM_SESSIONS.pop(key, None)
+			NAPALM_SESSIONS_COND.notify_all()
+		raise
+
+
+def release_napalm_session(key=None, drop=False):
+	with NAPALM_SESSIONS_COND:
+		entry = NAPALM_SESSIONS.get(key)
+		if entry is not None:
+			if drop:
+				close_napalm_driver(NAPALM_SESSIONS.pop(key)['device'])
+			else:
+				entry['in_use'] = False
+				entry['last_used'] = time.time()
+		NAPALM_SESSIONS_COND.notify_all()
+
+
+@contextmanager
+def napalm_session(napalm_device=None, napalm_device_ip=None):
+	# Open NAPALM connections are reused within a run, keyed by device and credential profile
+	key, device = acquire_napalm_session(napalm_device, napalm_device_ip)
+	try:
+		yield device
+	except BaseException:
+		# Don't hand a session in unknown state to the next user
+		release_napalm_session(key, drop=True)
+		raise
+	else:
+		release_napalm_session(key)
+
+
+def close_napalm_sessions():
+	with NAPALM_SESSIONS_COND:
+		for key in list(NAPALM_SESSIONS):
+			entry = NAPALM_SESSIONS.pop(key)
+			if entry['device'] is not None:
+				close_napalm_driver(entry['device'])
+		NAPALM_SESSIONS_COND.notify_all()
+
+
+atexit.register(close_napalm_sessions)
+
+
+def set_local_diff(flag=False):
+	global LOCAL_DIFF
+	LOCAL_DIFF = bool(flag)
+
+
+def parse_clogin_running_config(output=None):
+	# clogin echoes login banner and prompts, keep what's between the command and 'end'
+	lines = output.splitlines()
+	start = None
+	for n, line in enumerate(lines):
+		if line.rstrip().endswith('show running-config'):
+			start = n + 1
+	if start is None:
+		raise Exception('No running config in clogin output!')
+	config = list()
+	for line in lines[start:]:
+		# Header lines and the blank lines around them
+		if not config and (not line.strip() or CLOGIN_CONFIG_PREAMBLE_RE.match(line.strip())):
+			continue
+		config.append(line)
+		if line.rstrip() == 'end':
+			break
+	else:
+		raise Exception('Truncated running config in clogin output!')
+	return '\n'.join(config) + '\n'
+
+
+@profiled('clogin_get_config', 'clogin_device')
+def get_running_config_with_clogin(clogin_device=None, clogin_device_ip=None):
+	output, errors = run_clogin(clogin_device, clogin_device_ip, ['-c', 'terminal length 0;show running-config'])
+	if errors:
+		raise Exception('clogin ({0}) failed: {1}'.format(clogin_device, '; '.join(errors)))
+	return parse_clogin_running_config(output)
+
+
+def fetch_running_config(device=None, device_ip=None):
+	if device.lower() in YAML_PARAMS['telnet']:
+		return get_running_config_with_clogin(device, device_ip)
+	with napalm_session(device, device_ip) as napalm_device, stage('napalm_get_config', device=device):
+		return napalm_device.get_config(retrieve='running')['running']
+
+
+def get_running_config(device=None, device_ip=None, refresh=False):
+	# Running config is fetched once per device and run and archived, a fresh enough archived
+	# copy saves the fetch, a commit invalidates both
+	with RUNNING_CONFIGS_LOCK:
+		if (not refresh) and (device.lower() in RUNNING_CONFIGS):
+			return RUNNING_CONFIGS[device.lower()]
+	running_config = None if refresh else get_fresh_config(ARCHIVE_DIR, device, ARCHIVE_TTL)
+	if running_config is None:
+		running_config = fetch_running_config(device, device_ip)
+		if ARCHIVE_DIR:
+			save_config(ARCHIVE_DIR, device, running_config, keep=ARCHIVE_KEEP)
+	with RUNNING_CONFIGS_LOCK:
+		RUNNING_CONFIGS[device.lower()] = running_config
+	return running_config
+
+
+def archive_running_config(device=None, device_ip=None, force=False):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+		elif not device_ip:
+			raise Exception('No device ip specified!')
+
+		# None - archived copy is still fresh, nothing fetched
+		if (not force) and (get_fresh_config(ARCHIVE_DIR, device, ARCHIVE_TTL) is not None):
+			print('[skip] {0}: archived running config is fresh'.format(device))
+			return None
+		get_running_config(device, device_ip, refresh=True)
+		print('[ok] {0}: running config archived'.format(device))
+		return True
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def forget_running_config(device=None):
+	with RUNNING_CONFIGS_LOCK:
+		RUNNING_CONFIGS.pop(str(device).lower(), None)
+	mark_stale(ARCHIVE_DIR, device)
+
+
+@profiled('local_diff', 'device')
+def get_local_delta(device=None, device_ip=None, generated_config=None):
+	# None - no running config to compare with (push everything), '' - nothing to change
+	running_config = get_running_config(device, device_ip)
+	if running_config is None:
+		return None
+	return get_registered('cfg_parser').get_cfg_delta(running_config, generated_config)
+
+
+def diff_cfg_with_napalm(napalm_device, napalm_device_ip):
 	try:
 		if not napalm_device:
 			raise Exception('No device specified!')
 		elif not napalm_device_ip:
 			raise Exception('No device ip specified!')
 
-		check_device = YAML_PARAMS['napalm'].get(napalm_device, None)
+		with napalm_session(napalm_device, napalm_device_ip) as device, stage('napalm_compare', device=napalm_device):
+			device.load_merge_candidate(filename='./out/{0}.cfg'.format(napalm_device.lower()))
+			diffs = device.compare_config()
+			device.discard_config()
+		return diffs
 
-		if check_device:
-			key = check_device
-		else:
-			key = 'default'
-
-		napalm_driver = YAML_PARAMS['napalm'][key]['driver']
-		napalm_username = YAML_PARAMS['napalm'][key]['username']
-		napalm_password = YAML_PARAMS['napalm'][key]['password']
-		napalm_timeout = YAML_PARAMS['napalm'][key]['timeout']
-
-		driver = get_network_driver(napalm_driver)
-		device = driver(napalm_device_ip, napalm_username, napalm_password, timeout=napalm_timeout)
-		device.open()
-		device.load_merge_candidate(filename='./out/{0}.cfg'.format(napalm_device.lower()))
-		diffs = device.compare_config()
-
-		print('Diff by NAPALM:')
-		print('*****')
-		if diffs:
-			print(diffs)
-			print('*****')
-		else:
-			print('Empty!')
-			print('*****')
-			return True
-		if yes_or_no('ARE YOU STILL SURE?'):
-			 device.commit_config()
-			 return True
-		else:
-			return False
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def load_cfg_with_napalm(napalm_device, napalm_device_ip, expected_diff=None):
+	try:
+		if not napalm_device:
+			raise Exception('No device specified!')
+		elif not napalm_device_ip:
+			raise Exception('No device ip specified!')
+
+		with napalm_session(napalm_device, napalm_device_ip) as device:
+			with stage('napalm_compare', device=napalm_device):
+				device.load_merge_candidate(filename='./out/{0}.cfg'.format(napalm_device.lower()))
+				diffs = device.compare_config()
+
+			# Diff computed at plan time must still be the one the device reports now
+			if (expected_diff is not None) and (diffs != expected_diff):
+				device.discard_config()
+				print('{0}: diff differs from the planned one, device changed since the plan was made!'.format(
+					napalm_device))
+				return False
+
+			with CONSOLE_LOCK:
+				print('Diff by NAPALM ({0}):'.format(napalm_device))
+				print('*****')
+				if diffs:
+					print(diffs)
+					print('*****')
+				else:
+					print('Empty!')
+					print('*****')
+					device.discard_config()
+					return True
+				commit = yes_or_no('ARE YOU STILL SURE?')
+			if commit:
+				with stage('napalm_commit', device=napalm_device):
+					device.commit_config()
+				forget_running_config(napalm_device)
+				return True
+			else:
+				device.discard_config()
+				return False
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -138,42 +633,98 @@ def load_cfg_with_napalm(napalm_device, napalm_device_ip):
 		sys.exit(1)
 
 
-def load_cfg(dst_device, dst_device_ip, src_config_dict, j2_tpl):
+def get_config_to_push(dst_device=None, dst_device_ip=None, j2_tpl=None, generated_config=None, force=None,
+	config_hash=None):
+	# Rendered config -> (what has to be sent to the device, True if it's a delta), None if the device can be skipped
+	if force is None:
+		force = FORCE_PUSH
+	if config_hash is None:
+		config_hash = get_text_hash(generated_config)
+
+	# Skip the device without connecting to it if exactly this config was pushed last time
+	state_key = get_push_state_key(dst_device, j2_tpl)
+	set_push_state(state_key, persist=False, rendered=config_hash)
+	if (not force) and (get_push_state(state_key).get('pushed') == config_hash):
+		print('[skip] {0}: rendered config unchanged since the last successful push'.format(dst_device))
+		return None, False
+
+	# Only the lines the device doesn't have yet are pushed
+	if LOCAL_DIFF:
+		delta = get_local_delta(dst_device, dst_device_ip, generated_config)
+		if delta == '':
+			set_push_state(state_key, pushed=config_hash)
+			print('[skip] {0}: running config already matches the rendered one'.format(dst_device))
+			return None, False
+		elif delta is not None:
+			return delta, True
+
+	return generated_config, False
+
+
+def load_cfg(dst_device, dst_device_ip, src_config_dict, j2_tpl, generated_config=None, expected_diff=None, force=None):
 	try:
 		if not dst_device:
 			raise Exception('No device specified!')
-		elif not dst_device:
+		elif not dst_device_ip:
 			raise Exception('No device ip specified!')
-		elif not src_config_dict:
+		elif not src_config_dict and not generated_config:
 			raise Exception('No config dict provided!')
-		elif not j2_tpl:
+		elif not j2_tpl and not generated_config:
 			raise Exception('No j2 tpl provided!')
 		
-		generated_config = generate_cfg_from_template(j2_tpl, src_config_dict)
-		print('{0} is going to be burned by the following lines:'.format(dst_device))
-		print('*****')
-		print(generated_config)
-		print('*****')
-		if yes_or_no('ARE YOU SURE?'):
+		if generated_config is None:
+			generated_config = generate_cfg_from_template(j2_tpl, src_config_dict)
+		state_key = get_push_state_key(dst_device, j2_tpl)
+		config_hash = get_text_hash(generated_config)
+		record_stage(dst_device, 'rendered', hash=config_hash)
+		generated_config, is_delta = get_config_to_push(dst_device, dst_device_ip, j2_tpl, generated_config, force,
+			config_hash)
+		if generated_config is None:
+			record_stage(dst_device, 'unchanged')
+			return None
+		elif is_delta:
+			record_stage(dst_device, 'diffed', lines=len(generated_config.splitlines()))
+
+		with CONSOLE_LOCK:
+			print('{0} is going to be burned by the following lines:'.format(dst_device))
+			print('*****')
+			print(generated_config)
+			print('*****')
+			confirm = yes_or_no('ARE YOU SURE?')
+		if confirm:
 			with open('./out/{0}.cfg'.format(dst_device.lower()), 'w') as file:
 				file.write(generated_config)
 			print('Connecting to {0}...'.format(dst_device))
 			if dst_device.lower() not in YAML_PARAMS['telnet']:
-				load = load_cfg_with_napalm(napalm_device=dst_device, napalm_device_ip=dst_device_ip)
+				load = load_cfg_with_napalm(napalm_device=dst_device, napalm_device_ip=dst_device_ip,
+					expected_diff=expected_diff)
 				if load:
+					set_push_state(state_key, pushed=config_hash)
+					record_stage(dst_device, 'committed', hash=config_hash)
 					print('[ok] Configuration loaded successfully!')
 					return True
 				else:
+					record_stage(dst_device, 'failed', error='not loaded')
 					print('[nok] Configuration not loaded successfully!')
 					return False
 			else:
-				# no True/False is returned by function using clogin
 				load = load_cfg_with_clogin(clogin_device=dst_device, clogin_device_ip=dst_device_ip)
-				print('[ok] Configuration loaded successfully!')
-				return True
+				# Even a failed session may have applied some lines
+				forget_running_config(dst_device)
+				if load:
+					set_push_state(state_key, pushed=config_hash)
+					record_stage(dst_device, 'committed', hash=config_hash)
+					print('[ok] Configuration loaded successfully!')
+					return True
+				else:
+					record_stage(dst_device, 'failed', error='not loaded')
+					print('[nok] Configuration not loaded successfully!')
+					return False
 		else:
+			# Not pushed: 'nok' for the fleet (no vlan write-back), done for the journal
+			record_stage(dst_device, 'declined')
 			print('Operation canceled!')
-			return True
+			return False
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -182,25 +733,82 @@ def load_cfg(dst_device, dst_device_ip, src_config_dict, j2_tpl):
 		sys.exit(1)
 
 
+class IntfRecord(object):
+	# Interface as the builders need it, flattened from the netbox JSON when the snapshot is pulled:
+	# choices as their values, nested objects as ids, VLANs as packed vid arrays. No pynetbox record
+	# is kept per interface.
+
+	__slots__ = ('id', 'device_id', 'name', 'description', 'tags', 'mtu', 'mode', 'is_lag', 'untagged_vid',
+		'tagged_vids', 'connected', 'circuit_id')
+
+	def __init__(self, values=None):
+		self.id = values['id']
+		self.device_id = values['device']['id']
+		self.name = values['name']
+		self.description = values.get('description') or ''
+		self.tags = tuple(sys.intern(str(tag)) for tag in values.get('tags') or ())
+		self.mtu = values.get('mtu')
+		self.mode = (values.get('mode') or dict()).get('value')
+		self.is_lag = 'LAG' in str((values.get('form_factor') or dict()).get('label') or '')
+		self.untagged_vid = (values.get('untagged_vlan') or dict()).get('vid')
+		self.tagged_vids = array('H', [vlan['vid'] for vlan in values.get('tagged_vlans') or ()])
+		self.connected = bool(values.get('interface_connection'))
+		self.circuit_id = ((values.get('circuit_termination') or dict()).get('circuit') or dict()).get('id')
+
+	def __repr__(self):
+		return '<IntfRecord {0} {1}>'.format(self.id, self.name)
+
+
+def get_intf_values(interface=None):
+	# IntfRecord -> the part of the netbox JSON it reads, IntfRecord(get_intf_values(r)) gives r back
+	return {
+		'id': interface.id,
+		'device': {'id': interface.device_id},
+		'name': interface.name,
+		'description': interface.description,
+		'tags': list(interface.tags),
+		'mtu': interface.mtu,
+		'mode': {'value': interface.mode} if interface.mode is not None else None,
+		'form_factor': {'label': 'LAG'} if interface.is_lag else None,
+		'untagged_vlan': {'vid': interface.untagged_vid} if interface.untagged_vid is not None else None,
+		'tagged_vlans': [{'vid': vid} for vid in interface.tagged_vids],
+		'interface_connection': True if interface.connected else None,
+		'circuit_termination': {'circuit': {'id': interface.circuit_id}} if interface.circuit_id else None,
+	}
+
+
+class IntfIntent(object):
+	# Per-interface input of tpl_intf.j2, the template reads it like the dict it replaces
+
+	__slots__ = ('name', 'desc', 'vlans', 'native_vlan', 'access_vlan', 'isp_l2_flag', 'isp_l3_flag', 'mtu', 'mss',
+		'circuit_isp', 'circuit_svc', 'circuit_rate', 'switch_flag', 'lldp_flag')
+
+	def __init__(self, **fields):
+		for key in self.__slots__:
+			setattr(self, key, fields.get(key, False))
+
+	def __repr__(self):
+		return '<IntfIntent {0}>'.format(self.name)
+
+
 def populate_vlan_list(netbox_interface=None):
 	try:
 		if not netbox_interface:
 			raise Exception("No data provided!")
 
-		vlan_list = list()
+		vlan_list = array('H')
 		native_vlan = False
 
 		# Pickup interface with 802.1Q Mode: Tagged
 		if netbox_interface.mode:
-			if netbox_interface.mode.value == 200:
-				if netbox_interface.untagged_vlan:
+			if netbox_interface.mode == 200:
+				if netbox_interface.untagged_vid:
 					# Add native vlan to the vlan list and set 'native_vlan' in case when native vlan id is not '1'
-					vlan_list.append(netbox_interface.untagged_vlan.vid)
-					if netbox_interface.untagged_vlan.vid != 1:
-						native_vlan = netbox_interface.untagged_vlan.vid
-				
-				for vlan in netbox_interface.tagged_vlans:
-					vlan_list.append(vlan.vid)
+					vlan_list.append(netbox_interface.untagged_vid)
+					if netbox_interface.untagged_vid != 1:
+						native_vlan = netbox_interface.untagged_vid
+
+				vlan_list.extend(netbox_interface.tagged_vids)
 
 		return native_vlan, vlan_list
 
@@ -209,3 +817,921 @@ def populate_vlan_list(netbox_interface=None):
 			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
 		print(msg)
 		sys.exit(1)
+
+
+def chunk_list(items=None, size=100):
+	items = list(items or [])
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+
+def get_circuit_id(intf_tag=None):
+	# 'cid_XXX' tag -> XXX (circuit id in netbox)
+	if intf_tag and 'cid' in intf_tag:
+		return int(re.sub('^cid_', '', intf_tag))
+	return None
+
+
+def load_circuit_index_file():
+	if not (CIRCUIT_INDEX_FILE and CIRCUIT_INDEX_TTL) or not os.path.exists(CIRCUIT_INDEX_FILE):
+		return None
+	try:
+		with open(CIRCUIT_INDEX_FILE) as file:
+			data = json.load(file)
+		if time.time() - data.get('built', 0) > CIRCUIT_INDEX_TTL:
+			return None
+		return {int(circuit_id): circuit for circuit_id, circuit in data['circuits'].items()}
+	except (ValueError, KeyError):
+		return None
+
+
+def get_circuit_row(values=None):
+	# Circuit JSON -> flat entry of the circuit index and of the -c output
+	return {
+		'id': values['id'],
+		'cid': values['cid'],
+		'provider': (values.get('provider') or dict()).get('name'),
+		'provider_slug': (values.get('provider') or dict()).get('slug'),
+		'type': (values.get('type') or dict()).get('name'),
+		'type_slug': (values.get('type') or dict()).get('slug'),
+		'commit_rate': values.get('commit_rate'),
+	}
+
+
+def get_circuit_index(refresh=False):
+	try:
+		global CIRCUIT_INDEX
+
+		with CIRCUIT_INDEX_LOCK:
+			if CIRCUIT_INDEX is not None and not refresh:
+				return CIRCUIT_INDEX
+
+			if NETBOX_SNAPSHOT is not None:
+				# Nothing newer to refresh from
+				if CIRCUIT_INDEX is not None:
+					return CIRCUIT_INDEX
+				index = dict((row['id'], row) for row in NETBOX_SNAPSHOT.get('circuits', 'all', list()))
+			else:
+				index = None if refresh else load_circuit_index_file()
+			if index is None:
+				# circuit id -> provider, type, commit rate and cid, one paginated query for all circuits
+				index = dict()
+				for values in get_netbox_results(NETBOX_API.circuits.circuits):
+					index[values['id']] = get_circuit_row(values)
+				if CIRCUIT_INDEX_FILE and CIRCUIT_INDEX_TTL:
+					tmp_file = CIRCUIT_INDEX_FILE + '.tmp'
+					with open(tmp_file, 'w') as file:
+						json.dump({'built': time.time(), 'circuits': index}, file)
+					os.replace(tmp_file, CIRCUIT_INDEX_FILE)
+
+			# Swapped whole, never changed in place: workers reading the dict a snapshot holds without
+			# the lock keep seeing a complete index, get_snapshot_circuit() picks up the new one
+			CIRCUIT_INDEX = index
+			return CIRCUIT_INDEX
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_circuit_devices(circuit_ids=None):
+	# Devices using a circuit: interfaces tagged 'cid_<id>' and circuit terminations
+	devices = set()
+	# Repeated 'tag' filters are ANDed by netbox, one query per tag
+	for circuit_id in sorted(circuit_ids):
+		for interface in NETBOX_API.dcim.interfaces.filter(tag='cid_{0}'.format(circuit_id), limit=NETBOX_PAGE_SIZE):
+			devices.add(str(interface.device.name))
+	for chunk in chunk_list(sorted(circuit_ids), NETBOX_FILTER_CHUNK):
+		for term in NETBOX_API.circuits.circuit_terminations.filter(circuit_id=chunk, limit=NETBOX_PAGE_SIZE):
+			if getattr(term, 'interface', None):
+				devices.add(str(term.interface.device.name))
+	return devices
+
+
+def get_snapshot_circuit(snapshot=None, circuit_id=None):
+	try:
+		if not snapshot:
+			raise Exception('No snapshot provided!')
+		elif not circuit_id:
+			raise Exception('No circuit id specified!')
+
+		circuit_id = int(circuit_id)
+		if circuit_id not in snapshot['circuits']:
+			# Persisted index may be older than the circuit, rebuild it once
+			snapshot['circuits'] = get_circuit_index(refresh=True)
+		if circuit_id not in snapshot['circuits']:
+			raise Exception('Circuit id {0} not found in the netbox!'.format(circuit_id))
+		return snapshot['circuits'][circuit_id]
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_device_site(snapshot=None, device=None):
+	record = (snapshot or dict()).get('devices', dict()).get(str(device))
+	if record and record.site:
+		return str(record.site.slug)
+	return None
+
+
+def get_snapshot_interface(snapshot=None, device=None, intf_id=None):
+	record = (snapshot or dict()).get('devices', dict()).get(str(device))
+	if record:
+		for interface in snapshot['interfaces'].get(record.id, list()):
+			if interface.id == intf_id:
+				return interface
+	raise Exception('Interface id {0} of {1} not found in the snapshot!'.format(intf_id, device))
+
+
+def get_site_topology(snapshot=None, site_id=None):
+	# Links of a whole site from two bulk queries instead of walking every interface's nested connection:
+	# links - interface id -> peer device/interface, circuits - interface id -> terminated circuit id
+	try:
+		if not snapshot:
+			raise Exception('No snapshot provided!')
+		elif not site_id:
+			raise Exception('No site id specified!')
+
+		with SITE_TOPOLOGY_LOCK:
+			topologies = snapshot.setdefault('topology', dict())
+			if site_id in topologies:
+				return topologies[site_id]
+
+			if NETBOX_SNAPSHOT is not None:
+				topology = NETBOX_SNAPSHOT.get('topology', site_id)
+				if topology is None:
+					raise Exception('Site id {0} not found in the snapshot!'.format(site_id))
+				# JSON keys are strings
+				for key in ('links', 'circuits'):
+					topology[key] = dict((int(intf_id), value) for intf_id, value in topology[key].items())
+				topologies[site_id] = topology
+				return topology
+
+			site_slug = None
+			for record in snapshot['devices_by_id'].values():
+				if record.site.id == site_id:
+					site_slug = str(record.site.slug)
+					break
+			if not site_slug:
+				raise Exception('Site id {0} not found in the snapshot!'.format(site_id))
+
+			topology = {'site_id': site_id, 'links': dict(), 'circuits': dict()}
+			# Connections with either end on the site, both ends are recorded
+			for connection in NETBOX_API.dcim.interface_connections.filter(site=site_slug, limit=NETBOX_PAGE_SIZE):
+				if not (connection.interface_a and connection.interface_b):
+					continue
+				for local, peer in ((connection.interface_a, connection.interface_b),
+					(connection.interface_b, connection.interface_a)):
+					topology['links'][local.id] = {
+						'device': str(peer.device.name),
+						'interface': str(peer.name),
+						'interface_id': peer.id,
+					}
+			for term in NETBOX_API.circuits.circuit_terminations.filter(site_id=site_id, limit=NETBOX_PAGE_SIZE):
+				if term.interface:
+					topology['circuits'][term.interface.id] = term.circuit.id
+			topologies[site_id] = topology
+			return topology
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_site_vlan_plan(snapshot=None, site_id=None, j2_tpl=None):
+	try:
+		if not snapshot:
+			raise Exception('No snapshot provided!')
+
+		# VLANs of a site indexed by tag, built and rendered once and shared by all switches of the site
+		with SITE_VLAN_PLANS_LOCK:
+			plans = snapshot.setdefault('vlan_plans', dict())
+			plan = plans.get(site_id)
+			if plan is None:
+				by_tag = {'vlan_add': list(), 'vlan_del': list(), 'vlan_ok': list()}
+				for vlan in snapshot['vlans'].get(site_id, list()):
+					if vlan.tags and vlan.tags[0] in by_tag:
+						# 'id' - ID in netbox, 'vid' - VLAN ID
+						by_tag[vlan.tags[0]].append({
+							'id': vlan.id,
+							'vid': vlan.vid,
+							'name': vlan.name
+							})
+				config_dict = None
+				if by_tag['vlan_add'] or by_tag['vlan_del']:
+					config_dict = {
+						'vlans_add': by_tag['vlan_add'] or None,
+						'vlans_del': by_tag['vlan_del'] or None,
+					}
+				plan = {
+					'site_id': site_id,
+					'by_tag': by_tag,
+					'config_dict': config_dict,
+					'configs': dict(),
+					'written_back': False,
+				}
+				plans[site_id] = plan
+			if j2_tpl and plan['config_dict'] and (j2_tpl not in plan['configs']):
+				plan['configs'][j2_tpl] = generate_cfg_from_template(j2_tpl, plan['config_dict'])
+		return plan
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_site_vlan_lists(snapshot=None, site_id=None):
+	plan = get_site_vlan_plan(snapshot, site_id)
+	return plan['by_tag']['vlan_add'], plan['by_tag']['vlan_del']
+
+
+def load_watermarks():
+	if not (WATERMARK_FILE and os.path.exists(WATERMARK_FILE)):
+		return dict()
+	try:
+		with open(WATERMARK_FILE) as file:
+			return json.load(file)
+	except ValueError:
+		print('{0} is corrupted, next run is a full one'.format(WATERMARK_FILE))
+		return dict()
+
+
+def save_watermarks(kind=None, marks=None):
+	# marks: site slug -> mark, merged into the saved ones of the same kind ('intf'/'vlan')
+	watermarks = load_watermarks()
+	watermarks.setdefault(kind, dict()).update(marks)
+	tmp_file = WATERMARK_FILE + '.tmp'
+	with open(tmp_file, 'w') as file:
+		json.dump(watermarks, file, indent=1, sort_keys=True)
+	os.replace(tmp_file, WATERMARK_FILE)
+
+
+def parse_netbox_time(value=None):
+	return datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+
+def get_netbox_time():
+	# Server clock from the 'Date' header, local clock may be off. One second back for
+	# the header's resolution, the marks are compared with '>=' so overlaps are harmless.
+	response = NETBOX_API.http_session.get(NETBOX_API.base_url + '/', headers={'Accept': 'application/json'})
+	server_time = parsedate_to_datetime(response.headers['Date']) - timedelta(seconds=1)
+	return server_time.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_netbox_deletions(since=None):
+	# Interfaces and vlans deleted since 'since': a deleted object has no 'last_updated' left, only the
+	# changelog has it. None if the changelog can't be read (netbox < 2.4, or a token that may not view it).
+	deletions = list()
+	try:
+		for change in get_netbox_results(NETBOX_API.extras.object_changes, action='delete', time_after=since):
+			parent_key = NETBOX_DELETE_PARENTS.get(change.get('changed_object_type'))
+			if parent_key is None:
+				continue
+			# netbox >= 3.0 keeps the deleted object in 'prechange_data'
+			parent = (change.get('prechange_data') or change.get('object_data') or dict()).get(parent_key)
+			deletions.append({'type': change['changed_object_type'], 'id': change.get('changed_object_id'),
+				'time': change['time'], 'parent': parent.get('id') if isinstance(parent, dict) else parent})
+	except Exception as e:
+		print('Netbox changelog can\'t be read: {0}'.format(e))
+		return None
+	return deletions
+
+
+def get_site_changes(sites=None, kind='intf'):
+	try:
+		if not sites:
+			raise Exception('No site(s) specified!')
+
+		# What changed in netbox since the last successful run of 'kind' per site:
+		# site slug -> {'devices': [...], 'vlans_changed': bool, 'full': bool, 'mark': new mark}
+		marks = load_watermarks().get(kind, dict())
+		new_mark = get_netbox_time()
+		snapshot = prefetch_netbox_data(sites=sites, devices_only=True)
+		changes = dict()
+
+		for site in [str(site).lower() for site in sites]:
+			dev_names = snapshot['sites'].get(site, list())
+			mark = marks.get(site)
+			entry = {'devices': set(), 'vlans_changed': False, 'full': mark is None, 'mark': new_mark}
+			changes[site] = entry
+			if mark is None:
+				# First run for the site
+				entry['devices'].update(dev_names)
+				entry['vlans_changed'] = True
+				continue
+			dev_ids = [snapshot['devices'][name].id for name in dev_names]
+			for chunk in chunk_list(dev_ids, NETBOX_FILTER_CHUNK):
+				for interface in NETBOX_API.dcim.interfaces.filter(device_id=chunk, last_updated__gte=mark,
+						limit=NETBOX_PAGE_SIZE):
+					entry['devices'].add(str(interface.device.name))
+			if dev_ids:
+				site_id = snapshot['devices'][dev_names[0]].site.id
+				entry['vlans_changed'] = NETBOX_API.ipam.vlans.count(site_id=site_id, last_updated__gte=mark) > 0
+
+		# Deleted interfaces and vlans come from the changelog, without it they can't be ruled out
+		site_marks = [marks[site] for site in changes if not changes[site]['full']]
+		if site_marks:
+			deletions = get_netbox_deletions(min(site_marks, key=parse_netbox_time))
+			for site, entry in changes.items():
+				if entry['full']:
+					continue
+				dev_names = snapshot['sites'].get(site, list())
+				if deletions is None:
+					entry['full'] = True
+					entry['devices'].update(dev_names)
+					entry['vlans_changed'] = True
+					continue
+				dev_ids = dict((snapshot['devices'][name].id, name) for name in dev_names)
+				site_id = snapshot['devices'][dev_names[0]].site.id if dev_names else None
+				for deletion in deletions:
+					if parse_netbox_time(deletion['time']) < parse_netbox_time(marks[site]):
+						continue
+					elif deletion['type'] == 'dcim.interface' and deletion['parent'] in dev_ids:
+						entry['devices'].add(dev_ids[deletion['parent']])
+					elif deletion['type'] == 'ipam.vlan' and deletion['parent'] == site_id:
+						entry['vlans_changed'] = True
+
+		# Circuits aren't tied to a site, a changed one re-renders the devices using it
+		site_marks = [marks[site] for site in changes if not changes[site]['full']]
+		if site_marks:
+			oldest = min(site_marks, key=parse_netbox_time)
+			circuits = list(NETBOX_API.circuits.circuits.filter(last_updated__gte=oldest, limit=NETBOX_PAGE_SIZE))
+			if circuits:
+				get_circuit_index(refresh=True)
+			for site, entry in changes.items():
+				if entry['full']:
+					continue
+				circuit_ids = [c.id for c in circuits
+					if parse_netbox_time(c.last_updated) >= parse_netbox_time(marks[site])]
+				if circuit_ids:
+					dev_names = set(snapshot['sites'].get(site, list()))
+					entry['devices'].update(dev_names.intersection(get_circuit_devices(circuit_ids)))
+
+		for site, entry in changes.items():
+			entry['devices'] = sorted(entry['devices'])
+			print('{0}: {1}, {2} device(s) changed{3}'.format(site,
+				'full run' if entry['full'] else 'changes since {0}'.format(marks[site]), len(entry['devices']),
+				', vlans changed' if (kind == 'vlan' and entry['vlans_changed']) else ''))
+		return changes, snapshot
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_vlan_writeback_mark(site_id=None, mark=None, written_ids=None, deleted_ids=None):
+	# After a vlan write-back the site's own 'vlan_ok' updates and deletions are newer than the mark and
+	# would make the next run see vlan changes again. The mark moves just past them only when nobody else
+	# changed a vlan of the site in the meantime, otherwise the next run has to start from the old one anyway.
+	latest = parse_netbox_time(mark)
+	for vlan in NETBOX_API.ipam.vlans.filter(site_id=site_id, last_updated__gte=mark, limit=NETBOX_PAGE_SIZE):
+		if vlan.id not in written_ids:
+			return mark
+		latest = max(latest, parse_netbox_time(vlan.last_updated))
+	deletions = get_netbox_deletions(mark)
+	if deletions is None:
+		return mark
+	for deletion in deletions:
+		if deletion['type'] != 'ipam.vlan' or deletion['parent'] != site_id:
+			continue
+		elif deletion['id'] not in (deleted_ids or set()):
+			return mark
+		latest = max(latest, parse_netbox_time(deletion['time']))
+	return (latest + timedelta(microseconds=1)).astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def get_netbox_headers():
+	return {
+		'Authorization': 'Token {0}'.format(NETBOX_TOKEN),
+		'Accept': 'application/json',
+	}
+
+
+async def fetch_netbox_json(semaphore=None, executor=None, url=None, params=None):
+	# requests is blocking, the pooled session runs in executor threads, the semaphore bounds in-flight requests
+	import asyncio
+
+	async with semaphore:
+		loop = asyncio.get_running_loop()
+		response = await loop.run_in_executor(executor, functools.partial(NETBOX_API.http_session.get, url,
+			params=params, headers=get_netbox_headers()))
+	response.raise_for_status()
+	return response.json()
+
+
+async def fetch_netbox_records(semaphore=None, executor=None, endpoint=None, make_record=None, **filters):
+	# First page tells the count, the other pages are pulled concurrently. Every page is turned into
+	# pynetbox records, or whatever make_record() builds from an object's JSON, as soon as it arrives.
+	import asyncio
+
+	if make_record is None:
+		make_record = lambda values: endpoint.return_obj(values, endpoint.api, endpoint)
+	url = endpoint.url + '/'
+	first = await fetch_netbox_json(semaphore, executor, url, dict(filters, limit=NETBOX_PAGE_SIZE, offset=0))
+	# Netbox caps the page size at its MAX_PAGE_SIZE, step by what it really returned
+	step = len(first['results']) or NETBOX_PAGE_SIZE
+	records = [make_record(values) for values in first['results']]
+
+	async def fetch_page(offset):
+		page = await fetch_netbox_json(semaphore, executor, url, dict(filters, limit=step, offset=offset))
+		return [make_record(values) for values in page['results']]
+
+	for page in await asyncio.gather(*[fetch_page(offset) for offset in range(step, first['count'], step)]):
+		records.extend(page)
+	return records
+
+
+def get_netbox_results(endpoint=None, **filters):
+	# Synchronous counterpart: JSON of every object, page by page, without pynetbox records
+	url = endpoint.url + '/'
+	params = dict(filters, limit=NETBOX_PAGE_SIZE)
+	while url:
+		response = NETBOX_API.http_session.get(url, params=params, headers=get_netbox_headers())
+		response.raise_for_status()
+		data = response.json()
+		for values in data['results']:
+			yield values
+		# 'next' carries the filters and the offset
+		url, params = data.get('next'), None
+
+
+async def fetch_netbox_data_async(devices=None, sites=None, devices_only=False):
+	# Same records as the synchronous path in prefetch_netbox_data(), all chunks and pages at once
+	import asyncio
+
+	semaphore = asyncio.Semaphore(NETBOX_MAX_IN_FLIGHT)
+	loop = asyncio.get_running_loop()
+	# A thread per in-flight request and one for the circuit index, the loop's default executor is left alone
+	executor = ThreadPoolExecutor(max_workers=NETBOX_MAX_IN_FLIGHT + 1)
+	try:
+		circuits = None
+		if not devices_only:
+			# The circuit index doesn't depend on the devices, build it meanwhile
+			circuits = loop.run_in_executor(executor, get_circuit_index)
+
+		queries = list()
+		for chunk in chunk_list([str(site).lower() for site in sites or []], NETBOX_FILTER_CHUNK):
+			queries.append(fetch_netbox_records(semaphore, executor, NETBOX_API.dcim.devices, site=chunk))
+		dev_names = [str(device) for device in devices or []]
+		for chunk in chunk_list(dev_names, NETBOX_FILTER_CHUNK):
+			queries.append(fetch_netbox_records(semaphore, executor, NETBOX_API.dcim.devices, name=chunk))
+		dev_records = [record for records in await asyncio.gather(*queries) for record in records]
+		# Older netbox releases ignore repeated 'name' params, pick up the rest one by one
+		found = set(str(record.name) for record in dev_records)
+		missing = [name for name in dev_names if name not in found]
+		for records in await asyncio.gather(*[fetch_netbox_records(semaphore, executor, NETBOX_API.dcim.devices,
+				name=name) for name in missing]):
+			dev_records.extend(records)
+		if devices_only:
+			return dev_records, list(), list()
+
+		dev_ids = sorted(set(record.id for record in dev_records))
+		site_ids = sorted(set(record.site.id for record in dev_records))
+		intf_queries = [fetch_netbox_records(semaphore, executor, NETBOX_API.dcim.interfaces, IntfRecord,
+			device_id=chunk) for chunk in chunk_list(dev_ids, NETBOX_FILTER_CHUNK)]
+		vlan_queries = [fetch_netbox_records(semaphore, executor, NETBOX_API.ipam.vlans, site_id=chunk)
+			for chunk in chunk_list(site_ids, NETBOX_FILTER_CHUNK)]
+		results = await asyncio.gather(*(intf_queries + vlan_queries))
+		intf_records = [record for records in results[:len(intf_queries)] for record in records]
+		vlan_records = [record for records in results[len(intf_queries):] for record in records]
+		await circuits
+		return dev_records, intf_records, vlan_records
+
+	finally:
+		executor.shutdown(wait=False, cancel_futures=True)
+
+
+@profiled('netbox_prefetch')
+def prefetch_netbox_data(devices=None, sites=None, devices_only=False):
+	try:
+		if not devices and not sites:
+			raise Exception('No device(s) or site(s) specified!')
+
+		if NETBOX_SNAPSHOT is not None:
+			return load_snapshot_data(devices, sites, devices_only)
+
+		# In-memory snapshot of everything update_device_cfg(), update_device_vlans()
+		# and update_netbox_db() need, pulled with a few paginated bulk queries
+		# instead of per-device/per-interface round-trips.
+		snapshot = {
+			'sites': dict(),
+			'devices': dict(),
+			'devices_by_id': dict(),
+			'interfaces': dict(),
+			'vlans': dict(),
+			'circuits': dict(),
+		}
+		dev_records = list()
+		intf_records = None
+		vlan_records = None
+
+		if NETBOX_ASYNC_FETCH:
+			# asyncio is imported only when netbox.async_fetch is on
+			import asyncio
+
+			dev_records, intf_records, vlan_records = asyncio.run(fetch_netbox_data_async(devices, sites, devices_only))
+
+		else:
+			if sites:
+				site_slugs = [str(site).lower() for site in sites]
+				for chunk in chunk_list(site_slugs, NETBOX_FILTER_CHUNK):
+					dev_records.extend(NETBOX_API.dcim.devices.filter(site=chunk, limit=NETBOX_PAGE_SIZE))
+
+			if devices:
+				dev_names = [str(device) for device in devices]
+				for chunk in chunk_list(dev_names, NETBOX_FILTER_CHUNK):
+					dev_records.extend(NETBOX_API.dcim.devices.filter(name=chunk, limit=NETBOX_PAGE_SIZE))
+				# Older netbox releases ignore repeated 'name' params, pick up the rest one by one
+				found = set(str(record.name) for record in dev_records)
+				for name in dev_names:
+					if name not in found:
+						record = NETBOX_API.dcim.devices.get(name=name)
+						if record:
+							dev_records.append(record)
+
+		for record in dev_records:
+			if record.id in snapshot['devices_by_id']:
+				continue
+			snapshot['devices'][str(record.name)] = record
+			snapshot['devices_by_id'][record.id] = record
+			snapshot['interfaces'][record.id] = list()
+			snapshot['sites'].setdefault(str(record.site.slug), list()).append(str(record.name))
+
+		# Device records (name, site, primary ip) are all running config collection needs
+		if devices_only:
+			print('Prefetched {0} device(s)\n'.format(len(snapshot['devices'])))
+			return snapshot
+
+		site_ids = sorted(set(record.site.id for record in snapshot['devices_by_id'].values()))
+
+		if intf_records is None:
+			# Interfaces of all devices in chunks of device ids, VLANs of all sites involved
+			intf_records = list()
+			for chunk in chunk_list(snapshot['devices_by_id'].keys(), NETBOX_FILTER_CHUNK):
+				intf_records.extend(IntfRecord(values) for values in get_netbox_results(NETBOX_API.dcim.interfaces,
+					device_id=chunk))
+			vlan_records = list()
+			for chunk in chunk_list(site_ids, NETBOX_FILTER_CHUNK):
+				vlan_records.extend(NETBOX_API.ipam.vlans.filter(site_id=chunk, limit=NETBOX_PAGE_SIZE))
+
+		for interface in intf_records:
+			snapshot['interfaces'].setdefault(interface.device_id, list()).append(interface)
+		for site_id in site_ids:
+			snapshot['vlans'][site_id] = list()
+		for vlan in vlan_records:
+			snapshot['vlans'].setdefault(vlan.site.id, list()).append(vlan)
+
+		# Circuits referenced by 'cid_XXX' tags or by circuit terminations are resolved through the
+		# run-wide circuit index
+		snapshot['circuits'] = get_circuit_index()
+
+		print('Prefetched {0} device(s), {1} interface(s), {2} vlan(s), {3} circuit(s)\n'.format(
+			len(snapshot['devices']), sum(len(i) for i in snapshot['interfaces'].values()),
+			sum(len(v) for v in snapshot['vlans'].values()), len(snapshot['circuits'])))
+		return snapshot
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def set_netbox_snapshot(path=None):
+	global NETBOX_SNAPSHOT
+	try:
+		if not path:
+			raise Exception('No snapshot file specified!')
+
+		# Header and index only, the records are read when a run asks for them
+		NETBOX_SNAPSHOT = SnapshotFile(path)
+		return NETBOX_SNAPSHOT
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_netbox_snapshot():
+	return NETBOX_SNAPSHOT
+
+
+def get_snapshot_values(record=None, fields=None):
+	# pynetbox record -> the fields a snapshot keeps
+	values = dict(record)
+	result = dict()
+	for key in fields:
+		value = values.get(key)
+		if isinstance(value, dict):
+			value = dict((k, v) for k, v in value.items() if k in SNAPSHOT_NESTED_FIELDS)
+		result[key] = value
+	return result
+
+
+def get_site_slugs():
+	if NETBOX_SNAPSHOT is not None:
+		return sorted(NETBOX_SNAPSHOT.keys('sites'))
+	return [values['slug'] for values in get_netbox_results(NETBOX_API.dcim.sites)]
+
+
+def find_site(site=None):
+	# Site slug or name (any case) -> slug, None if netbox doesn't know it
+	if NETBOX_SNAPSHOT is not None:
+		if NETBOX_SNAPSHOT.has('sites', str(site).lower()):
+			return str(site).lower()
+		for slug in NETBOX_SNAPSHOT.keys('sites'):
+			if str(NETBOX_SNAPSHOT.get('sites', slug)['name']).lower() == str(site).lower():
+				return slug
+		return None
+	for name in (site, site.upper(), site.lower()):
+		record = NETBOX_API.dcim.sites.get(name=name)
+		if record:
+			return str(record.slug)
+	return None
+
+
+def get_circuit_rows(types=None, providers=None):
+	# Circuits of the given type/provider slugs, filtered by netbox, or locally for a snapshot
+	if NETBOX_SNAPSHOT is not None:
+		for row in sorted(get_circuit_index().values(), key=lambda row: row['id']):
+			if (not types or row['type_slug'] in types) and (not providers or row['provider_slug'] in providers):
+				yield row
+		return
+	filters = dict()
+	if types:
+		filters['type'] = types
+	if providers:
+		filters['provider'] = providers
+	for values in get_netbox_results(NETBOX_API.circuits.circuits, **filters):
+		yield get_circuit_row(values)
+
+
+def load_snapshot_data(devices=None, sites=None, devices_only=False):
+	# Same snapshot as prefetch_netbox_data() builds, from the records of the snapshot file
+	snapshot = {
+		'sites': dict(),
+		'devices': dict(),
+		'devices_by_id': dict(),
+		'interfaces': dict(),
+		'vlans': dict(),
+		'circuits': dict(),
+	}
+	dev_names = list()
+	for site in sites or []:
+		dev_names.extend((NETBOX_SNAPSHOT.get('sites', str(site).lower()) or dict()).get('devices', list()))
+	dev_names.extend(str(device) for device in devices or [])
+
+	for name in dev_names:
+		if name in snapshot['devices']:
+			continue
+		data = NETBOX_SNAPSHOT.get('devices', name)
+		if data is None:
+			continue
+		record = SnapshotRecord(data['device'])
+		snapshot['devices'][name] = record
+		snapshot['devices_by_id'][record.id] = record
+		snapshot['interfaces'][record.id] = list() if devices_only else [IntfRecord(values)
+			for values in data['interfaces']]
+		snapshot['sites'].setdefault(str(record.site.slug), list()).append(name)
+
+	if devices_only:
+		print('Prefetched {0} device(s) from {1}\n'.format(len(snapshot['devices']), NETBOX_SNAPSHOT.path))
+		return snapshot
+
+	for site_id in sorted(set(record.site.id for record in snapshot['devices_by_id'].values())):
+		snapshot['vlans'][site_id] = [SnapshotRecord(values) for values in NETBOX_SNAPSHOT.get('vlans', site_id, list())]
+	snapshot['circuits'] = get_circuit_index()
+
+	print('Prefetched {0} device(s), {1} interface(s), {2} vlan(s), {3} circuit(s) from {4}\n'.format(
+		len(snapshot['devices']), sum(len(i) for i in snapshot['interfaces'].values()),
+		sum(len(v) for v in snapshot['vlans'].values()), len(snapshot['circuits']), NETBOX_SNAPSHOT.path))
+	return snapshot
+
+
+def get_snapshot_topologies(snapshot=None):
+	# get_site_topology() of every site of the snapshot, from two paginated queries over the whole estate
+	# instead of two per site
+	topologies = dict((site_id, {'site_id': site_id, 'links': dict(), 'circuits': dict()}) for site_id in snapshot['vlans'])
+	for values in get_netbox_results(NETBOX_API.dcim.interface_connections):
+		ends = (values.get('interface_a'), values.get('interface_b'))
+		if not all(ends):
+			continue
+		# Connections with either end on a site, both ends are recorded
+		for site_id in set(snapshot['devices_by_id'][end['device']['id']].site.id for end in ends
+			if end['device']['id'] in snapshot['devices_by_id']):
+			for local, peer in (ends, ends[::-1]):
+				topologies[site_id]['links'][local['id']] = {
+					'device': str(peer['device']['name']),
+					'interface': str(peer['name']),
+					'interface_id': peer['id'],
+				}
+	for values in get_netbox_results(NETBOX_API.circuits.circuit_terminations):
+		site_id = (values.get('site') or dict()).get('id')
+		if values.get('interface') and site_id in topologies:
+			topologies[site_id]['circuits'][values['interface']['id']] = values['circuit']['id']
+	return topologies
+
+
+def export_netbox_snapshot(path=None, sites=None):
+	try:
+		if not path:
+			raise Exception('No snapshot file specified!')
+		elif NETBOX_SNAPSHOT is not None:
+			raise Exception('Snapshots are exported from the netbox API, not from another snapshot!')
+
+		start = time.time()
+		site_rows = dict()
+		for values in get_netbox_results(NETBOX_API.dcim.sites):
+			if not sites or values['slug'] in sites:
+				site_rows[values['slug']] = {'id': values['id'], 'slug': values['slug'], 'name': values['name'],
+					'devices': list()}
+		if not site_rows:
+			raise Exception('No site to export!')
+
+		snapshot = prefetch_netbox_data(sites=sorted(site_rows))
+		for slug, names in snapshot['sites'].items():
+			# In netbox order, as a live -i2 lists them
+			site_rows[slug]['devices'] = names
+
+		sections = {
+			'sites': site_rows,
+			'devices': dict(),
+			'vlans': dict(),
+			'topology': dict(),
+			'circuits': {'all': sorted(snapshot['circuits'].values(), key=lambda row: row['id'])},
+		}
+		for name, record in snapshot['devices'].items():
+			sections['devices'][name] = {
+				'device': get_snapshot_values(record, SNAPSHOT_DEVICE_FIELDS),
+				'interfaces': [get_intf_values(interface) for interface in snapshot['interfaces'].get(record.id, list())],
+			}
+		for site_id, vlans in snapshot['vlans'].items():
+			sections['vlans'][site_id] = [get_snapshot_values(vlan, SNAPSHOT_VLAN_FIELDS) for vlan in vlans]
+		sections['topology'] = get_snapshot_topologies(snapshot)
+
+		meta = {
+			'created': datetime.now(timezone.utc).isoformat(),
+			'netbox': NETBOX_URL,
+			'counts': {
+				'sites': len(site_rows),
+				'devices': len(snapshot['devices']),
+				'interfaces': sum(len(i) for i in snapshot['interfaces'].values()),
+				'vlans': sum(len(v) for v in snapshot['vlans'].values()),
+				'circuits': len(snapshot['circuits']),
+			},
+		}
+		size = write_snapshot(path, meta, sections)
+		print('Exported {0} site(s), {1} device(s) to {2}, {3} bytes in {4:.1f}s'.format(len(site_rows),
+			len(snapshot['devices']), path, size, time.time() - start))
+		return meta
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_text_hash(text=None):
+	return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+
+def write_plan_file(plan_file=None, plan=None):
+	try:
+		if not plan_file:
+			raise Exception('No plan file specified!')
+		elif not plan:
+			raise Exception('No plan provided!')
+
+		plan['version'] = PLAN_VERSION
+		plan['created'] = datetime.now(timezone.utc).isoformat()
+		with open(plan_file, 'w') as file:
+			json.dump(plan, file, indent=2)
+		print('Plan written to {0}: {1} device(s), {2} netbox change(s), {3} vlan write-back(s)'.format(
+			plan_file, len(plan.get('devices', [])), len(plan.get('netbox', [])), len(plan.get('vlans', []))))
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def read_plan_file(plan_file=None):
+	try:
+		if not plan_file:
+			raise Exception('No plan file specified!')
+		elif not os.path.exists(plan_file):
+			raise Exception('Plan file {0} not found!'.format(plan_file))
+
+		with open(plan_file) as file:
+			plan = json.load(file)
+		if plan.get('version') != PLAN_VERSION:
+			raise Exception('Unsupported plan version: {0}'.format(plan.get('version')))
+		return plan
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def queue_netbox_update(endpoint=None, obj_id=None, data=None):
+	# Collected changes are sent by flush_netbox_writes() as bulk PATCH requests
+	with NETBOX_WRITE_LOCK:
+		queue = NETBOX_WRITE_QUEUE['update'].setdefault(endpoint, dict())
+		queue.setdefault(int(obj_id), dict()).update(data or dict())
+
+
+def queue_netbox_delete(endpoint=None, obj_id=None):
+	with NETBOX_WRITE_LOCK:
+		queue = NETBOX_WRITE_QUEUE['delete'].setdefault(endpoint, list())
+		if int(obj_id) not in queue:
+			queue.append(int(obj_id))
+		# No point in updating an object which is going to be deleted
+		NETBOX_WRITE_QUEUE['update'].get(endpoint, dict()).pop(int(obj_id), None)
+
+
+def netbox_request(method=None, endpoint=None, obj_id=None, data=None):
+	url = '{0}/{1}/'.format(NETBOX_API.base_url, endpoint)
+	if obj_id is not None:
+		url += '{0}/'.format(obj_id)
+	headers = dict(get_netbox_headers(), **{'Content-Type': 'application/json'})
+	return NETBOX_API.http_session.request(method, url, headers=headers,
+		data=json.dumps(data) if data is not None else None)
+
+
+def send_netbox_writes(method=None, endpoint=None, items=None):
+	results = list()
+	resp = netbox_request(method, endpoint, data=items)
+	if resp.ok:
+		for item in items:
+			results.append({'op': method, 'endpoint': endpoint, 'id': item['id'], 'status': resp.status_code, 'error': None})
+		return results
+	elif resp.status_code not in NETBOX_BULK_UNSUPPORTED:
+		# Netbox refused the chunk as a whole, every object in it failed
+		for item in items:
+			results.append({'op': method, 'endpoint': endpoint, 'id': item['id'], 'status': resp.status_code,
+				'error': resp.text[:200]})
+		return results
+
+	# Bulk operations on list endpoints need netbox >= 2.10, fall back to one request per object
+	for item in items:
+		data = {k: v for k, v in item.items() if k != 'id'} if method == 'PATCH' else None
+		obj_resp = netbox_request(method, endpoint, obj_id=item['id'], data=data)
+		results.append({'op': method, 'endpoint': endpoint, 'id': item['id'], 'status': obj_resp.status_code,
+			'error': None if obj_resp.ok else obj_resp.text[:200]})
+	return results
+
+
+@profiled('netbox_write')
+def flush_netbox_writes(chunk_size=None):
+	try:
+		chunk_size = chunk_size or NETBOX_WRITE_CHUNK
+		with NETBOX_WRITE_LOCK:
+			updates = NETBOX_WRITE_QUEUE['update']
+			deletes = NETBOX_WRITE_QUEUE['delete']
+			NETBOX_WRITE_QUEUE['update'] = dict()
+			NETBOX_WRITE_QUEUE['delete'] = dict()
+
+		# A snapshot run never writes to netbox, its data may be older than what netbox has now
+		if NETBOX_SNAPSHOT is not None:
+			count = sum(len(objects) for objects in updates.values()) + sum(len(ids) for ids in deletes.values())
+			if count:
+				print('Netbox data came from {0}, {1} netbox write(s) not sent'.format(NETBOX_SNAPSHOT.path, count))
+			return list()
+
+		results = list()
+		for endpoint, objects in updates.items():
+			items = [dict(data, id=obj_id) for obj_id, data in objects.items()]
+			for chunk in chunk_list(items, chunk_size):
+				results.extend(send_netbox_writes('PATCH', endpoint, chunk))
+		for endpoint, obj_ids in deletes.items():
+			items = [{'id': obj_id} for obj_id in obj_ids]
+			for chunk in chunk_list(items, chunk_size):
+				results.extend(send_netbox_writes('DELETE', endpoint, chunk))
+
+		for result in results:
+			print('Operation {0} {1} id {2} returned status: {3}{4}'.format(result['op'], result['endpoint'],
+				result['id'], result['status'], ' ({0})'.format(result['error']) if result['error'] else ''))
+		return results
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
@@ -2,28 +2,36 @@
 
 import sys
 import os
-import re
-import yaml
-import requests
+import csv
+import json
+import time
+import hashlib
+import shutil
+import tarfile
+import tempfile
 import argparse
-import pynetbox
-from pprint import pprint
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 # Local functions.py
 from functions import *
+from fleet import run_fleet, print_fleet_summary
+# Local profiler.py
+from profiler import enable_profile, finish_profile
+# Local journal.py
+from journal import get_run_key, open_journal, close_journal, record_stage, is_device_done
 
 
-if os.path.exists('./config.yml'):
-	with open('./config.yml') as f:
-		YAML_PARAMS = yaml.safe_load(f)
-		f.close()
-else:
-	print('config.yml not found!')
-	sys.exit(1)
-
-NETBOX_URL = YAML_PARAMS['netbox']['url']
-NETBOX_TOKEN = YAML_PARAMS['netbox']['token']
-NETBOX_API = pynetbox.api(NETBOX_URL, token=NETBOX_TOKEN)
+# YAML_PARAMS, NETBOX_URL, NETBOX_TOKEN and NETBOX_API come from functions.py
 LLDP_INCOMPATIBLE_SLUGS = YAML_PARAMS['lldp_incompatible_slugs']
+INTF_TPL = './out/tpl_intf.j2'
+VLAN_TPL = './out/tpl_vlan.j2'
+PLAN_TEMPLATES = {'intf': INTF_TPL, 'vlan': VLAN_TPL}
+CIRCUIT_FIELDS = ('id', 'cid', 'provider', 'provider_slug', 'type', 'type_slug', 'commit_rate')
+RENDER_MANIFEST = 'manifest.json'
+RENDER_ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz')
+FLEET_PARAMS = YAML_PARAMS.get('fleet') or dict()
+FLEET_WORKERS = FLEET_PARAMS.get('workers', 1)
+FLEET_SITE_WORKERS = FLEET_PARAMS.get('site_workers', 0)
 
 
 def get_cmdline():
@@ -38,134 +46,421 @@ def get_cmdline():
 							help='update interface descriptions of a single device in the netbox db. specify a DEVICE name from netbox, \
 							or comma separated LIST.',
 							required=False)
+	parser.add_argument('-i4', dest='upd_db_site', type=str,
+							help='update interface descriptions of all devices of a site in the netbox db. specify a SITE name \
+							from netbox, or comma separated LIST.',
+							required=False)
 	parser.add_argument('-v1', dest='upd_dev_vlans', type=str,
 							help='update vlans on a single device. specify a single DEVICE name from netbox, or comma separated LIST.',
 							required=False)
 	parser.add_argument('-v3', dest='upd_site_vlans', type=str,
 							help='update vlans across a whole site. specify a SITE name from netbox, or comma separated LIST.',
 							required=False)
+	parser.add_argument('-r1', dest='arch_dev', type=str,
+							help='archive running config of a single device. specify a single DEVICE name from netbox, or comma separated LIST.',
+							required=False)
+	parser.add_argument('-r2', dest='arch_site_devs', type=str,
+							help='archive running configs across a whole site. specify a single SITE name from netbox, or comma separated LIST.',
+							required=False)
 	parser.add_argument('-c', dest='site_circuits', type=str, nargs='?', const='all',
 							help='print circuits id. specify TYPE (separated by comma if many) or leave blank for ALL.',
 							required=False)
+	parser.add_argument('--provider', dest='circuit_providers', type=str,
+							help='with -c: only circuits of PROVIDER (slug, separated by comma if many).',
+							required=False)
+	parser.add_argument('--format', dest='out_format', type=str, choices=('text', 'json', 'csv'), default='text',
+							help='with -c: output format (default: text).',
+							required=False)
+	parser.add_argument('--group-by', dest='group_by', type=str,
+							help='with -c: print circuit count and total commit rate per \'provider\', \'type\' \
+							or \'provider,type\' instead of the circuits.',
+							required=False)
+	parser.add_argument('--plan', dest='plan_file', type=str,
+							help='don\'t change anything, write pending device diffs and netbox changes of -i1/-i2/-i3/-v1/-v3 \
+							to a PLAN file.',
+							required=False)
+	parser.add_argument('--render', dest='render_path', type=str,
+							help='don\'t touch any device, render the configs of -i1/-i2/-v1/-v3 (site \'all\' for every site) \
+							into a DIR, or a .tar/.tar.gz ARCHIVE, with a manifest of their hashes. --workers sets the number \
+							of render processes.',
+							required=False)
+	parser.add_argument('--golden', dest='golden_manifest', type=str,
+							help='with --render: compare the hashes with a MANIFEST (or a DIR holding one) of an earlier \
+							render, exit code 1 if any config differs.',
+							required=False)
+	parser.add_argument('--snapshot', dest='snapshot_file', type=str,
+							help='read the netbox data from a snapshot FILE instead of the API, netbox isn\'t written to.',
+							required=False)
+	parser.add_argument('--export-snapshot', dest='export_snapshot', type=str,
+							help='export sites, devices, interfaces, vlans, circuits and connections of every site \
+							into a snapshot FILE for --snapshot.',
+							required=False)
+	parser.add_argument('--apply', dest='apply_file', type=str,
+							help='apply a PLAN file made with --plan, unattended and in batches.',
+							required=False)
+	parser.add_argument('--batch-size', dest='batch_size', type=int, default=FLEET_PARAMS.get('batch_size', 10),
+							help='number of devices per batch when applying a plan (default: 10).',
+							required=False)
+	parser.add_argument('--force', dest='force', action='store_true',
+							help='push to every device, even if its rendered config was already pushed successfully \
+							(with -r1/-r2: fetch even if the archived running config is still fresh).',
+							required=False)
+	parser.add_argument('--local-diff', dest='local_diff', action='store_true', default=None,
+							help='diff rendered configs against running configs locally, skip devices without changes \
+							and push only the missing lines.',
+							required=False)
+	parser.add_argument('--incremental', dest='incremental', action='store_true',
+							help='with -i2/-v3: handle only what changed in netbox since the last successful run of each site.',
+							required=False)
+	parser.add_argument('--resume', dest='resume', action='store_true',
+							help='with -i1/-i2/-v1/-v3: continue the last unfinished run of the same command, \
+							devices it already finished are skipped without connecting to them.',
+							required=False)
+	parser.add_argument('--workers', dest='workers', type=int, default=FLEET_PARAMS.get('workers', 1),
+							help='number of devices handled in parallel (default: 1, sequential).',
+							required=False)
+	parser.add_argument('--site-workers', dest='site_workers', type=int, default=FLEET_PARAMS.get('site_workers', 0),
+							help='max number of devices of the same site handled in parallel (default: 0, no limit).',
+							required=False)
+	parser.add_argument('--profile', dest='profile', type=str, nargs='?', const='',
+							help='print netbox request and per-device stage timings at the end of the run, \
+							optionally write them to a Chrome trace FILE (chrome://tracing, ui.perfetto.dev) too.',
+							required=False)
+	parser.add_argument('-y', dest='assume_yes', action='store_true',
+							help='answer \'yes\' to all prompts (unattended run).',
+							required=False)
 	arguments = parser.parse_args()
 	return arguments
 
 
-def update_device_cfg(devices=None):
+def build_device_cfg(device=None, snapshot=None, verbose=True):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+		elif not snapshot:
+			raise Exception('No snapshot provided!')
+
+		if snapshot['devices'].get(device) is None:
+			print('{0} not found in the netbox!'.format(device))
+			sys.exit(1)
+		else:
+			NETBOX_DEVICE_VIEW = snapshot['devices'][device]
+			NETBOX_DEVICE_ID = NETBOX_DEVICE_VIEW.id
+			NETBOX_DEVICE_IP = str(NETBOX_DEVICE_VIEW.primary_ip4).split('/')[0]
+			NETBOX_DEVICE_MODEL = str(NETBOX_DEVICE_VIEW.device_type.slug)
+			NETBOX_DEVICE_INTFS = snapshot['interfaces'].get(NETBOX_DEVICE_ID, list())
+			if verbose:
+				print('Found {0} id: {1}\n'.format(device, NETBOX_DEVICE_ID))
+
+		config_dict = dict()
+		intf_list = list()
+		intf_tags = ['gw', 'isp_l2', 'isp_l3', 'upd_desc', 'upd_trunk']
+
+		for interface in NETBOX_DEVICE_INTFS:
+			check_intf_tags = interface.tags
+
+			# MTU, MSS
+			if interface.mtu:
+				mtu = interface.mtu
+				mss = int(mtu)-40
+			else:
+				mtu = False
+				mss = False
+
+			# Resulting dictionary defaults
+			vlan_list = ()
+			native_vlan = False
+			access_vlan = False
+			isp_l2_flag = False
+			isp_l3_flag = False
+			circuit_isp = False
+			circuit_svc = False
+			circuit_rate = False
+			switch_flag = False
+			lldp_flag = False
+			populate_flag = False
+
+			#
+			# Pickup connected interface or LAG
+			#
+			if interface.connected or interface.is_lag:
+				# print(interface.name)
+				pvl = populate_vlan_list(interface)
+				native_vlan = pvl[0]
+				vlan_list = pvl[1]
+				populate_flag = True
+
+			# Pickup interfaces tagged with predefined tags (intf_tags).
+			# - 'upd_desc' is when an interface's description is manually set in Netbox,
+			# and replicated from Netbox to a device.
+			# - 'upd_trunk' is when an trunk's allowed vlans are manually set in Netbox,
+			# and replicated from Netbox to a device.
+			# - 'cid_XXX' to configure policy-map
+			elif len(check_intf_tags) > 0:
+				for intf_tag in check_intf_tags:
+					if 'cid' in intf_tag:
+						circuit = get_snapshot_circuit(snapshot, get_circuit_id(intf_tag))
+						circuit_isp = circuit['provider']
+						circuit_svc = circuit['type']
+						# kbps -> bps
+						circuit_rate = int(circuit['commit_rate'])*1000
+				for item in intf_tags:
+					if item in check_intf_tags:
+						if item == 'isp_l2':
+							isp_l2_flag = True
+							if 'switch' in NETBOX_DEVICE_VIEW.device_role.slug:
+								switch_flag = True
+								if interface.mode:
+									if interface.mode == 100:
+										access_vlan = interface.untagged_vid
+							elif NETBOX_DEVICE_MODEL not in LLDP_INCOMPATIBLE_SLUGS:
+								lldp_flag = True
+						elif item == 'isp_l3':
+							isp_l3_flag = True
+						elif item == 'upd_trunk':
+							pvl = populate_vlan_list(interface)
+							native_vlan = pvl[0]
+							vlan_list = pvl[1]
+						populate_flag = True
+
+			if populate_flag:
+				intf_list.append(IntfIntent(
+				name=interface.name,
+				desc=interface.description,
+				vlans=vlan_list,
+				native_vlan=native_vlan,
+				access_vlan=access_vlan,
+				isp_l2_flag=isp_l2_flag,
+				isp_l3_flag=isp_l3_flag,
+				mtu=mtu,
+				mss=mss,
+				circuit_isp=circuit_isp,
+				circuit_svc=circuit_svc,
+				circuit_rate=circuit_rate,
+				switch_flag=switch_flag,
+				lldp_flag=lldp_flag
+				))
+
+		config_dict['interfaces'] = intf_list
+
+		return NETBOX_DEVICE_IP, config_dict
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def push_device_cfg(device=None, snapshot=None):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+
+		if is_device_done(device):
+			print('[resume] {0}: already done'.format(device))
+			return None
+
+		NETBOX_DEVICE_IP, config_dict = build_device_cfg(device, snapshot)
+
+		# Load config on device
+		# pprint(config_dict)
+		# sys.exit(1)
+		return load_cfg(dst_device=device, dst_device_ip=NETBOX_DEVICE_IP, src_config_dict=config_dict, j2_tpl=INTF_TPL)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def record_failures(results=None):
+	# Devices whose task died (error handler exit, exception) get their failure journaled
+	for result in results or []:
+		if result['status'] == 'failed':
+			record_stage(result['device'], 'failed', error=result['error'])
+
+
+def update_device_cfg(devices=None, snapshot=None):
 	try:
 		if not devices:
 			raise Exception('No device(s) specified!')
 
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=devices)
+
+		tasks = list()
 		for item in devices:
-			
 			device = str(item)
+			tasks.append({
+				'device': device,
+				'site': get_device_site(snapshot, device),
+				'func': push_device_cfg,
+				'kwargs': {'device': device, 'snapshot': snapshot}
+				})
+			if not is_device_done(device):
+				record_stage(device, 'fetched')
 
-			if NETBOX_API.dcim.devices.get(name=device) is None:
-				print('{0} not found in the netbox!'.format(device))
-				sys.exit(1)
-			else:
-				NETBOX_DEVICE_VIEW = NETBOX_API.dcim.devices.get(name=device)
-				NETBOX_DEVICE_ID = NETBOX_DEVICE_VIEW.id
-				NETBOX_DEVICE_IP = str(NETBOX_DEVICE_VIEW.primary_ip4).split('/')[0]
-				NETBOX_DEVICE_MODEL = str(NETBOX_DEVICE_VIEW.device_type.slug)
-				NETBOX_DEVICE_INTFS = NETBOX_API.dcim.interfaces.filter(device=device)
-				print('Found {0} id: {1}\n'.format(device, NETBOX_DEVICE_ID))
+		start = time.time()
+		results = run_fleet(tasks, workers=FLEET_WORKERS, site_workers=FLEET_SITE_WORKERS)
+		if len(results) > 1:
+			print_fleet_summary(results, wall_time=time.time()-start)
+		record_failures(results)
+		return results
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
 
-			config_dict = dict()
-			intf_list = list()
-			intf_tags = ['gw', 'isp_l2', 'isp_l3', 'upd_desc', 'upd_trunk']
 
-			for interface in NETBOX_DEVICE_INTFS:
-				check_intf_tags = interface.tags
+def archive_device_cfg(device=None, snapshot=None, force=False):
+	try:
+		if not device:
+			raise Exception('No device specified!')
 
-				# MTU, MSS
-				if interface.mtu:
-					mtu = interface.mtu
-					mss = int(mtu)-40
-				else:
-					mtu = False
-					mss = False
-
-				# Resulting dictionary defaults
-				vlan_list = list()
-				native_vlan = False
-				access_vlan = False
-				isp_l2_flag = False
-				isp_l3_flag = False
-				circuit_isp = False
-				circuit_svc = False
-				circuit_rate = False
-				switch_flag = False
-				lldp_flag = False
-				populate_flag = False
-
-				#
-				# Pickup connected interface or LAG
-				#
-				if interface.interface_connection or 'LAG' in interface.form_factor.label:
-					# print(interface.name)
-					pvl = populate_vlan_list(interface)
-					native_vlan = pvl[0]
-					vlan_list = pvl[1]
-					populate_flag = True
-
-				# Pickup interfaces tagged with predefined tags (intf_tags).
-				# - 'upd_desc' is when an interface's description is manually set in Netbox,
-				# and replicated from Netbox to a device.
-				# - 'upd_trunk' is when an trunk's allowed vlans are manually set in Netbox,
-				# and replicated from Netbox to a device.
-				# - 'cid_XXX' to configure policy-map
-				elif len(check_intf_tags) > 0:
-					for intf_tag in check_intf_tags:
-						if 'cid' in intf_tag:
-							circuit = NETBOX_API.circuits.circuits.get(re.sub('^cid_', '', intf_tag))
-							circuit_isp = circuit.provider.name
-							circuit_svc = circuit.type.name
-							# kbps -> bps
-							circuit_rate = int(circuit.commit_rate)*1000
-					for item in intf_tags:
-						if item in check_intf_tags:
-							if item == 'isp_l2':
-								isp_l2_flag = True
-								if 'switch' in NETBOX_DEVICE_VIEW.device_role.slug:
-									switch_flag = True
-									if interface.mode:
-										if interface.mode.value == 100:
-											access_vlan = interface.untagged_vlan.vid
-								elif NETBOX_DEVICE_MODEL not in LLDP_INCOMPATIBLE_SLUGS:
-									lldp_flag = True
-							elif item == 'isp_l3':
-								isp_l3_flag = True
-							elif item == 'upd_trunk':
-								pvl = populate_vlan_list(interface)
-								native_vlan = pvl[0]
-								vlan_list = pvl[1]
-							populate_flag = True
-
-				if populate_flag:
-					intf_list.append({
-					'name': interface.name,
-					'desc': interface.description,
-					'vlans': vlan_list,
-					'native_vlan': native_vlan,
-					'access_vlan': access_vlan,
-					'isp_l2_flag': isp_l2_flag,
-					'isp_l3_flag': isp_l3_flag,
-					'mtu': mtu,
-					'mss': mss,
-					'circuit_isp': circuit_isp,
-					'circuit_svc': circuit_svc,
-					'circuit_rate': circuit_rate,
-					'switch_flag': switch_flag,
-					'lldp_flag': lldp_flag
-					})
+		NETBOX_DEVICE = snapshot['devices'].get(device)
+		if not NETBOX_DEVICE:
+			raise Exception('Device \'{}\' not found!'.format(device))
+		NETBOX_DEVICE_IP = str(NETBOX_DEVICE.primary_ip4).split('/')[0]
+		return archive_running_config(device=device, device_ip=NETBOX_DEVICE_IP, force=force)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
 
-			config_dict['interfaces'] = intf_list
 
-			# Load config on device
-			# pprint(config_dict)
-			# sys.exit(1)
-			load_cfg(dst_device=device, dst_device_ip=NETBOX_DEVICE_IP, src_config_dict=config_dict, j2_tpl='./out/tpl_intf.j2')
+def archive_devices_cfg(devices=None, snapshot=None, force=False):
+	try:
+		if not devices:
+			raise Exception('No device(s) specified!')
+
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=devices, devices_only=True)
+
+		tasks = list()
+		for item in devices:
+			device = str(item)
+			tasks.append({
+				'device': device,
+				'site': get_device_site(snapshot, device),
+				'func': archive_device_cfg,
+				'kwargs': {'device': device, 'snapshot': snapshot, 'force': force}
+				})
+
+		start = time.time()
+		results = run_fleet(tasks, workers=FLEET_WORKERS, site_workers=FLEET_SITE_WORKERS)
+		if len(results) > 1:
+			print_fleet_summary(results, wall_time=time.time()-start)
+		return results
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def build_device_vlans(device=None, snapshot=None):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+		elif not snapshot:
+			raise Exception('No snapshot provided!')
+
+		NETBOX_DEVICE_VIEW = snapshot['devices'][device]
+		NETBOX_DEVICE_IP = str(NETBOX_DEVICE_VIEW.primary_ip4).split('/')[0]
+
+		# Every switch of the site gets the same vlans, rendered once per site
+		plan = get_site_vlan_plan(snapshot, NETBOX_DEVICE_VIEW.site.id, VLAN_TPL)
+		if plan['config_dict']:
+			return NETBOX_DEVICE_IP, plan['config_dict']
+		else:
+			return NETBOX_DEVICE_IP, None
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_device_vlan_cfg(device=None, snapshot=None):
+	plan = get_site_vlan_plan(snapshot, snapshot['devices'][device].site.id, VLAN_TPL)
+	return plan['configs'].get(VLAN_TPL)
+
+
+def push_device_vlans(device=None, snapshot=None):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+
+		if is_device_done(device):
+			print('[resume] {0}: already done'.format(device))
+			return None
+
+		NETBOX_DEVICE_IP, config_dict = build_device_vlans(device, snapshot)
+
+		# Load config on device
+		# pprint(config_dict)
+		# sys.exit(1)
+		if config_dict:
+			return load_cfg(dst_device=device, dst_device_ip=NETBOX_DEVICE_IP, src_config_dict=config_dict, j2_tpl=VLAN_TPL,
+				generated_config=get_device_vlan_cfg(device, snapshot))
+		else:
+			print('No vlans need to be modified!')
+			return None
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def apply_vlan_writeback(vlans_add=None, vlans_del=None):
+	try:
+		for item in vlans_add or []:
+			queue_netbox_update('ipam/vlans', item['id'], {'tags':['vlan_ok']})
+		for item in vlans_del or []:
+			queue_netbox_delete('ipam/vlans', item['id'])
+		return flush_netbox_writes()
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_failed_writes(results=None, obj_ids=None):
+	# Queued writes of obj_ids without a successful result
+	done = set(r['id'] for r in results or [] if not r['error'] and r['status'] < 400)
+	return sorted(set(obj_ids) - done)
+
+
+def writeback_site_vlans(plans=None):
+	try:
+		# Tag added vlans as 'vlan_ok' and delete removed ones, once per site
+		pending = list()
+		for plan in plans or []:
+			if plan['written_back']:
+				continue
+			for item in plan['by_tag']['vlan_add']:
+				queue_netbox_update('ipam/vlans', item['id'], {'tags':['vlan_ok']})
+			for item in plan['by_tag']['vlan_del']:
+				queue_netbox_delete('ipam/vlans', item['id'])
+			pending.append(plan)
+		results = flush_netbox_writes() if pending else list()
+		# A site is written back once netbox confirmed every write of it
+		for plan in pending:
+			obj_ids = [item['id'] for item in plan['by_tag']['vlan_add'] + plan['by_tag']['vlan_del']]
+			plan['written_back'] = not get_failed_writes(results, obj_ids)
+		return results
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -174,82 +469,131 @@ def update_device_cfg(devices=None):
 		sys.exit(1)
 
 
-def update_device_vlans(devices=None):
+def update_device_vlans(devices=None, snapshot=None):
 	try:
 		if not devices:
 			raise Exception('No device specified!')
 
-		ok_count, sw_count = 0, 0
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=devices)
+
+		tasks = list()
+		# site id -> switches of the site in this run
+		site_switches = dict()
 
 		for item in devices:
 
 			device = str(item)
 
-			if NETBOX_API.dcim.devices.get(name=device) is None:
+			if snapshot['devices'].get(device) is None:
+				# Journaled as failed, the run goes on and exits non-zero once the journal is closed
 				print('{0} not found in the netbox!'.format(device))
-				if device == devices[-1]:
-					sys.exit(1)
-				else:
-					continue
+				record_stage(device, 'failed', error='not found in the netbox')
+				continue
 			else:
-				NETBOX_DEVICE_VIEW = NETBOX_API.dcim.devices.get(name=device)
-				NETBOX_DEVICE_IP = str(NETBOX_DEVICE_VIEW.primary_ip4).split('/')[0]
+				NETBOX_DEVICE_VIEW = snapshot['devices'][device]
 
 			if 'switch' not in NETBOX_DEVICE_VIEW.device_role.slug:
 				print('Skipping {0}'.format(device))
 				continue
 			else:
-				sw_count += 1
-				vlans_add = list()
-				vlans_del = list()
-				config_dict = dict()
-
-			site_vlans = NETBOX_API.ipam.vlans.filter(site_id=NETBOX_DEVICE_VIEW.site.id)
-
-			for vlan in site_vlans:
-				if vlan.tags:
-					if vlan.tags[0] == 'vlan_add':
-						# 'id' - ID in netbox, 'vid' - VLAN ID
-						vlans_add.append({
-							'id': vlan.id,
-							'vid': vlan.vid,
-							'name': vlan.name
-							})
-					elif vlan.tags[0] == 'vlan_del':
-						vlans_del.append({
-							'id': vlan.id,
-							'vid': vlan.vid,
-							'name': vlan.name
-							})
-			
-			if vlans_add:
-				config_dict['vlans_add'] = vlans_add
+				site_switches.setdefault(NETBOX_DEVICE_VIEW.site.id, list()).append(device)
+				tasks.append({
+					'device': device,
+					'site': get_device_site(snapshot, device),
+					'func': push_device_vlans,
+					'kwargs': {'device': device, 'snapshot': snapshot}
+					})
+				if not is_device_done(device):
+					record_stage(device, 'fetched')
+
+		status = dict()
+		results = list()
+		if tasks:
+			start = time.time()
+			results = run_fleet(tasks, workers=FLEET_WORKERS, site_workers=FLEET_SITE_WORKERS)
+			if len(results) > 1:
+				print_fleet_summary(results, wall_time=time.time()-start)
+			status = {r['device']: r['status'] for r in results}
+			record_failures(results)
+
+		# Netbox is updated for the sites whose switches all got the vlans
+		# ('skipped' switches already run the rendered config)
+		done_plans = list()
+		for site_id, switches in site_switches.items():
+			if all(status.get(device) in ('ok', 'skipped') for device in switches):
+				done_plans.append(get_site_vlan_plan(snapshot, site_id))
+			else:
+				print('Skipping vlan write-back for site {0}'.format(get_device_site(snapshot, switches[0])))
+		writeback_site_vlans(done_plans)
+		for plan in done_plans:
+			switches = site_switches[plan['site_id']]
+			if plan['written_back']:
+				for device in switches:
+					record_stage(device, 'writeback')
+				continue
+			# Pushed but netbox not updated: not done, --resume writes back again
+			print('Vlan write-back for site {0} failed'.format(get_device_site(snapshot, switches[0])))
+			for device in switches:
+				record_stage(device, 'failed', error='vlan write-back')
+			for result in results:
+				if result['device'] in switches:
+					result['status'] = 'failed'
+					result['error'] = 'vlan write-back'
+		return results
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def update_sites_incremental(site_list=None, kind='intf'):
+	try:
+		if not site_list:
+			raise Exception('No site(s) specified!')
+
+		# Only devices with interfaces/circuits (or sites with vlans) changed since the last
+		# successful run of the site are handled, marks move forward for fully successful sites
+		changes, site_snapshot = get_site_changes(site_list, kind)
+		dev_list = list()
+		for site, entry in changes.items():
+			if kind == 'vlan':
+				if entry['vlans_changed']:
+					dev_list.extend(site_snapshot['sites'].get(site, list()))
 			else:
-				config_dict['vlans_add'] = None
+				dev_list.extend(entry['devices'])
 
-			if vlans_del:
-				config_dict['vlans_del'] = vlans_del
+		status = dict()
+		if dev_list:
+			snapshot = prefetch_netbox_data(devices=dev_list)
+			if kind == 'vlan':
+				results = update_device_vlans(devices=dev_list, snapshot=snapshot)
 			else:
-				config_dict['vlans_del'] = None
-
-			# Load config on device
-			# pprint(config_dict)
-			# sys.exit(1)
-			if vlans_add or vlans_del:
-				if load_cfg(dst_device=device, dst_device_ip=NETBOX_DEVICE_IP, src_config_dict=config_dict, j2_tpl='./out/tpl_vlan.j2'):
-					ok_count += 1
+				results = update_device_cfg(devices=dev_list, snapshot=snapshot)
+			status = {r['device']: r['status'] for r in results or []}
+		else:
+			print('Nothing changed since the last run')
+
+		marks = dict()
+		for site, entry in changes.items():
+			site_devs = [d for d in dev_list if d in site_snapshot['sites'].get(site, list())]
+			# Routers are skipped by vlan runs without a result
+			if all(status.get(d, 'skipped') in ('ok', 'skipped') for d in site_devs):
+				marks[site] = entry['mark']
+				plan = None
+				if kind == 'vlan' and site_devs:
+					site_id = site_snapshot['devices'][site_devs[0]].site.id
+					plan = snapshot.get('vlan_plans', dict()).get(site_id)
+				if plan and plan['written_back'] and plan['config_dict']:
+					marks[site] = get_vlan_writeback_mark(site_id, entry['mark'],
+						set(item['id'] for item in plan['by_tag']['vlan_add']),
+						set(item['id'] for item in plan['by_tag']['vlan_del']))
 			else:
-				print('No vlans need to be modified!')
-
-		if (sw_count > 0) and (ok_count == sw_count):
-			for item in vlans_add:
-				vlan = NETBOX_API.ipam.vlans.get(item['id'])
-				oper = vlan.update({'tags':['vlan_ok']})
-				print('Operation returned status: {0}'.format(oper))
-			for item in vlans_del:
-				vlan = NETBOX_API.ipam.vlans.get(item['id'])
-				oper = vlan.delete()
-				print('Operation returned status: {0}'.format(oper))
+				print('{0}: not all devices succeeded, next run starts from the same mark'.format(site))
+		if marks:
+			save_watermarks(kind, marks)
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -258,115 +602,110 @@ def update_device_vlans(devices=None):
 		sys.exit(1)
 
 
-def update_netbox_db(device=None):
+def get_desc_change(device=None, interface=None, new_desc=None, new_tags=None):
+	change = {
+		'device': device,
+		'interface_id': interface.id,
+		'interface': interface.name,
+		'old': {'description': interface.description, 'tags': list(interface.tags or [])},
+		'data': {'description': new_desc},
+	}
+	if new_tags is not None:
+		change['data']['tags'] = new_tags
+	return change
+
+
+def print_unchanged(interface=None, exit_code=None, verbose=True):
+	if verbose:
+		print('Nothing to change for interface {0} (id: {1}, exit: {2})'.format(
+			interface.name, interface.id, exit_code))
+
+
+def get_netbox_db_changes(device=None, snapshot=None, verbose=True):
 	try:
 		if not device:
 			raise Exception('No device specified!')
 
-		if NETBOX_API.dcim.devices.get(name=device) is None:
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=[device])
+
+		if snapshot['devices'].get(device) is None:
 			print('{0} not found in the netbox!'.format(device))
 			sys.exit(1)
 		else:
-			NETBOX_DEVICE_VIEW = NETBOX_API.dcim.devices.get(name=device)
+			NETBOX_DEVICE_VIEW = snapshot['devices'][device]
 			NETBOX_DEVICE_ID = NETBOX_DEVICE_VIEW.id
-			NETBOX_DEVICE_INTFS = NETBOX_API.dcim.interfaces.filter(device=device)
-			print('Found {0} id: {1}\n'.format(device, NETBOX_DEVICE_ID))
+			NETBOX_DEVICE_INTFS = snapshot['interfaces'].get(NETBOX_DEVICE_ID, list())
+			if verbose:
+				print('Found {0} id: {1}\n'.format(device, NETBOX_DEVICE_ID))
+		topology = get_site_topology(snapshot, NETBOX_DEVICE_VIEW.site.id)
 
 		static_desc_dict = YAML_PARAMS['netbox']['static_intf_desc']
+		changes = list()
 
 		for interface in NETBOX_DEVICE_INTFS:
 			cur_desc = interface.description
 			static_desc = static_desc_dict.get(interface.id, None)
-			data_to_mod = dict()
+			peer = topology['links'].get(interface.id)
+			circuit_id = topology['circuits'].get(interface.id)
+			if circuit_id is None:
+				circuit_id = interface.circuit_id
 			#
 			# Pickup interface connected to another device (but not circuit termination)
 			#
-			if interface.is_connected and interface.interface_connection:
-				connected_to_dev = interface.interface_connection.interface.device.name
-				connected_to_intf = interface.interface_connection.interface.name
-				new_desc = 'Core: {0} {1}'.format(connected_to_dev.lower(), connected_to_intf)
+			if peer:
+				new_desc = 'Core: {0} {1}'.format(peer['device'].lower(), peer['interface'])
 				if static_desc and (cur_desc != static_desc):
-					choise = yes_or_no('Change interface {0} (id:{1}) description: \'{2}\' <---> \'{3}\''.format(
-						interface.name, interface.id, cur_desc, static_desc))
-					if choise:
-						data_to_mod['description'] = static_desc
-						oper = interface.update(data_to_mod)
-						print('Operation returned status: {0}'.format(oper))
+					changes.append(get_desc_change(device, interface, static_desc))
 				elif (not static_desc) and (cur_desc != new_desc):
-					choise = yes_or_no('Change interface {0} (id: {1}) description: \'{2}\' <---> \'{3}\''.format(
-						interface.name, interface.id, cur_desc, new_desc))
-					if choise:
-						data_to_mod['description'] = new_desc
-						oper = interface.update(data_to_mod)
-						print('Operation returned status: {0}'.format(oper))
+					changes.append(get_desc_change(device, interface, new_desc))
 				else:
-					print('Nothing to change for interface {0} (id: {1}, exit: 1)'.format(
-						interface.name, interface.id))
+					print_unchanged(interface, 1, verbose)
 					continue
 			#
 			# Pickup interface with 802.1Q Mode: Access
 			#
-			elif interface.mode and (interface.circuit_termination is None) and ('gw' in interface.tags):
-				if (interface.mode.value == 100) and (interface.tags):
+			elif interface.mode and (circuit_id is None) and ('gw' in interface.tags):
+				if (interface.mode == 100) and (interface.tags):
 					# ..and tagged 'gw'
 					if 'gw' in interface.tags:
-						if interface.untagged_vlan:
-							new_desc = 'Gateway: VLAN {0}'.format(interface.untagged_vlan.vid)
+						if interface.untagged_vid:
+							new_desc = 'Gateway: VLAN {0}'.format(interface.untagged_vid)
 						else:
-							print('Nothing to change for interface {0} (id: {1}, exit: 2)'.format(
-								interface.name, interface.id))
+							print_unchanged(interface, 2, verbose)
 							continue
 						if static_desc and (cur_desc != static_desc):
-							choise = yes_or_no('Change interface {0} (id:{1}) description: \'{2}\' <---> \'{3}\''.format(
-								interface.name, interface.id, cur_desc, static_desc))
-							if choise:
-								data_to_mod['description'] = static_desc
-								oper = interface.update(data_to_mod)
-								print('Operation returned status: {0}'.format(oper))
+							changes.append(get_desc_change(device, interface, static_desc))
 						elif (not static_desc) and (cur_desc != new_desc):
-							choise = yes_or_no('Change interface {0} (id: {1}) description: \'{2}\' <---> \'{3}\''.format(
-								interface.name, interface.id, cur_desc, new_desc))
-							if choise:
-								data_to_mod['description'] = new_desc
-								oper = interface.update(data_to_mod)
-								print('Operation returned status: {0}'.format(oper))
+							changes.append(get_desc_change(device, interface, new_desc))
 						else:
-							print('Nothing to change for interface {0} (id: {1}, exit: 3)'.format(
-								interface.name, interface.id))
+							print_unchanged(interface, 3, verbose)
 							continue
 					else:
-						print('Nothing to change for interface {0} (id: {1}, exit: 4)'.format(
-							interface.name, interface.id))
+						print_unchanged(interface, 4, verbose)
 						continue
 				else:
-					print('Nothing to change for interface {0} (id: {1}, exit: 5)'.format(
-						interface.name, interface.id))
+					print_unchanged(interface, 5, verbose)
 					continue
 			#
 			# Pickup router's interface with circuit termination
 			#
-			elif (interface.circuit_termination) and ('switch' not in NETBOX_API.dcim.devices.get(name=device).device_role.slug):
-				circuit = NETBOX_API.circuits.circuits.get(interface.circuit_termination.circuit.id)
-				circuit_isp = circuit.provider.name
-				circuit_svc = circuit.type.name
-				circuit_rate = int(circuit.commit_rate)
+			elif circuit_id and ('switch' not in NETBOX_DEVICE_VIEW.device_role.slug):
+				circuit = get_snapshot_circuit(snapshot, circuit_id)
+				circuit_isp = circuit['provider']
+				circuit_svc = circuit['type']
+				circuit_rate = int(circuit['commit_rate'])
 				form_circuit_rate = format_rate(circuit_rate)
 				new_desc = 'Transit: {0} [{1}] '.format(
-								circuit_isp, form_circuit_rate)+'{'+circuit.cid +'}'+' ({0})'.format(circuit_svc)
+								circuit_isp, form_circuit_rate)+'{'+circuit['cid'] +'}'+' ({0})'.format(circuit_svc)
 				if cur_desc != new_desc:
-					choise = yes_or_no('Change interface {0} (id:{1}) description: \'{2}\' <---> \'{3}\''.format(
-						interface.name, interface.id, cur_desc, new_desc))
-					if choise:
-						if 'cid_' + str(circuit.id) not in interface.tags:
-							interface.tags.append('cid_' + str(circuit.id))
-							data_to_mod['tags'] = interface.tags
-						data_to_mod['description'] = new_desc
-						oper = interface.update(data_to_mod)
-						print('Operation returned status: {0}'.format(oper))
+					new_tags = None
+					if 'cid_' + str(circuit['id']) not in interface.tags:
+						new_tags = list(interface.tags) + ['cid_' + str(circuit['id'])]
+					changes.append(get_desc_change(device, interface, new_desc, new_tags))
 					continue
 				else:
-					print('Nothing to change for interface {0} (id: {1}, exit: 6)'.format(
-						interface.name, interface.id))
+					print_unchanged(interface, 6, verbose)
 					continue
 			#
 			# Check for specific tags
@@ -376,37 +715,45 @@ def update_netbox_db(device=None):
 				for intf_tag in interface.tags:
 					# Pickup interface with Tag: cid_XXX (but without direct circuit termination!)
 					if 'cid' in intf_tag:
-						circuit = NETBOX_API.circuits.circuits.get(re.sub('^cid_', '', intf_tag))
-						circuit_cid = circuit.cid
-						circuit_isp = circuit.provider.name
-						circuit_svc = circuit.type.name
-						circuit_rate = int(circuit.commit_rate)
+						circuit = get_snapshot_circuit(snapshot, get_circuit_id(intf_tag))
+						circuit_cid = circuit['cid']
+						circuit_isp = circuit['provider']
+						circuit_svc = circuit['type']
+						circuit_rate = int(circuit['commit_rate'])
 						form_circuit_rate = format_rate(circuit_rate)
 						new_desc = 'Transit: {0} [{1}] '.format(
 							circuit_isp, form_circuit_rate)+'{'+circuit_cid +'}'+' ({0})'.format(circuit_svc)
 				if new_desc is None:
-					print('Nothing to change for interface {0} (id: {1}, exit: 7)'.format(
-						interface.name, interface.id))
+					print_unchanged(interface, 7, verbose)
 					continue
 				else:
 					if cur_desc != new_desc:
-						choise = yes_or_no('Change interface {0} (id:{1}) description: \'{2}\' <---> \'{3}\''.format(
-							interface.name, interface.id, cur_desc, new_desc))
-						if choise:
-							data_to_mod['description'] = new_desc
-							oper = interface.update(data_to_mod)
-							print('Operation returned status: {0}'.format(oper))
-						else:
-							continue
+						changes.append(get_desc_change(device, interface, new_desc))
 					else:
-						print('Nothing to change for interface {0} (id: {1}, exit: 8)'.format(
-							interface.name, interface.id))
+						print_unchanged(interface, 8, verbose)
 						continue
 			# else:
 			# 	print('Nothing to change for interface {0} (id: {1}, exit: 9)'.format(
 			# 		interface.name, interface.id))
 			# 	continue
 
+		return changes
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def apply_netbox_db_change(change=None):
+	try:
+		if not change:
+			raise Exception('No change provided!')
+
+		# Sent with the next flush_netbox_writes()
+		queue_netbox_update('dcim/interfaces', change['interface_id'], dict(change['data']))
+
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
 			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
@@ -414,15 +761,553 @@ def update_netbox_db(device=None):
 		sys.exit(1)
 
 
-def circuits_info(types=None):
+def update_netbox_db(device=None, snapshot=None):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=[device])
+
+		for change in get_netbox_db_changes(device, snapshot):
+			choise = yes_or_no('Change interface {0} (id: {1}) description: \'{2}\' <---> \'{3}\''.format(
+				change['interface'], change['interface_id'], change['old']['description'], change['data']['description']))
+			if choise:
+				apply_netbox_db_change(change)
+
+		return flush_netbox_writes()
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def update_sites_netbox_db(site_list=None, snapshot=None):
+	try:
+		if not site_list:
+			raise Exception('No site(s) specified!')
+
+		if not snapshot:
+			snapshot = prefetch_netbox_data(sites=site_list)
+
+		# Core/Gateway/Transit proposals for every device of the sites, confirmed at once
+		changes = list()
+		for site in site_list:
+			for device in sorted(snapshot['sites'].get(site.lower(), list())):
+				changes.extend(get_netbox_db_changes(device, snapshot, verbose=False))
+		if not changes:
+			print('Nothing to change')
+			return True
+
+		width = max(len(change['device']) for change in changes)
+		print('\nProposed interface descriptions:')
+		print('*****')
+		for change in changes:
+			print('{0:<{w}}  {1}: \'{2}\' ---> \'{3}\''.format(change['device'], change['interface'],
+				change['old']['description'], change['data']['description'], w=width))
+		print('*****')
+		choise = yes_or_no('Change {0} interface description(s) on {1} device(s)'.format(
+			len(changes), len(set(change['device'] for change in changes))))
+		if not choise:
+			return False
+		for change in changes:
+			apply_netbox_db_change(change)
+		return flush_netbox_writes()
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def plan_device_cfg(device=None, snapshot=None, kind='intf', plan=None):
+	try:
+		if not device:
+			raise Exception('No device specified!')
+		elif plan is None:
+			raise Exception('No plan provided!')
+
+		if kind == 'vlan':
+			NETBOX_DEVICE_IP, config_dict = build_device_vlans(device, snapshot)
+		else:
+			NETBOX_DEVICE_IP, config_dict = build_device_cfg(device, snapshot)
+		if not config_dict:
+			print('{0}: nothing to change'.format(device))
+			return None
+
+		if kind == 'vlan':
+			generated_config = get_device_vlan_cfg(device, snapshot)
+		else:
+			generated_config = generate_cfg_from_template(PLAN_TEMPLATES[kind], config_dict)
+		config_hash = get_text_hash(generated_config)
+		push_config = get_config_to_push(device, NETBOX_DEVICE_IP, PLAN_TEMPLATES[kind], generated_config,
+			config_hash=config_hash)[0]
+		if push_config is None:
+			return None
+		with open('./out/{0}.cfg'.format(device.lower()), 'w') as file:
+			file.write(push_config)
+
+		# clogin devices can't be diffed, the whole rendered config is planned for them
+		if device.lower() in YAML_PARAMS['telnet']:
+			diffs = None
+		else:
+			diffs = diff_cfg_with_napalm(napalm_device=device, napalm_device_ip=NETBOX_DEVICE_IP)
+			if not diffs:
+				print('{0}: no effective changes'.format(device))
+				return None
+
+		plan['devices'].append({
+			'device': device,
+			'ip': NETBOX_DEVICE_IP,
+			'site': get_device_site(snapshot, device),
+			'kind': kind,
+			'config': generated_config,
+			'config_hash': config_hash,
+			'diff': diffs,
+			})
+		print('{0}: planned'.format(device))
+		return True
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def create_plan(plan_file=None, snapshot=None, devices=None, kind='intf'):
+	try:
+		if not plan_file:
+			raise Exception('No plan file specified!')
+		elif not devices:
+			raise Exception('No device(s) specified!')
+
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=devices)
+
+		plan = {'devices': list(), 'netbox': list(), 'vlans': list()}
+		devices = [str(item) for item in devices if snapshot['devices'].get(str(item))]
+
+		if kind == 'db':
+			for device in devices:
+				plan['netbox'].extend(get_netbox_db_changes(device, snapshot))
+			write_plan_file(plan_file, plan)
+			return plan
+
+		if kind == 'vlan':
+			devices = [device for device in devices if 'switch' in snapshot['devices'][device].device_role.slug]
+
+		tasks = list()
+		for device in devices:
+			tasks.append({
+				'device': device,
+				'site': get_device_site(snapshot, device),
+				'func': plan_device_cfg,
+				'kwargs': {'device': device, 'snapshot': snapshot, 'kind': kind, 'plan': plan}
+				})
+		if tasks:
+			start = time.time()
+			results = run_fleet(tasks, workers=FLEET_WORKERS, site_workers=FLEET_SITE_WORKERS)
+			if len(results) > 1:
+				print_fleet_summary(results, wall_time=time.time()-start)
+			failed = [r['device'] for r in results if r['status'] in ('failed', 'nok')]
+			if failed:
+				raise Exception('Plan not written, failed device(s): {0}'.format(', '.join(failed)))
+
+		# Keep the device order of the request
+		order = {device: n for n, device in enumerate(devices)}
+		plan['devices'].sort(key=lambda entry: order[entry['device']])
+
+		# VLAN tag/delete write-back per site, done once every planned switch of the site is loaded
+		if kind == 'vlan':
+			site_ids = sorted(set(snapshot['devices'][device].site.id for device in devices))
+			for site_id in site_ids:
+				vlans_add, vlans_del = get_site_vlan_lists(snapshot, site_id)
+				if not (vlans_add or vlans_del):
+					continue
+				site_devices = [d for d in devices if snapshot['devices'][d].site.id == site_id]
+				plan['vlans'].append({
+					'site_id': site_id,
+					'site': get_device_site(snapshot, site_devices[0]),
+					'devices': site_devices,
+					'update': [{'id': item['id'], 'tags': ['vlan_add']} for item in vlans_add],
+					'delete': [{'id': item['id'], 'tags': ['vlan_del']} for item in vlans_del],
+					})
+
+		write_plan_file(plan_file, plan)
+		return plan
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def check_plan(plan=None, snapshot=None):
+	try:
+		if not plan:
+			raise Exception('No plan provided!')
+		elif not snapshot:
+			raise Exception('No snapshot provided!')
+
+		stale = list()
+
+		for entry in plan['devices']:
+			if snapshot['devices'].get(entry['device']) is None:
+				stale.append('{0}: device not found in the netbox'.format(entry['device']))
+				continue
+			if entry['kind'] == 'vlan':
+				NETBOX_DEVICE_IP, config_dict = build_device_vlans(entry['device'], snapshot)
+			else:
+				NETBOX_DEVICE_IP, config_dict = build_device_cfg(entry['device'], snapshot)
+			generated_config = generate_cfg_from_template(PLAN_TEMPLATES[entry['kind']], config_dict) \
+				if config_dict else ''
+			if get_text_hash(generated_config) != entry['config_hash']:
+				stale.append('{0}: rendered config changed'.format(entry['device']))
+
+		# Descriptions are proposed again from the current data (peers, circuits), like configs are rendered again
+		proposals = dict()
+		for change in plan['netbox']:
+			try:
+				interface = get_snapshot_interface(snapshot, change['device'], change['interface_id'])
+			except Exception:
+				stale.append('{0} {1}: interface not found'.format(change['device'], change['interface']))
+				continue
+			if (interface.description != change['old']['description']) or \
+				(list(interface.tags or []) != change['old']['tags']):
+				stale.append('{0} {1}: description/tags changed'.format(change['device'], change['interface']))
+				continue
+			if change['device'] not in proposals:
+				proposals[change['device']] = dict((proposal['interface_id'], proposal['data'])
+					for proposal in get_netbox_db_changes(change['device'], snapshot, verbose=False))
+			if proposals[change['device']].get(change['interface_id']) != change['data']:
+				stale.append('{0} {1}: proposed description changed'.format(change['device'], change['interface']))
+
+		for entry in plan['vlans']:
+			site_vlans = {vlan.id: vlan for vlan in snapshot['vlans'].get(entry['site_id'], list())}
+			for item in entry['update'] + entry['delete']:
+				vlan = site_vlans.get(item['id'])
+				if vlan is None or list(vlan.tags or [])[:1] != item['tags']:
+					stale.append('{0}: vlan id {1} changed'.format(entry['site'], item['id']))
+
+		return stale
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def apply_planned_cfg(entry=None):
+	try:
+		if not entry:
+			raise Exception('No plan entry provided!')
+
+		# The planned diff is authoritative, don't skip on the push state
+		return load_cfg(dst_device=entry['device'], dst_device_ip=entry['ip'], src_config_dict=None,
+			j2_tpl=PLAN_TEMPLATES[entry['kind']], generated_config=entry['config'], expected_diff=entry['diff'],
+			force=True)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def apply_plan(plan_file=None, batch_size=10):
+	try:
+		if not plan_file:
+			raise Exception('No plan file specified!')
+
+		plan = read_plan_file(plan_file)
+		devices = [entry['device'] for entry in plan['devices']] + [change['device'] for change in plan['netbox']]
+		for entry in plan['vlans']:
+			devices.extend(entry['devices'])
+		devices = sorted(set(devices))
+		if not devices:
+			print('Nothing to apply!')
+			return True
+
+		snapshot = prefetch_netbox_data(devices=devices)
+		stale = check_plan(plan, snapshot)
+		if stale:
+			print('Plan {0} is stale, netbox data changed since it was made:'.format(plan_file))
+			for line in stale:
+				print(' - {0}'.format(line))
+			sys.exit(1)
+
+		set_assume_yes(True)
+		start = time.time()
+		results = list()
+		failed = set()
+
+		for n, batch in enumerate(chunk_list(plan['devices'], batch_size)):
+			print('Applying batch {0} ({1} device(s))...'.format(n + 1, len(batch)))
+			tasks = [{
+				'device': entry['device'],
+				'site': entry['site'],
+				'func': apply_planned_cfg,
+				'kwargs': {'entry': entry}
+				} for entry in batch]
+			batch_results = run_fleet(tasks, workers=FLEET_WORKERS, site_workers=FLEET_SITE_WORKERS)
+			results.extend(batch_results)
+			failed.update(r['device'] for r in batch_results if r['status'] in ('failed', 'nok'))
+			if failed:
+				print('Batch {0} had failures, remaining batches are not applied!'.format(n + 1))
+				break
+
+		if not failed:
+			for change in plan['netbox']:
+				apply_netbox_db_change(change)
+			failed_writes = [r for r in flush_netbox_writes() if r['error']]
+			if failed_writes:
+				failed.add('netbox')
+
+		for entry in plan['vlans']:
+			if failed.intersection(entry['devices']) or len(results) < len(plan['devices']):
+				print('Skipping vlan write-back for site {0}'.format(entry['site']))
+				continue
+			writes = apply_vlan_writeback(entry['update'], entry['delete'])
+			if get_failed_writes(writes, [item['id'] for item in entry['update'] + entry['delete']]):
+				print('Vlan write-back for site {0} failed'.format(entry['site']))
+				failed.add('netbox')
+
+		if results:
+			print_fleet_summary(results, wall_time=time.time()-start)
+		return not failed
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def print_circuit_groups(groups=None, group_by=None, out_format='text'):
+	fields = list(group_by) + ['count', 'commit_rate']
+	rows = [dict(zip(group_by, key), count=value[0], commit_rate=value[1]) for key, value in sorted(groups.items())]
+	if out_format == 'json':
+		print(json.dumps(rows, indent=2))
+	elif out_format == 'csv':
+		writer = csv.DictWriter(sys.stdout, fieldnames=fields, lineterminator='\n')
+		writer.writeheader()
+		writer.writerows(rows)
+	else:
+		row = '  '.join('{{{0}:<{{w{0}}}}}'.format(n) for n in range(len(fields)))
+		cells = [list(group_by) + ['count', 'commit rate']] + [[str(r[k]) for k in group_by] + [str(r['count']),
+			format_rate(r['commit_rate']) if r['commit_rate'] else '-'] for r in rows]
+		widths = {'w{0}'.format(n): max(len(c[n]) for c in cells) for n in range(len(fields))}
+		print('*****')
+		for line in cells:
+			print(row.format(*line, **widths).rstrip())
+		print('*****')
+
+
+def circuits_info(types=None, providers=None, out_format='text', group_by=None):
 	try:
 		if not types:
 			raise Exception('No types specified!')
-		cir_list = NETBOX_API.circuits.circuits.all()
-		for circuit in cir_list:
-			if circuit.type.slug in types or types == 'all':
+
+		# Filtered by netbox, pages are printed as they arrive
+		circuits = get_circuit_rows(None if types == 'all' else types, providers)
+
+		if group_by:
+			# (provider, type) -> [count, total commit rate], nothing else is kept
+			groups = dict()
+			for circuit in circuits:
+				group = groups.setdefault(tuple(circuit[key] for key in group_by), [0, 0])
+				group[0] += 1
+				group[1] += circuit['commit_rate'] or 0
+			print_circuit_groups(groups, group_by, out_format)
+
+		elif out_format == 'json':
+			# Streamed JSON array
+			sep = '[\n'
+			for circuit in circuits:
+				sys.stdout.write(sep + '  ' + json.dumps(circuit))
+				sep = ',\n'
+			print('[]' if sep == '[\n' else '\n]')
+
+		elif out_format == 'csv':
+			writer = csv.DictWriter(sys.stdout, fieldnames=CIRCUIT_FIELDS, lineterminator='\n')
+			writer.writeheader()
+			for circuit in circuits:
+				writer.writerow(circuit)
+
+		else:
+			for circuit in circuits:
 				print('isp: {0}, type: {1}, cid: {2}, id: {3}'.format(
-					circuit.provider.name, circuit.type.slug, circuit.cid, circuit.id))
+					circuit['provider'], circuit['type_slug'], circuit['cid'], circuit['id']))
+
+	except BrokenPipeError:
+		# Output piped into head & co. that stopped reading
+		os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def get_render_jobs(devices=None, snapshot=None, kind='intf', out_dir=None):
+	# One job per device, its interface/vlan data is built here, rendering is left to the pool
+	for device in devices:
+		record = snapshot['devices'].get(str(device))
+		if record is None:
+			print('{0} not found in the netbox!'.format(device))
+			continue
+		if kind == 'vlan':
+			if 'switch' not in record.device_role.slug:
+				continue
+			# Vlan data of the site without rendering it here, the pool renders it
+			config_dict = get_site_vlan_plan(snapshot, record.site.id)['config_dict']
+		else:
+			NETBOX_DEVICE_IP, config_dict = build_device_cfg(device, snapshot, verbose=False)
+		if not config_dict:
+			continue
+		rel_file = os.path.join(kind, '{0}.cfg'.format(str(device).lower()))
+		yield {
+			'device': str(device),
+			'site': get_device_site(snapshot, device),
+			'tpl': PLAN_TEMPLATES[kind],
+			'config_dict': config_dict,
+			'file': rel_file,
+			'out_file': os.path.join(out_dir, rel_file),
+		}
+
+
+def get_render_entry(job=None, result=None):
+	return {'device': job['device'], 'site': job['site'], 'file': job['file'], 'sha256': result[0], 'bytes': result[1]}
+
+
+def render_devices(devices=None, snapshot=None, kind='intf', render_path=None, workers=1):
+	try:
+		if not devices:
+			raise Exception('No device(s) specified!')
+		elif not render_path:
+			raise Exception('No render path specified!')
+
+		if not snapshot:
+			snapshot = prefetch_netbox_data(devices=devices)
+
+		# Archives are filled from a scratch dir next to them
+		archive = render_path.endswith(RENDER_ARCHIVE_SUFFIXES)
+		if archive:
+			out_dir = tempfile.mkdtemp(prefix='.render-', dir=os.path.dirname(os.path.abspath(render_path)))
+		else:
+			out_dir = render_path
+			os.makedirs(out_dir, exist_ok=True)
+
+		start = time.time()
+		entries = list()
+		jobs = get_render_jobs(devices, snapshot, kind, out_dir)
+		if workers > 1:
+			# Bounded number of jobs in flight, config data of the whole estate is never queued at once
+			with ProcessPoolExecutor(max_workers=workers) as pool:
+				pending = dict()
+				for job in jobs:
+					future = pool.submit(render_cfg_to_file, job['tpl'], job['config_dict'], job['out_file'])
+					pending[future] = job
+					if len(pending) >= workers * 4:
+						done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+						for future in done:
+							entries.append(get_render_entry(pending.pop(future), future.result()))
+				for future in wait(pending)[0]:
+					entries.append(get_render_entry(pending[future], future.result()))
+		else:
+			for job in jobs:
+				entries.append(get_render_entry(job, render_cfg_to_file(job['tpl'], job['config_dict'], job['out_file'])))
+		entries.sort(key=lambda entry: entry['file'])
+
+		templates = dict()
+		for tpl_file in sorted(set(PLAN_TEMPLATES[kind] for entry in entries)):
+			with open(tpl_file, 'rb') as file:
+				templates[os.path.basename(tpl_file)] = hashlib.sha256(file.read()).hexdigest()
+		manifest = {
+			'version': PLAN_VERSION,
+			'created': datetime.now(timezone.utc).isoformat(),
+			'kind': kind,
+			'templates': templates,
+			'devices': entries,
+		}
+		with open(os.path.join(out_dir, RENDER_MANIFEST), 'w') as file:
+			json.dump(manifest, file, indent=2)
+
+		if archive:
+			with tarfile.open(render_path, 'w:gz' if render_path.endswith('gz') else 'w') as tar:
+				tar.add(os.path.join(out_dir, RENDER_MANIFEST), arcname=RENDER_MANIFEST)
+				for entry in entries:
+					tar.add(os.path.join(out_dir, entry['file']), arcname=entry['file'])
+			shutil.rmtree(out_dir, ignore_errors=True)
+
+		print('Rendered {0} config(s), {1} bytes, to {2} in {3:.1f}s'.format(len(entries),
+			sum(entry['bytes'] for entry in entries), render_path, time.time() - start))
+		return manifest
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def read_render_manifest(path=None):
+	# Manifest file, or a render dir/archive holding one
+	if os.path.isdir(path):
+		path = os.path.join(path, RENDER_MANIFEST)
+	elif path.endswith(RENDER_ARCHIVE_SUFFIXES):
+		with tarfile.open(path) as tar:
+			return json.load(tar.extractfile(RENDER_MANIFEST))
+	with open(path) as file:
+		return json.load(file)
+
+
+def compare_render_manifest(manifest=None, golden_path=None):
+	try:
+		if not manifest:
+			raise Exception('No manifest provided!')
+		elif not golden_path:
+			raise Exception('No golden manifest specified!')
+
+		golden = dict((entry['file'], entry) for entry in read_render_manifest(golden_path)['devices'])
+		current = dict((entry['file'], entry) for entry in manifest['devices'])
+		changed = sorted(f for f in current if f in golden and current[f]['sha256'] != golden[f]['sha256'])
+		added = sorted(f for f in current if f not in golden)
+		missing = sorted(f for f in golden if f not in current)
+
+		print('\nCompared with {0}:'.format(golden_path))
+		print('*****')
+		for label, files in (('changed', changed), ('new', added), ('missing', missing)):
+			for rel_file in files:
+				print('{0:<8}  {1}'.format(label, rel_file))
+		print('*****')
+		print('changed: {0}, new: {1}, missing: {2}, same: {3}'.format(len(changed), len(added), len(missing),
+			len(current) - len(changed) - len(added)))
+		return not (changed or added or missing)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def check_site_list(site_list=None):
+	try:
+		if not site_list:
+			raise Exception('No site(s) specified!')
+
+		for site in site_list:
+			if not find_site(site):
+				raise Exception('Site \'{}\' not found!'.format(site))
+		return site_list
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -433,10 +1318,84 @@ def circuits_info(types=None):
 
 def main():
 	try:
+		global FLEET_WORKERS, FLEET_SITE_WORKERS
 		ARGS = get_cmdline()
 		dev_list = list()
+		FLEET_WORKERS = ARGS.workers
+		FLEET_SITE_WORKERS = ARGS.site_workers
+		if ARGS.snapshot_file:
+			if ARGS.incremental or ARGS.export_snapshot:
+				raise Exception('--incremental and --export-snapshot need the netbox API, not a snapshot!')
+			set_netbox_snapshot(ARGS.snapshot_file)
+		set_netbox_workers(FLEET_WORKERS)
+		set_assume_yes(ARGS.assume_yes)
+		if ARGS.profile is not None:
+			enable_profile(True, trace_file=ARGS.profile)
+		set_force_push(ARGS.force)
+		if ARGS.local_diff:
+			set_local_diff(True)
 
-		if ARGS.upd_dev:
+		# Push runs journal every device's stage, --resume continues the last unfinished run
+		run_key = None
+		for flag, value in (('i1', ARGS.upd_dev), ('i2', ARGS.upd_site_devs), ('v1', ARGS.upd_dev_vlans),
+			('v3', ARGS.upd_site_vlans)):
+			if value and not (ARGS.plan_file or ARGS.apply_file or ARGS.render_path or ARGS.export_snapshot):
+				run_targets = value.split(',')
+				run_key = get_run_key(flag, run_targets)
+				break
+		if run_key:
+			open_journal(JOURNAL_DIR, run_key, resume=ARGS.resume, targets=run_targets)
+		elif ARGS.resume:
+			raise Exception('--resume needs one of -i1, -i2, -v1, -v3!')
+
+		if ARGS.export_snapshot:
+			export_netbox_snapshot(ARGS.export_snapshot)
+
+		elif ARGS.apply_file:
+			if not apply_plan(plan_file=ARGS.apply_file, batch_size=ARGS.batch_size):
+				sys.exit(1)
+
+		elif ARGS.render_path:
+			snapshot = None
+			if ARGS.upd_dev or ARGS.upd_dev_vlans:
+				dev_list = (ARGS.upd_dev or ARGS.upd_dev_vlans).split(',')
+			elif ARGS.upd_site_devs or ARGS.upd_site_vlans:
+				site_list = (ARGS.upd_site_devs or ARGS.upd_site_vlans).split(',')
+				if site_list == ['all']:
+					site_list = get_site_slugs()
+				else:
+					site_list = check_site_list(site_list)
+				snapshot = prefetch_netbox_data(sites=site_list)
+				for site in site_list:
+					dev_list.extend(snapshot['sites'].get(site.lower(), list()))
+			else:
+				raise Exception('--render needs one of -i1, -i2, -v1, -v3!')
+			kind = 'vlan' if (ARGS.upd_dev_vlans or ARGS.upd_site_vlans) else 'intf'
+			manifest = render_devices(devices=dev_list, snapshot=snapshot, kind=kind, render_path=ARGS.render_path,
+				workers=FLEET_WORKERS)
+			if ARGS.golden_manifest and not compare_render_manifest(manifest, ARGS.golden_manifest):
+				sys.exit(1)
+
+		elif ARGS.plan_file:
+			snapshot = None
+			if ARGS.upd_dev or ARGS.upd_dev_vlans or ARGS.upd_db_dev:
+				dev_list = (ARGS.upd_dev or ARGS.upd_dev_vlans or ARGS.upd_db_dev).split(',')
+			elif ARGS.upd_site_devs or ARGS.upd_site_vlans or ARGS.upd_db_site:
+				site_list = check_site_list((ARGS.upd_site_devs or ARGS.upd_site_vlans or ARGS.upd_db_site).split(','))
+				snapshot = prefetch_netbox_data(sites=site_list)
+				for site in site_list:
+					dev_list.extend(snapshot['sites'].get(site.lower(), list()))
+			else:
+				raise Exception('--plan needs one of -i1, -i2, -i3, -i4, -v1, -v3!')
+			if ARGS.upd_db_dev or ARGS.upd_db_site:
+				kind = 'db'
+			elif ARGS.upd_dev_vlans or ARGS.upd_site_vlans:
+				kind = 'vlan'
+			else:
+				kind = 'intf'
+			create_plan(plan_file=ARGS.plan_file, snapshot=snapshot, devices=dev_list, kind=kind)
+
+		elif ARGS.upd_dev:
 			dev_list = ARGS.upd_dev.split(',')
 			update_device_cfg(devices=dev_list)
 
@@ -445,34 +1404,67 @@ def main():
 			update_device_vlans(devices=dev_list)
 
 		elif ARGS.upd_site_devs:
-			site_list = ARGS.upd_site_devs.split(',')
-			for site in site_list:
-				if NETBOX_API.dcim.sites.get(name=site) or NETBOX_API.dcim.sites.get(name=site.upper()) \
-					or NETBOX_API.dcim.sites.get(name=site.lower()):
-					dev_list = NETBOX_API.dcim.devices.filter(site=site.lower())
-					update_device_cfg(devices=dev_list)
-				else:
-					raise Exception('Site \'{}\' not found!'.format(ARGS.upd_site_devs))
+			site_list = check_site_list(ARGS.upd_site_devs.split(','))
+			if ARGS.incremental:
+				update_sites_incremental(site_list=site_list, kind='intf')
+			else:
+				snapshot = prefetch_netbox_data(sites=site_list)
+				# All sites go through one worker pool, limited per site by --site-workers
+				for site in site_list:
+					dev_list.extend(snapshot['sites'].get(site.lower(), list()))
+				if dev_list:
+					update_device_cfg(devices=dev_list, snapshot=snapshot)
 
 		elif ARGS.upd_site_vlans:
-			site_list = ARGS.upd_site_vlans.split(',')
-			for site in site_list:
-				if NETBOX_API.dcim.sites.get(name=site) or NETBOX_API.dcim.sites.get(name=site.upper()) \
-					or NETBOX_API.dcim.sites.get(name=site.lower()):
-					dev_list = NETBOX_API.dcim.devices.filter(site=site.lower())
-					update_device_vlans(devices=dev_list)
-				else:
-					raise Exception('Site \'{}\' not found!'.format(ARGS.upd_site_vlans))
+			site_list = check_site_list(ARGS.upd_site_vlans.split(','))
+			if ARGS.incremental:
+				update_sites_incremental(site_list=site_list, kind='vlan')
+			else:
+				snapshot = prefetch_netbox_data(sites=site_list)
+				# All sites go through one worker pool, vlan write-back is tracked per site
+				for site in site_list:
+					dev_list.extend(snapshot['sites'].get(site.lower(), list()))
+				if dev_list:
+					update_device_vlans(devices=dev_list, snapshot=snapshot)
 
 		elif ARGS.upd_db_dev:
-			update_netbox_db(device=ARGS.upd_db_dev)
+			dev_list = ARGS.upd_db_dev.split(',')
+			snapshot = prefetch_netbox_data(devices=dev_list)
+			for device in dev_list:
+				update_netbox_db(device=device, snapshot=snapshot)
+
+		elif ARGS.upd_db_site:
+			site_list = check_site_list(ARGS.upd_db_site.split(','))
+			update_sites_netbox_db(site_list=site_list)
+
+		elif ARGS.arch_dev:
+			dev_list = ARGS.arch_dev.split(',')
+			archive_devices_cfg(devices=dev_list, force=ARGS.force)
+
+		elif ARGS.arch_site_devs:
+			site_list = check_site_list(ARGS.arch_site_devs.split(','))
+			snapshot = prefetch_netbox_data(sites=site_list, devices_only=True)
+			for site in site_list:
+				dev_list.extend(snapshot['sites'].get(site.lower(), list()))
+			if dev_list:
+				archive_devices_cfg(devices=dev_list, snapshot=snapshot, force=ARGS.force)
 
 		elif ARGS.site_circuits:
+			group_by = None
+			if ARGS.group_by:
+				group_by = [key.strip() for key in ARGS.group_by.split(',')]
+				if not group_by or any(key not in ('provider', 'type') for key in group_by):
+					raise Exception('--group-by takes \'provider\', \'type\' or \'provider,type\'!')
+			providers = ARGS.circuit_providers.split(',') if ARGS.circuit_providers else None
 			if ARGS.site_circuits != 'all':
 				types = ARGS.site_circuits.split(',')
-				circuits_info(types)
+				circuits_info(types, providers, ARGS.out_format, group_by)
 			else:
-				circuits_info(ARGS.site_circuits)
+				circuits_info(ARGS.site_circuits, providers, ARGS.out_format, group_by)
+
+		# Not every device got done (failed, interrupted): non-zero exit, the journal tells which
+		if run_key and not close_journal():
+			sys.exit(1)
 
 	except Exception as e:
 		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
@@ -480,6 +1472,11 @@ def main():
 		print(msg)
 		sys.exit(1)
 
+	finally:
+		close_journal()
+		close_napalm_sessions()
+		finish_profile()
+
 
 if __name__ == '__main__':
 	main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import re
+import json
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+
+
+# Rollout journal, one JSON line per device stage:
+#   <journal dir>/<flag>_<digest of the targets>.jsonl
+# fetched -> rendered [-> diffed] -> committed [-> writeback], or unchanged/declined/failed.
+# A rerun of the same command with --resume skips the devices a previous run already finished,
+# 'declined' (the operator answered no) included: --resume must not push what was turned down.
+
+DONE_STAGES = ('committed', 'writeback', 'unchanged', 'declined')
+JOURNAL_FILE = None
+JOURNAL_PATH = None
+# device -> last stage, of this run and of the run it resumes
+JOURNAL_STATE = dict()
+# device -> last stage of the resumed run, see is_device_done()
+JOURNAL_RESUMED = dict()
+JOURNAL_LOCK = threading.Lock()
+
+
+def get_run_targets(targets=None):
+	return sorted(set(str(target).strip().lower() for target in targets or [] if str(target).strip()))
+
+
+def get_run_key(flag=None, targets=None):
+	# Device/site lists can be longer than a file name may be, the key is their digest
+	digest = hashlib.sha1(','.join(get_run_targets(targets)).encode('utf-8')).hexdigest()[:16]
+	return '{0}_{1}'.format(flag, digest)
+
+
+def get_journal_path(journal_dir=None, run_key=None):
+	return os.path.join(journal_dir, re.sub(r'[^\w.,-]', '_', run_key) + '.jsonl')
+
+
+def read_journal(path=None):
+	# -> header of the last run, device -> last stage, whether the last run completed
+	header = None
+	stages = dict()
+	complete = False
+	with open(path) as file:
+		for line in file:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				# Line cut by a crash
+				continue
+			if 'run' in entry:
+				header = entry
+				complete = False
+			elif 'complete' in entry:
+				complete = entry['complete']
+			elif entry.get('device'):
+				stages[entry['device']] = entry['stage']
+	return header, stages, complete
+
+
+def open_journal(journal_dir=None, run_key=None, resume=False, targets=None):
+	global JOURNAL_FILE, JOURNAL_PATH
+	try:
+		if not journal_dir:
+			raise Exception('No journal dir specified!')
+		elif not run_key:
+			raise Exception('No run key specified!')
+
+		path = get_journal_path(journal_dir, run_key)
+		if targets is not None:
+			targets = get_run_targets(targets)
+		label = ','.join(targets) if targets else run_key
+		os.makedirs(journal_dir, exist_ok=True)
+		with JOURNAL_LOCK:
+			JOURNAL_STATE.clear()
+			JOURNAL_RESUMED.clear()
+			mode = 'w'
+			if resume and os.path.exists(path):
+				header, stages, complete = read_journal(path)
+				if header and targets is not None and header.get('targets') not in (None, targets):
+					print('Journal {0} is of another run, starting from scratch'.format(path))
+				elif complete:
+					print('Last \'{0}\' run completed, nothing to resume'.format(label))
+				else:
+					JOURNAL_RESUMED.update(stages)
+					JOURNAL_STATE.update(stages)
+					mode = 'a'
+					done = [device for device, stage in stages.items() if stage in DONE_STAGES]
+					print('Resuming \'{0}\' started {1}: {2} device(s) done, {3} to go\n'.format(label,
+						(header or dict()).get('time', '?'), len(done), len(stages) - len(done)))
+			elif resume:
+				print('No journal of \'{0}\' to resume, starting from scratch'.format(label))
+			JOURNAL_FILE = open(path, mode)
+			JOURNAL_PATH = path
+			write_entry({'run': run_key, 'targets': targets, 'resume': mode == 'a', 'argv': sys.argv[1:]})
+		return path
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def write_entry(entry=None):
+	# Caller holds JOURNAL_LOCK. Flushed per line, a crash loses at most the stage in progress
+	entry = dict({'time': datetime.now(timezone.utc).isoformat()}, **entry)
+	JOURNAL_FILE.write(json.dumps(entry) + '\n')
+	JOURNAL_FILE.flush()
+
+
+def record_stage(device=None, stage=None, **info):
+	if JOURNAL_FILE is None:
+		return
+	with JOURNAL_LOCK:
+		if JOURNAL_FILE is None:
+			return
+		JOURNAL_STATE[str(device)] = stage
+		write_entry(dict(info, device=str(device), stage=stage))
+
+
+def get_device_stage(device=None):
+	return JOURNAL_STATE.get(str(device))
+
+
+def is_device_done(device=None):
+	# Finished by the run being resumed, so it doesn't have to be touched again
+	return JOURNAL_RESUMED.get(str(device)) in DONE_STAGES
+
+
+def close_journal():
+	# The run is complete once every device it touched got to a done stage
+	global JOURNAL_FILE
+	with JOURNAL_LOCK:
+		if JOURNAL_FILE is None:
+			return None
+		pending = sorted(device for device, stage in JOURNAL_STATE.items() if stage not in DONE_STAGES)
+		write_entry({'complete': not pending})
+		JOURNAL_FILE.close()
+		JOURNAL_FILE = None
+	if pending:
+		print('\n{0} device(s) not done ({1}), rerun the same command with --resume to continue. Journal: {2}'.format(
+			len(pending), ', '.join(pending), JOURNAL_PATH))
+	return not pending
+
+
+def print_journal(path=None):
+	header, stages, complete = read_journal(path)
+	width = max([len('device')] + [len(device) for device in stages])
+	print('run: {0} ({1}), started: {2}, complete: {3}'.format((header or dict()).get('run'),
+		','.join((header or dict()).get('targets') or []), (header or dict()).get('time'), complete))
+	print('*****')
+	print('{0:<{w}}  {1}'.format('device', 'stage', w=width))
+	for device in sorted(stages):
+		print('{0:<{w}}  {1}'.format(device, stages[device], w=width))
+	print('*****')
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('journal', type=str, help='journal FILE to show the last stage of every device of.')
+	arguments = parser.parse_args()
+	return arguments
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+		print_journal(ARGS.journal)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
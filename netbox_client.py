@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+
+# Netbox answers these when it's overloaded or restarting, worth another try
+NETBOX_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# POST isn't retried, a lost response would create the object twice
+NETBOX_RETRY_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'PATCH', 'DELETE'])
+NETBOX_MIN_POOL_SIZE = 10
+
+
+# requests, urllib3 and pynetbox are imported when the client is built, not by every command importing this module
+def build_netbox_session(pool_size=NETBOX_MIN_POOL_SIZE, retries=3, backoff_factor=0.5, timeout=30):
+	import requests
+	from requests.adapters import HTTPAdapter
+	from urllib3.util.retry import Retry
+
+	class TimeoutHTTPAdapter(HTTPAdapter):
+		# requests has no session-wide timeout and pynetbox doesn't pass one, requests without their own get this one
+		def __init__(self, timeout=None, **kwargs):
+			self.timeout = timeout
+			super().__init__(**kwargs)
+
+		def send(self, request, timeout=None, **kwargs):
+			if timeout is None:
+				timeout = self.timeout
+			return super().send(request, timeout=timeout, **kwargs)
+
+	session = requests.Session()
+	retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=NETBOX_RETRY_STATUSES,
+		allowed_methods=NETBOX_RETRY_METHODS, respect_retry_after_header=True, raise_on_status=False)
+	# One host, so a single pool whose size is the number of concurrent requests it may serve
+	adapter = TimeoutHTTPAdapter(timeout=timeout or None, pool_connections=1, pool_maxsize=pool_size,
+		max_retries=retry)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
+	return session
+
+
+def get_netbox_api(netbox_params=None, workers=1):
+	# netbox section of config.yml -> pynetbox client on a tuned, pooled HTTP session
+	import pynetbox
+
+	pool_size = netbox_params.get('pool_size') or max(NETBOX_MIN_POOL_SIZE, workers or 1)
+	api = pynetbox.api(netbox_params['url'], token=netbox_params['token'],
+		threading=netbox_params.get('threading', False))
+	api.http_session = build_netbox_session(pool_size=pool_size,
+		retries=netbox_params.get('retries', 3),
+		backoff_factor=netbox_params.get('backoff_factor', 0.5),
+		timeout=netbox_params.get('timeout', 30))
+	return api
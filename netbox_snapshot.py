@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import mmap
+import zlib
+import struct
+import argparse
+
+
+# Netbox data frozen into one file, read instead of the API with --snapshot:
+#   header - magic, format version, offset and length of the index
+#   blobs  - zlib compressed JSON, one per site, device (with its interfaces), site vlans, site topology
+#   index  - zlib compressed JSON: meta + section -> key -> [offset, length] of the blob
+# The file is memory-mapped, opening it reads the header and the index only, blobs are decoded on use.
+
+SNAPSHOT_MAGIC = b'NBSNAP'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<6sHQQ')
+SNAPSHOT_SECTIONS = ('sites', 'devices', 'vlans', 'topology', 'circuits')
+
+
+def pack_blob(value=None):
+	return zlib.compress(json.dumps(value, separators=(',', ':')).encode('utf-8'), 6)
+
+
+def write_snapshot(path=None, meta=None, sections=None):
+	try:
+		if not path:
+			raise Exception('No snapshot file specified!')
+
+		index = {'meta': dict(meta or dict(), version=SNAPSHOT_VERSION), 'sections': dict()}
+		tmp_file = path + '.tmp'
+		with open(tmp_file, 'wb') as file:
+			file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, 0))
+			offset = SNAPSHOT_HEADER.size
+			for section in SNAPSHOT_SECTIONS:
+				entries = index['sections'][section] = dict()
+				for key, value in (sections or dict()).get(section, dict()).items():
+					blob = pack_blob(value)
+					file.write(blob)
+					entries[str(key)] = [offset, len(blob)]
+					offset += len(blob)
+			blob = pack_blob(index)
+			file.write(blob)
+			file.seek(0)
+			file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, offset, len(blob)))
+		os.replace(tmp_file, path)
+		return offset + len(blob)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+class SnapshotFile(object):
+	# Read-only view of a snapshot file
+
+	__slots__ = ('path', 'meta', 'index', '_file', '_map')
+
+	def __init__(self, path=None):
+		self.path = path
+		self._file = open(path, 'rb')
+		self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._map.size() < SNAPSHOT_HEADER.size:
+			raise Exception('{0} is not a netbox snapshot!'.format(path))
+		magic, version, offset, length = SNAPSHOT_HEADER.unpack_from(self._map, 0)
+		if magic != SNAPSHOT_MAGIC:
+			raise Exception('{0} is not a netbox snapshot!'.format(path))
+		elif version != SNAPSHOT_VERSION:
+			raise Exception('{0} is a version {1} snapshot, version {2} is supported!'.format(path, version,
+				SNAPSHOT_VERSION))
+		elif not offset:
+			raise Exception('{0} is incomplete!'.format(path))
+		data = json.loads(zlib.decompress(self._map[offset:offset + length]))
+		self.meta = data['meta']
+		self.index = data['sections']
+
+	def keys(self, section=None):
+		return self.index.get(section, dict()).keys()
+
+	def has(self, section=None, key=None):
+		return str(key) in self.index.get(section, dict())
+
+	def get(self, section=None, key=None, default=None):
+		entry = self.index.get(section, dict()).get(str(key))
+		if entry is None:
+			return default
+		offset, length = entry
+		return json.loads(zlib.decompress(self._map[offset:offset + length]))
+
+	def close(self):
+		self._map.close()
+		self._file.close()
+
+	def __repr__(self):
+		return '<SnapshotFile {0}>'.format(self.path)
+
+
+class SnapshotRecord(object):
+	# Stands in for the pynetbox record an object was exported from, nested objects are records as well
+
+	__slots__ = ('_values',)
+
+	def __init__(self, values=None):
+		object.__setattr__(self, '_values', values)
+
+	def __getattr__(self, attr):
+		try:
+			value = self._values[attr]
+		except KeyError:
+			raise AttributeError(attr)
+		if isinstance(value, dict):
+			return SnapshotRecord(value)
+		return value
+
+	def __setattr__(self, attr, value):
+		raise AttributeError('Snapshot records are read-only')
+
+	def __iter__(self):
+		return iter(self._values.items())
+
+	def __str__(self):
+		# Same as pynetbox: ip addresses print as their address, everything else as its name
+		for key in ('address', 'name', 'label', 'display'):
+			if self._values.get(key):
+				return str(self._values[key])
+		return ''
+
+	def __repr__(self):
+		return '<SnapshotRecord {0}>'.format(str(self) or self._values.get('id'))
+
+
+def print_snapshot(path=None):
+	snapshot_file = SnapshotFile(path)
+	print('{0}: version {1}, exported {2} from {3}'.format(path, snapshot_file.meta.get('version'),
+		snapshot_file.meta.get('created'), snapshot_file.meta.get('netbox')))
+	print('*****')
+	for section in SNAPSHOT_SECTIONS:
+		entries = snapshot_file.index.get(section, dict())
+		print('{0:<10}  {1:>7} entries  {2:>10} bytes'.format(section, len(entries),
+			sum(length for offset, length in entries.values())))
+	counts = snapshot_file.meta.get('counts') or dict()
+	print(', '.join('{0}: {1}'.format(key, counts[key]) for key in sorted(counts)))
+	print('*****')
+	snapshot_file.close()
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('snapshot', type=str, help='snapshot FILE to show the contents of.')
+	arguments = parser.parse_args()
+	return arguments
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+		print_snapshot(ARGS.snapshot)
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
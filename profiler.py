@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import re
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+
+# Run-wide timing records, collected only after enable_profile():
+# netbox HTTP requests per endpoint and stages (render, NAPALM, clogin...) per device.
+
+PROFILE_ENABLED = False
+PROFILE_EVENTS = list()
+PROFILE_LOCK = threading.Lock()
+PROFILE_START = time.time()
+PROFILE_TRACE_FILE = None
+# Device handled by the current thread, set by the fleet runner
+PROFILE_CONTEXT = threading.local()
+# Upper bounds of the latency histogram buckets, ms
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500)
+ENDPOINT_ID_RE = re.compile(r'/\d+(?=/|$)')
+
+
+def enable_profile(flag=True, trace_file=None):
+	global PROFILE_ENABLED, PROFILE_START, PROFILE_TRACE_FILE
+	PROFILE_ENABLED = bool(flag)
+	PROFILE_START = time.time()
+	PROFILE_TRACE_FILE = trace_file or None
+
+
+def set_profile_device(device=None):
+	PROFILE_CONTEXT.device = device
+
+
+def get_profile_device():
+	return getattr(PROFILE_CONTEXT, 'device', None)
+
+
+def add_event(cat=None, name=None, start=None, duration=None, device=None, **args):
+	if not PROFILE_ENABLED:
+		return
+	event = {
+		'cat': cat,
+		'name': name,
+		'start': start,
+		'duration': duration,
+		'device': device or get_profile_device(),
+		'tid': threading.get_ident(),
+		'args': args,
+	}
+	with PROFILE_LOCK:
+		PROFILE_EVENTS.append(event)
+
+
+@contextmanager
+def stage(name=None, device=None):
+	if not PROFILE_ENABLED:
+		yield
+		return
+	start = time.time()
+	try:
+		yield
+	finally:
+		add_event('stage', name, start, time.time() - start, device)
+
+
+def profiled(name=None, device_arg=None):
+	# Decorator timing every call as stage 'name', device is taken from the 'device_arg' argument
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			if not PROFILE_ENABLED:
+				return func(*args, **kwargs)
+			device = kwargs.get(device_arg) if device_arg in kwargs else (args[0] if args and device_arg else None)
+			with stage(name, device=device):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def get_endpoint(url=None):
+	# http://netbox/api/dcim/interfaces/12/?limit=1000 -> dcim/interfaces/{id}
+	path = url.split('?', 1)[0].split('/api/', 1)[-1].strip('/')
+	return ENDPOINT_ID_RE.sub('/{id}', '/' + path).lstrip('/')
+
+
+def http_response_hook(response, *args, **kwargs):
+	if PROFILE_ENABLED:
+		duration = response.elapsed.total_seconds()
+		add_event('http', '{0} {1}'.format(response.request.method, get_endpoint(response.request.url)),
+			time.time() - duration, duration, status=response.status_code)
+	return response
+
+
+def install_http_hooks(http_session=None):
+	hooks = http_session.hooks.setdefault('response', list())
+	if http_response_hook not in hooks:
+		hooks.append(http_response_hook)
+
+
+def get_percentile(values=None, percent=50):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def get_histogram(durations=None):
+	counts = [0] * (len(LATENCY_BUCKETS) + 1)
+	for duration in durations:
+		ms = duration * 1000
+		n = 0
+		while n < len(LATENCY_BUCKETS) and ms > LATENCY_BUCKETS[n]:
+			n += 1
+		counts[n] += 1
+	labels = ['<{0}'.format(b) for b in LATENCY_BUCKETS] + ['>{0}'.format(LATENCY_BUCKETS[-1])]
+	return ' '.join('{0}:{1}'.format(l, c) for l, c in zip(labels, counts) if c)
+
+
+def print_profile():
+	with PROFILE_LOCK:
+		events = list(PROFILE_EVENTS)
+	if not events:
+		return
+
+	by_endpoint = dict()
+	by_stage = dict()
+	by_device = dict()
+	for event in events:
+		if event['cat'] == 'http':
+			by_endpoint.setdefault(event['name'], list()).append(event['duration'])
+		else:
+			by_stage.setdefault(event['name'], list()).append(event['duration'])
+			if event['device']:
+				stages = by_device.setdefault(event['device'], dict())
+				stages[event['name']] = stages.get(event['name'], 0.0) + event['duration']
+
+	if by_endpoint:
+		width = max(len('endpoint'), max(len(k) for k in by_endpoint))
+		row = '{0:<{w}}  {1:>6}  {2:>8}  {3:>8}  {4:>8}  {5:>8}  {6}'
+		print('\nNetbox requests:')
+		print('*****')
+		print(row.format('endpoint', 'count', 'total, s', 'p50, ms', 'p95, ms', 'max, ms', 'histogram, ms', w=width))
+		for endpoint, durations in sorted(by_endpoint.items(), key=lambda i: -sum(i[1])):
+			print(row.format(endpoint, len(durations), '{0:.2f}'.format(sum(durations)),
+				'{0:.0f}'.format(get_percentile(durations, 50) * 1000), '{0:.0f}'.format(get_percentile(durations, 95) * 1000),
+				'{0:.0f}'.format(max(durations) * 1000), get_histogram(durations), w=width))
+		print('*****')
+		print('requests: {0}, total: {1:.2f}s'.format(sum(len(d) for d in by_endpoint.values()),
+			sum(sum(d) for d in by_endpoint.values())))
+
+	if by_stage:
+		width = max(len('stage'), max(len(k) for k in by_stage))
+		row = '{0:<{w}}  {1:>6}  {2:>8}  {3:>8}  {4:>8}'
+		print('\nStages:')
+		print('*****')
+		print(row.format('stage', 'count', 'total, s', 'avg, ms', 'max, ms', w=width))
+		for name, durations in sorted(by_stage.items(), key=lambda i: -sum(i[1])):
+			print(row.format(name, len(durations), '{0:.2f}'.format(sum(durations)),
+				'{0:.0f}'.format(sum(durations) / len(durations) * 1000), '{0:.0f}'.format(max(durations) * 1000), w=width))
+		print('*****')
+
+	if by_device:
+		names = sorted(set(name for stages in by_device.values() for name in stages))
+		width = max(len('device'), max(len(str(k)) for k in by_device))
+		print('\nStages per device, s:')
+		print('*****')
+		print('  '.join(['{0:<{w}}'.format('device', w=width)] + ['{0:>{w}}'.format(n, w=max(len(n), 6)) for n in names]))
+		for device in sorted(by_device):
+			stages = by_device[device]
+			print('  '.join(['{0:<{w}}'.format(str(device), w=width)] + ['{0:>{w}}'.format(
+				'{0:.2f}'.format(stages[n]) if n in stages else '-', w=max(len(n), 6)) for n in names]))
+		print('*****')
+	print('wall time: {0:.2f}s'.format(time.time() - PROFILE_START))
+
+
+def write_chrome_trace(trace_file=None):
+	try:
+		if not trace_file:
+			raise Exception('No trace file specified!')
+
+		with PROFILE_LOCK:
+			events = list(PROFILE_EVENTS)
+		# chrome://tracing / Perfetto 'complete' events, one row per worker thread
+		trace_events = list()
+		threads = dict()
+		for event in events:
+			tid = threads.setdefault(event['tid'], len(threads) + 1)
+			args = dict(event['args'])
+			if event['device']:
+				args['device'] = event['device']
+			trace_events.append({
+				'name': event['name'],
+				'cat': event['cat'],
+				'ph': 'X',
+				'ts': int((event['start'] - PROFILE_START) * 1000000),
+				'dur': int(event['duration'] * 1000000),
+				'pid': os.getpid(),
+				'tid': tid,
+				'args': args,
+				})
+		for ident, tid in threads.items():
+			trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+				'args': {'name': 'worker {0}'.format(tid)}})
+		with open(trace_file, 'w') as file:
+			json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, file)
+		print('Chrome trace written to {0}'.format(trace_file))
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+
+def finish_profile():
+	# Summary tables, plus the Chrome trace if a file was given to enable_profile()
+	if not PROFILE_ENABLED:
+		return
+	print_profile()
+	if PROFILE_TRACE_FILE:
+		write_chrome_trace(PROFILE_TRACE_FILE)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import importlib
+import threading
+# Local profiler.py
+from profiler import stage
+
+
+# Heavy modules (NAPALM and its drivers, jinja2, ciscoconfparse) and clients (netbox) are built on
+# first use: get_registered() runs the factory given to register() once per process and keeps the result.
+
+REGISTRY_FACTORIES = dict()
+REGISTRY_OBJECTS = dict()
+REGISTRY_LOCK = threading.RLock()
+
+
+def register(name=None, factory=None):
+	with REGISTRY_LOCK:
+		REGISTRY_FACTORIES[name] = factory
+		REGISTRY_OBJECTS.pop(name, None)
+
+
+def register_module(name=None, module=None):
+	register(name, lambda: importlib.import_module(module or name))
+
+
+def is_loaded(name=None):
+	return name in REGISTRY_OBJECTS
+
+
+def get_registered(name=None):
+	if name in REGISTRY_OBJECTS:
+		return REGISTRY_OBJECTS[name]
+	with REGISTRY_LOCK:
+		if name not in REGISTRY_OBJECTS:
+			if name not in REGISTRY_FACTORIES:
+				raise Exception('\'{0}\' is not registered!'.format(name))
+			# Shows up as 'load_<name>' in --profile output
+			with stage('load_{0}'.format(name)):
+				REGISTRY_OBJECTS[name] = REGISTRY_FACTORIES[name]()
+		return REGISTRY_OBJECTS[name]
+
+
+class LazyObject(object):
+	# Module-level stand-in for a registered object, the object is built on the first attribute access
+
+	__slots__ = ('_name',)
+
+	def __init__(self, name=None):
+		object.__setattr__(self, '_name', name)
+
+	def __getattr__(self, attr):
+		return getattr(get_registered(self._name), attr)
+
+	def __setattr__(self, attr, value):
+		setattr(get_registered(self._name), attr, value)
+
+	def __repr__(self):
+		if is_loaded(self._name):
+			return repr(get_registered(self._name))
+		return '<lazy {0}>'.format(self._name)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import hmac
+import json
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+# Local gen_intf_cfg.py
+import gen_intf_cfg
+from functions import *
+
+
+# Long-running sync: netbox webhooks (interface, vlan, circuit, circuit termination) are mapped to
+# devices/sites, bursts are coalesced and only the affected devices are re-rendered and pushed
+# through update_device_cfg()/update_device_vlans().
+
+WEBHOOK_PARAMS = YAML_PARAMS.get('webhook') or dict()
+WEBHOOK_MODELS = ('interface', 'vlan', 'circuit', 'circuittermination')
+# Changes made by these netbox users (the owner of netbox.token: vlan write-back, interface updates) are
+# the daemon's own, syncing on them would push the same devices again and loop on its own write-back
+WEBHOOK_IGNORE_USERS = set(str(user) for user in WEBHOOK_PARAMS.get('ignore_users') or list())
+# ('device', name) / ('site', slug) / ('circuit', id) -> time of the first event
+PENDING = dict()
+PENDING_COND = threading.Condition()
+LAST_EVENT = 0.0
+
+
+def get_cmdline():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--listen', dest='listen', type=str, default=WEBHOOK_PARAMS.get('listen', '127.0.0.1'),
+							help='ADDRESS to listen on for netbox webhooks (default: 127.0.0.1).',
+							required=False)
+	parser.add_argument('--port', dest='port', type=int, default=WEBHOOK_PARAMS.get('port', 8001),
+							help='PORT to listen on (default: 8001).',
+							required=False)
+	parser.add_argument('--debounce', dest='debounce', type=float, default=WEBHOOK_PARAMS.get('debounce', 5),
+							help='sync once no event came for SECONDS (default: 5).',
+							required=False)
+	parser.add_argument('--max-delay', dest='max_delay', type=float, default=WEBHOOK_PARAMS.get('max_delay', 60),
+							help='sync at the latest SECONDS after the first pending event (default: 60).',
+							required=False)
+	parser.add_argument('--workers', dest='workers', type=int, default=gen_intf_cfg.FLEET_WORKERS,
+							help='number of devices handled in parallel (default: fleet.workers).',
+							required=False)
+	arguments = parser.parse_args()
+	return arguments
+
+
+def check_signature(body=None, signature=None):
+	# netbox signs the body with HMAC-SHA512 of the webhook secret
+	secret = WEBHOOK_PARAMS.get('secret')
+	if not secret:
+		return True
+	expected = hmac.new(str(secret).encode(), body, hashlib.sha512).hexdigest()
+	return hmac.compare_digest(expected, str(signature or ''))
+
+
+def get_event_targets(event=None):
+	# Webhook payload -> set of ('device', name), ('site', slug), ('circuit', id)
+	model = event.get('model')
+	data = event.get('data') or dict()
+	targets = set()
+	if model == 'interface':
+		if (data.get('device') or dict()).get('name'):
+			targets.add(('device', data['device']['name']))
+	elif model == 'vlan':
+		if (data.get('site') or dict()).get('slug'):
+			targets.add(('site', data['site']['slug']))
+	elif model == 'circuit':
+		if data.get('id'):
+			targets.add(('circuit', int(data['id'])))
+	elif model == 'circuittermination':
+		device = ((data.get('interface') or dict()).get('device') or dict()).get('name')
+		if device:
+			targets.add(('device', device))
+		if (data.get('circuit') or dict()).get('id'):
+			targets.add(('circuit', int(data['circuit']['id'])))
+	return targets
+
+
+def queue_targets(targets=None):
+	global LAST_EVENT
+	with PENDING_COND:
+		now = time.time()
+		for target in targets:
+			PENDING.setdefault(target, now)
+		LAST_EVENT = now
+		PENDING_COND.notify_all()
+
+
+def wait_for_batch(debounce=5, max_delay=60):
+	# Blocks until the events went quiet for 'debounce' seconds (or the oldest one waits 'max_delay')
+	with PENDING_COND:
+		while True:
+			if not PENDING:
+				PENDING_COND.wait()
+				continue
+			now = time.time()
+			remaining = min(LAST_EVENT + debounce, min(PENDING.values()) + max_delay) - now
+			if remaining > 0:
+				PENDING_COND.wait(remaining)
+				continue
+			batch = set(PENDING)
+			PENDING.clear()
+			return batch
+
+
+def sync_batch(batch=None):
+	devices = set(name for kind, name in batch if kind == 'device')
+	sites = set(name for kind, name in batch if kind == 'site')
+	circuit_ids = set(name for kind, name in batch if kind == 'circuit')
+
+	# Running configs cached by an earlier batch may be outdated by now (archive TTL still applies)
+	with RUNNING_CONFIGS_LOCK:
+		RUNNING_CONFIGS.clear()
+
+	if circuit_ids:
+		# Provider/type/rate of the changed circuits have to be reread
+		get_circuit_index(refresh=True)
+		devices.update(get_circuit_devices(circuit_ids))
+
+	if not (devices or sites):
+		print('Nothing to sync')
+		return
+	print('Syncing {0} device(s) and vlans of {1} site(s)...'.format(len(devices), len(sites)))
+	snapshot = prefetch_netbox_data(devices=sorted(devices), sites=sorted(sites))
+	dev_list = [device for device in sorted(devices) if device in snapshot['devices']]
+	if dev_list:
+		gen_intf_cfg.update_device_cfg(devices=dev_list, snapshot=snapshot)
+	site_devs = list()
+	for site in sorted(sites):
+		site_devs.extend(snapshot['sites'].get(site.lower(), list()))
+	if site_devs:
+		gen_intf_cfg.update_device_vlans(devices=site_devs, snapshot=snapshot)
+
+
+def sync_loop(debounce=5, max_delay=60):
+	while True:
+		batch = wait_for_batch(debounce, max_delay)
+		start = time.time()
+		# A failed batch must not stop the daemon, its devices are picked up by the next event
+		try:
+			sync_batch(batch)
+		except SystemExit as e:
+			print('Sync of {0} target(s) failed (exit code {1})'.format(len(batch), e.code))
+		except Exception as e:
+			print('Sync of {0} target(s) failed: {1}'.format(len(batch), e))
+		print('Sync done in {0:.1f}s\n'.format(time.time() - start))
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+
+	def log_message(self, *args):
+		pass
+
+	def send_status(self, status=200):
+		self.send_response(status)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		if not check_signature(body, self.headers.get('X-Hook-Signature')):
+			print('Webhook with a bad signature from {0} dropped'.format(self.client_address[0]))
+			return self.send_status(403)
+		try:
+			event = json.loads(body)
+		except ValueError:
+			return self.send_status(400)
+		if event.get('model') not in WEBHOOK_MODELS:
+			return self.send_status(204)
+		elif event.get('username') in WEBHOOK_IGNORE_USERS:
+			return self.send_status(204)
+		targets = get_event_targets(event)
+		if targets:
+			print('{0} {1} id {2} -> {3}'.format(event.get('event'), event.get('model'),
+				(event.get('data') or dict()).get('id'), ', '.join('{0} {1}'.format(*t) for t in sorted(targets, key=str))))
+			queue_targets(targets)
+		self.send_status(202)
+
+
+def main():
+	try:
+		ARGS = get_cmdline()
+		gen_intf_cfg.FLEET_WORKERS = ARGS.workers
+		set_netbox_workers(ARGS.workers)
+		# Nobody is there to answer prompts
+		set_assume_yes(True)
+
+		sync_thread = threading.Thread(target=sync_loop, args=(ARGS.debounce, ARGS.max_delay), daemon=True)
+		sync_thread.start()
+
+		server = ThreadingHTTPServer((ARGS.listen, ARGS.port), WebhookHandler)
+		server.daemon_threads = True
+		print('Listening for netbox webhooks on {0}:{1}, debounce {2}s'.format(ARGS.listen, ARGS.port, ARGS.debounce))
+		server.serve_forever()
+
+	except KeyboardInterrupt:
+		print('Stopped')
+
+	except Exception as e:
+		msg = '\n\n\n*** Error in \'{0}___{1}\' function (line {2}): {3} ***\n\n\n'.format(
+			os.path.basename(__file__), sys._getframe().f_code.co_name, sys.exc_info()[-1].tb_lineno, e)
+		print(msg)
+		sys.exit(1)
+
+	finally:
+		close_napalm_sessions()
+
+
+if __name__ == '__main__':
+	main()